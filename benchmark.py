@@ -0,0 +1,966 @@
+import argparse
+import contextlib
+import csv
+import gc
+import http.server
+import io
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import wave
+from datetime import datetime, timedelta
+import numpy as np
+import speech_recognition as sr
+import script
+
+class StubRecognizer(sr.Recognizer):
+    """
+    A local stand-in for the Google recognizer that returns scripted transcripts after a fixed delay.
+
+    It reads audio through the real sr.Recognizer.record, so only the network round-trip is simulated.
+    """
+
+    def __init__(self, transcripts=("12345678910",), latency=0.05):
+        """
+        Parameters:
+        transcripts (tuple): The transcripts to return, cycled through in order.
+        latency (float): The number of seconds each recognition call takes.
+        """
+
+        super().__init__()
+        self.transcripts = list(transcripts)
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def recognize_google(self, audio_data, *args, **kwargs):
+        """
+        Returns the next scripted transcript after sleeping for the configured latency.
+
+        Raises:
+        sr.UnknownValueError: If the scripted transcript is None.
+        """
+
+        with self._lock:
+            transcript = self.transcripts[self.calls % len(self.transcripts)]
+            self.calls += 1
+        time.sleep(self.latency)
+        if transcript is None:
+            raise sr.UnknownValueError()
+        return transcript
+
+class FakeRecognitionServer:
+    """
+    A local HTTP server that answers recognition requests in the format of the Google Speech API.
+
+    Each response is scripted: a transcript is returned as the best alternative, None is returned as an empty
+    result (which recognize_google raises as sr.UnknownValueError), and an int is returned as that HTTP error status.
+    Point GoogleBackend at it with GoogleBackend(endpoint=server.endpoint). The number of requests and the total size of
+    their bodies are counted in requests and bytes_received.
+    """
+
+    def __init__(self, responses=("12345678910",), latency=0.0):
+        """
+        Parameters:
+        responses (tuple): The responses to return, cycled through in the order the requests arrive.
+        latency (float): The number of seconds to wait before answering each request.
+        """
+
+        self.responses = list(responses)
+        self.latency = latency
+        self.requests = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        """
+        str: The URL to send recognition requests to.
+        """
+
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/speech-api/v2/recognize"
+
+    def start(self):
+        """
+        Starts serving on a free local port in a background thread.
+        """
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with server._lock:
+                    response = server.responses[server.requests % len(server.responses)]
+                    server.requests += 1
+                    server.bytes_received += len(payload)
+                time.sleep(server.latency)
+                if isinstance(response, int):
+                    self.send_error(response)
+                    return
+                results = [{"alternative": [{"transcript": response}], "final": True}] if response is not None else []
+                body = (json.dumps({"result": []}) + "\n" + json.dumps({"result": results, "result_index": 0}) + "\n").encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the server.
+        """
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+def write_wav(path, seconds=1.0, sample_rate=16000, marker=0):
+    """
+    Writes a silent 16-bit mono WAV file.
+
+    Parameters:
+    path (str): The path of the WAV file to write.
+    seconds (float): The length of the audio.
+    sample_rate (int): The sample rate of the audio.
+    marker (int): A value stored in the first two samples, so that otherwise identical files have different contents.
+    """
+
+    frames = int(seconds * sample_rate)
+    with wave.open(path, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes((marker % 2 ** 31).to_bytes(4, 'little') + b'\x00\x00' * (frames - 2))
+
+def write_counting_wav(path, words=10, word_seconds=0.3, gap_seconds=0.4, sample_rate=16000, pitch=300):
+    """
+    Writes a 16-bit mono WAV file with a tone for each word, separated and surrounded by silence.
+
+    Each word is a tone of a different pitch, so that the words can be told apart.
+
+    Parameters:
+    path (str): The path of the WAV file to write.
+    words (int): The number of words.
+    word_seconds (float): The length of each word.
+    gap_seconds (float): The length of the silence before, between and after the words.
+    sample_rate (int): The sample rate of the audio.
+    pitch (float): The pitch of the first word in Hz, so that recordings can differ in voice but not in timing.
+    """
+
+    t = np.arange(int(word_seconds * sample_rate)) / sample_rate
+    gap = np.zeros(int(gap_seconds * sample_rate))
+    parts = [gap]
+    for word in range(words):
+        parts += [8000 * np.sin(2 * np.pi * (pitch + 60 * word) * t), gap]
+    with wave.open(path, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(np.concatenate(parts).astype('<i2').tobytes())
+
+def generate_corpus(directory, files, seconds=1.0):
+    """
+    Fills a directory with timestamped WAV files named like the real dataset.
+
+    Parameters:
+    directory (str): The directory to write the files to.
+    files (int): The number of files to write.
+    seconds (float): The length of each file.
+
+    Returns:
+    list: The filenames that were written.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    first_timestamp = datetime(2021, 9, 30)
+    filenames = []
+    for i in range(files):
+        filename = (first_timestamp + timedelta(seconds=i)).strftime('%m-%d-%Y %H-%M-%S.wav')
+        write_wav(os.path.join(directory, filename), seconds, marker=i)
+        filenames.append(filename)
+    return filenames
+
+def time_main(directory, workers, latency, transcripts=("12345678910",)):
+    """
+    Runs script.main over a directory with a stub recognizer and measures the wall-clock time.
+
+    Parameters:
+    directory (str): The directory containing the audio files.
+    workers (int): The number of workers to pass to script.main.
+    latency (float): The simulated recognizer latency in seconds.
+    transcripts (tuple): The transcripts for the stub recognizer to return.
+
+    Returns:
+    float: The number of seconds script.main took.
+    """
+
+    recognizer = StubRecognizer(transcripts, latency=latency)
+    original_audio_dir, original_output_file = script.audio_dir, script.output_file
+    script.audio_dir, script.output_file = directory, os.path.join(directory, "output.csv")
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            script.main(workers=workers, recognizer=recognizer)
+        return time.perf_counter() - start
+    finally:
+        script.audio_dir, script.output_file = original_audio_dir, original_output_file
+
+def benchmark_pipeline(args):
+    """
+    Compares sequential and concurrent runs of script.main on a synthetic corpus.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line arguments.
+    """
+
+    directory = tempfile.mkdtemp(prefix="audio-bench-")
+    try:
+        generate_corpus(directory, args.files)
+        sequential = time_main(directory, 1, args.latency)
+        concurrent = time_main(directory, args.workers, args.latency)
+    finally:
+        shutil.rmtree(directory)
+
+    print(f"workers=1: {sequential:.2f}s ({args.files / sequential:.1f} files/s)")
+    print(f"workers={args.workers}: {concurrent:.2f}s ({args.files / concurrent:.1f} files/s)")
+    print(f"speedup: {sequential / concurrent:.1f}x")
+
+def benchmark_engine(args):
+    """
+    Compares the thread pool and the async engine against a local fake recognizer that rate limits some requests.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line arguments.
+    """
+
+    responses = ["12345678910"] * 9 + [429]
+    directory = tempfile.mkdtemp(prefix="audio-bench-")
+    original_audio_dir, original_output_file = script.audio_dir, script.output_file
+    script.audio_dir, script.output_file = directory, os.path.join(directory, "output.csv")
+    try:
+        generate_corpus(directory, args.files)
+        engines = {'threads': None, 'async': script.AsyncEngine(args.workers, args.rate, args.retries, backoff_base=0.05)}
+        for name, engine in engines.items():
+            metrics = script.Metrics()
+            with FakeRecognitionServer(responses, args.latency) as server:
+                backend = script.GoogleBackend(endpoint=server.endpoint)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    script.main(workers=args.workers, backend=backend, metrics=metrics, engine=engine)
+                elapsed = time.perf_counter() - start
+            counters = metrics.snapshot()['counters']
+            print(f"{name}: {elapsed:.2f}s ({args.files / elapsed:.1f} files/s), "
+                  f"{counters['failed_files']} failed, {counters['retries']} retries, {server.requests} requests")
+    finally:
+        script.audio_dir, script.output_file = original_audio_dir, original_output_file
+        shutil.rmtree(directory)
+
+def benchmark_decode(args):
+    """
+    Compares decoding and voice activity detection on worker threads with decoding on worker processes.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line arguments.
+    """
+
+    directory = tempfile.mkdtemp(prefix="audio-bench-")
+    original_audio_dir, original_output_file = script.audio_dir, script.output_file
+    script.audio_dir, script.output_file = directory, os.path.join(directory, "output.csv")
+    try:
+        generate_corpus(directory, args.files, args.seconds)
+        vad = script.VoiceActivityDetector()
+        timings = {}
+        for processes in (0, args.workers):
+            with script.ProcessDecoder(processes) if processes else contextlib.nullcontext() as decoder:
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    script.main(workers=args.workers, recognizer=StubRecognizer(latency=0), vad=vad, decoder=decoder)
+                timings[processes] = time.perf_counter() - start
+    finally:
+        script.audio_dir, script.output_file = original_audio_dir, original_output_file
+        shutil.rmtree(directory)
+
+    threads, processes = timings[0], timings[args.workers]
+    print(f"{args.workers} threads: {threads:.2f}s ({args.files / threads:.1f} files/s)")
+    print(f"{args.workers} processes: {processes:.2f}s ({args.files / processes:.1f} files/s)")
+    print(f"speedup: {threads / processes:.1f}x on {os.cpu_count()} CPUs")
+
+def benchmark_upload(args):
+    """
+    Compares the bytes uploaded to a local fake recognizer with and without downsampling before upload.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line arguments.
+    """
+
+    directory = tempfile.mkdtemp(prefix="audio-bench-")
+    original_audio_dir, original_output_file = script.audio_dir, script.output_file
+    script.audio_dir, script.output_file = directory, os.path.join(directory, "output.csv")
+    try:
+        for index in range(args.files):
+            write_counting_wav(os.path.join(directory, f"09-30-2021 00-{index // 60:02d}-{index % 60:02d}.wav"), sample_rate=args.sample_rate)
+        preprocessors = {'original': None, f'{args.target_rate} Hz': script.AudioPreprocessor(args.target_rate)}
+        for name, preprocessor in preprocessors.items():
+            metrics = script.Metrics()
+            with FakeRecognitionServer() as server:
+                backend = script.GoogleBackend(endpoint=server.endpoint, preprocessor=preprocessor)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    script.main(workers=args.workers, backend=backend, metrics=metrics)
+                elapsed = time.perf_counter() - start
+            stages = metrics.snapshot()['stages']
+            preprocess = stages['preprocess']['total_seconds'] / args.files * 1000 if 'preprocess' in stages else 0
+            print(f"{name}: {server.bytes_received / args.files / 1024:.1f} KiB uploaded per file, "
+                  f"{preprocess:.2f}ms preprocessing per file, {elapsed:.2f}s total")
+    finally:
+        script.audio_dir, script.output_file = original_audio_dir, original_output_file
+        shutil.rmtree(directory)
+
+def benchmark_reader(args):
+    """
+    Compares reading WAV files with sr.AudioFile with reading them through a memory map with script.read_audio_file.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line arguments.
+    """
+
+    directory = tempfile.mkdtemp(prefix="audio-bench-")
+    try:
+        paths = [os.path.join(directory, filename) for filename in generate_corpus(directory, args.files, args.seconds)]
+        recognizer = sr.Recognizer()
+
+        def read_with_audio_file(path):
+            with sr.AudioFile(path) as source:
+                audio_data = recognizer.record(source)
+            return np.frombuffer(audio_data.frame_data, '<i2')
+
+        def read_with_memory_map(path):
+            return np.frombuffer(script.read_audio_file(path, recognizer).frame_data, '<i2')
+
+        memory_sample = min(args.files, 50)
+        for name, reader in (('sr.AudioFile', read_with_audio_file), ('memory map', read_with_memory_map)):
+            _, stage = measure_stage(reader, paths, memory_sample=memory_sample)
+            print(f"{name}: {stage['mean_ms']:.3f}ms per file, {stage['peak_allocated_bytes'] / memory_sample / 1024:.1f} KiB allocated per file")
+    finally:
+        shutil.rmtree(directory)
+
+def benchmark_output(args):
+    """
+    Compares loading a month of results from CSV and from Parquet and totalling the audible words per day.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line arguments.
+    """
+
+    import pyarrow.compute
+    import pyarrow.parquet
+
+    directory = tempfile.mkdtemp(prefix="output-bench-")
+    csv_file, parquet_file = os.path.join(directory, "output.csv"), os.path.join(directory, "output.parquet")
+    try:
+        start = datetime(2021, 9, 1)
+        step = timedelta(days=30) / args.rows
+        with script.CsvResultSink(csv_file, 'w', batch_size=10000) as csv_sink, script.ParquetResultSink(parquet_file) as parquet_sink:
+            for i, sequence in enumerate(random_sequences(args.rows)):
+                timestamp = start + step * i
+                longest, out_of_order = script.find_longest_consecutive_count_and_order(sequence)
+                result = script.AudioResult(timestamp.strftime("%m-%d-%Y %H-%M-%S.wav"), timestamp.replace(microsecond=0).isoformat(), len(sequence), out_of_order, longest)
+                csv_sink.write(result)
+                parquet_sink.write(result)
+
+        started = time.perf_counter()
+        csv_totals = {}
+        with open(csv_file, 'r', newline='') as csvfile:
+            for row in csv.DictReader(csvfile):
+                day = datetime.fromisoformat(row['Timestamp']).date()
+                csv_totals[day] = csv_totals.get(day, 0) + int(row['Count of Audible Words'])
+        csv_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        table = pyarrow.parquet.read_table(parquet_file, columns=['Timestamp', 'Count of Audible Words'])
+        table = table.append_column('Day', pyarrow.compute.floor_temporal(table.column('Timestamp'), unit='day'))
+        parquet_totals = table.group_by('Day').aggregate([('Count of Audible Words', 'sum')])
+        parquet_seconds = time.perf_counter() - started
+
+        csv_size, parquet_size = os.path.getsize(csv_file), os.path.getsize(parquet_file)
+    finally:
+        shutil.rmtree(directory)
+
+    assert len(csv_totals) == parquet_totals.num_rows
+    print(f"csv: {csv_seconds:.3f}s for {args.rows} rows ({csv_size / 1e6:.1f} MB)")
+    print(f"parquet: {parquet_seconds:.3f}s for {args.rows} rows ({parquet_size / 1e6:.1f} MB)")
+    print(f"speedup: {csv_seconds / parquet_seconds:.1f}x")
+
+def random_sequences(count, seed=0):
+    """
+    Generates sequences like those heard in the recordings: the numbers 1 to 10 with some dropped or swapped.
+
+    Parameters:
+    count (int): The number of sequences to generate.
+    seed (int): The seed for the random number generator.
+
+    Returns:
+    list: The generated lists of integers.
+    """
+
+    rng = random.Random(seed)
+    sequences = []
+    for _ in range(count):
+        sequence = [number for number in range(1, 11) if rng.random() > 0.1]
+        if len(sequence) > 1 and rng.random() < 0.3:
+            i = rng.randrange(len(sequence) - 1)
+            sequence[i], sequence[i + 1] = sequence[i + 1], sequence[i]
+        sequences.append(sequence)
+    return sequences
+
+def benchmark_analysis(args):
+    """
+    Compares find_longest_consecutive_count_and_order called once per sequence with the batch version.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line arguments.
+    """
+
+    sequences = random_sequences(args.sequences)
+
+    start = time.perf_counter()
+    scalar = [script.find_longest_consecutive_count_and_order(sequence) for sequence in sequences if sequence]
+    scalar_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    values, offsets = script.pack_sequences(sequences)
+    pack_time = time.perf_counter() - start
+    start = time.perf_counter()
+    counts, longest, out_of_order = script.find_longest_consecutive_count_and_order_batch(values, offsets)
+    batch_time = time.perf_counter() - start
+
+    non_empty = counts > 0
+    if scalar != list(zip(longest[non_empty].tolist(), out_of_order[non_empty].tolist())):
+        raise AssertionError("The batch results do not match the scalar results")
+
+    print(f"scalar: {scalar_time:.3f}s ({args.sequences / scalar_time:,.0f} sequences/s)")
+    print(f"batch: {batch_time:.3f}s ({args.sequences / batch_time:,.0f} sequences/s), plus {pack_time:.3f}s to pack the sequences")
+    print(f"speedup: {scalar_time / batch_time:.1f}x")
+
+def legacy_get_audio_in_array_format_int(text):
+    """
+    The original implementation of script.get_audio_in_array_format_int, kept as the baseline for benchmark_parser.
+    """
+
+    if not isinstance(text, str):
+        raise ValueError("Input must be a string.")
+    if not text.isdigit():
+        raise ValueError("Input string must only contain digits.")
+    text_with_spaces = ' '.join(text)
+    if '1 0' in text_with_spaces:
+        text_with_spaces = text_with_spaces.replace('1 0', '10')
+    text_array = text_with_spaces.split()
+    return [int(word) for word in text_array]
+
+def benchmark_parser(args):
+    """
+    Compares the original transcript parser with script.parse_transcript.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line arguments.
+    """
+
+    transcripts = [''.join(map(str, sequence)) for sequence in random_sequences(args.transcripts) if sequence]
+
+    # Like timeit, keep the garbage collector from charging one run for the objects left by the other
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        legacy = [legacy_get_audio_in_array_format_int(text) for text in transcripts]
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        parsed = [script.parse_transcript(text) for text in transcripts]
+        parse_time = time.perf_counter() - start
+    finally:
+        gc.enable()
+
+    if parsed != legacy:
+        raise AssertionError("parse_transcript does not match the original parser")
+
+    print(f"original: {legacy_time:.3f}s ({len(transcripts) / legacy_time:,.0f} transcripts/s)")
+    print(f"parse_transcript: {parse_time:.3f}s ({len(transcripts) / parse_time:,.0f} transcripts/s)")
+    print(f"speedup: {legacy_time / parse_time:.1f}x")
+
+def legacy_get_timestamp(filename):
+    """
+    The original implementation of script.get_timestamp, kept as the baseline for benchmark_timestamp.
+    """
+
+    if not re.match(r'\d{2}-\d{2}-\d{4} \d{2}-\d{2}-\d{2}\.wav', filename):
+        return None
+    try:
+        date_str = filename.split('.')[0]
+        date_time_obj = datetime.strptime(date_str, '%m-%d-%Y %H-%M-%S')
+        return date_time_obj.isoformat()
+    except ValueError:
+        return None
+
+def benchmark_timestamp(args):
+    """
+    Compares the original timestamp extraction with script.get_timestamp and script.get_timestamps on a month of
+    filenames, a few of them invalid.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line arguments.
+    """
+
+    start = datetime(2021, 9, 1)
+    step = timedelta(days=30) / args.filenames
+    filenames = [(start + step * i).strftime('%m-%d-%Y %H-%M-%S.wav') for i in range(args.filenames)]
+    unusual = ["13-45-2021 00-00-00.wav", "notes.wav", "02-29-2021 00-00-00.wav", "02-29-2024 00-00-00.wav.bak"]
+    for i in range(0, len(filenames), 1000):
+        filenames[i] = unusual[i // 1000 % len(unusual)]
+
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        legacy = [legacy_get_timestamp(filename) for filename in filenames]
+        legacy_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            single = [script.get_timestamp(filename) for filename in filenames]
+        single_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        bulk = script.get_timestamps(filenames)
+        bulk_time = time.perf_counter() - started
+    finally:
+        gc.enable()
+
+    if single != legacy or bulk != legacy:
+        raise AssertionError("get_timestamp does not match the original implementation")
+
+    print(f"original: {legacy_time:.3f}s ({len(filenames) / legacy_time:,.0f} filenames/s)")
+    print(f"get_timestamp: {single_time:.3f}s ({len(filenames) / single_time:,.0f} filenames/s)")
+    print(f"get_timestamps: {bulk_time:.3f}s ({len(filenames) / bulk_time:,.0f} filenames/s)")
+    print(f"speedup: {legacy_time / single_time:.1f}x single, {legacy_time / bulk_time:.1f}x bulk")
+
+def parse_importtime(stderr):
+    """
+    Parses the output of python -X importtime.
+
+    Parameters:
+    stderr (str): The standard error of the interpreter.
+
+    Returns:
+    list: The (module, self microseconds, cumulative microseconds, depth) of each import, in the order they finished.
+    """
+
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((name.strip(), int(self_us), int(cumulative_us), (len(name) - len(name.lstrip())) // 2))
+    return imports
+
+def benchmark_startup(args):
+    """
+    Measures how long a fresh interpreter takes to import script.py, compared with an empty interpreter, and lists
+    the imports that take longest.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line arguments.
+    """
+
+    directory = os.path.dirname(os.path.abspath(script.__file__))
+
+    def best_of(code):
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=directory, check=True)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    empty = best_of("pass")
+    imported = best_of("import script")
+    imports = parse_importtime(subprocess.run([sys.executable, "-X", "importtime", "-c", "import script"], cwd=directory, check=True, capture_output=True, text=True).stderr)
+    # An import is listed after the imports it made, so those made by script are the ones since the previous top-level import
+    script_index = next(index for index, entry in enumerate(imports) if entry[0] == "script" and entry[3] == 0)
+    first_index = max([index + 1 for index, entry in enumerate(imports[:script_index]) if entry[3] == 0], default=0)
+    made_by_script = [entry for entry in imports[first_index:script_index] if entry[3] == 1]
+    script_us = imports[script_index][2]
+
+    print(f"empty interpreter: {empty * 1000:.1f}ms")
+    print(f"import script: {imported * 1000:.1f}ms ({(imported - empty) * 1000:.1f}ms over an empty interpreter, {script_us / 1000:.1f}ms measured by -X importtime)")
+    print("slowest imports made by script:")
+    for name, self_us, cumulative, depth in sorted(made_by_script, key=lambda entry: -entry[2])[:args.top]:
+        print(f"  {name}: {cumulative / 1000:.1f}ms")
+
+def summarise_latencies(latencies):
+    """
+    Summarises a list of latencies.
+
+    Parameters:
+    latencies (list): The latencies in seconds.
+
+    Returns:
+    dict: The mean, 50th, 90th and 99th percentile latencies in milliseconds.
+    """
+
+    milliseconds = np.asarray(latencies) * 1000
+    p50, p90, p99 = np.percentile(milliseconds, [50, 90, 99])
+    return {'mean_ms': float(milliseconds.mean()), 'p50_ms': float(p50), 'p90_ms': float(p90), 'p99_ms': float(p99)}
+
+def measure_stage(function, items, repeat=5, memory_sample=50):
+    """
+    Calls a function on each item, timing every call, then measures the peak Python memory it allocates.
+
+    Like timeit, the items are run through the stage repeat times and the fastest pass is kept, which filters out
+    most of the noise from other processes. The memory is measured in a separate pass over the first memory_sample
+    items, because tracing allocations slows every call down and would distort the timings.
+
+    Parameters:
+    function (callable): The stage to measure.
+    items (list): The inputs to the stage.
+    repeat (int): The number of timed passes.
+    memory_sample (int): The number of items to trace allocations for.
+
+    Returns:
+    tuple: The stage's outputs and a dict of its throughput, latency percentiles and peak allocation.
+    """
+
+    elapsed = None
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            pass_latencies = []
+            outputs = []
+            start = time.perf_counter()
+            for item in items:
+                call_start = time.perf_counter()
+                outputs.append(function(item))
+                pass_latencies.append(time.perf_counter() - call_start)
+            pass_elapsed = time.perf_counter() - start
+            if elapsed is None or pass_elapsed < elapsed:
+                elapsed, latencies = pass_elapsed, pass_latencies
+    finally:
+        gc.enable()
+
+    tracemalloc.start()
+    sample_outputs = [function(item) for item in items[:memory_sample]]
+    _, peak_allocated = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del sample_outputs
+
+    metrics = {'items_per_second': len(items) / elapsed}
+    metrics.update(summarise_latencies(latencies))
+    metrics['peak_allocated_bytes'] = peak_allocated
+    return outputs, metrics
+
+def peak_rss_bytes():
+    """
+    Returns the peak resident set size of this process so far.
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def current_rss_bytes():
+    """
+    Returns the resident set size of this process now, or the peak so far where /proc is not available.
+    """
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return peak_rss_bytes()
+
+def benchmark_backpressure(args):
+    """
+    Runs the staged engine over many files with recognition much slower than decoding, sampling the resident memory
+    as it goes to show that it stays flat however many files there are.
+
+    A small corpus is processed over and over, so a long run does not need the disk space of a real one.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line arguments.
+    """
+
+    directory = tempfile.mkdtemp(prefix="audio-bench-")
+    try:
+        corpus = generate_corpus(directory, min(args.files, 100), args.seconds)
+        filenames = [corpus[i % len(corpus)] for i in range(args.files)]
+        engine = script.StagedEngine(args.decoders, args.workers, args.queue_files, int(args.queue_mb * 1024 * 1024))
+        metrics = script.Metrics()
+        samples = []
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(0.05):
+                samples.append(current_rss_bytes())
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        start = time.perf_counter()
+        # Progress goes to the null device, as a StringIO would grow by a line per file
+        with script.CsvResultSink(os.path.join(directory, "output.csv"), 'w') as sink, open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+            engine.run(filenames, sink, len(filenames), StubRecognizer(latency=args.latency), directory=directory, metrics=metrics)
+        elapsed = time.perf_counter() - start
+        done.set()
+        sampler.join()
+    finally:
+        shutil.rmtree(directory)
+
+    print(f"{args.files} files in {elapsed:.2f}s ({args.files / elapsed:.1f} files/s)")
+    tenth = max(1, len(samples) // 10)
+    print("RSS by tenth of the run: " + ", ".join(f"{max(samples[i:i + tenth]) / 1024 / 1024:.1f}" for i in range(0, len(samples), tenth)) + " MiB")
+    stats = engine.stats()
+    for name, queue in stats['queues'].items():
+        print(f"{name} queue: peak {queue['peak_items']} files, {queue['peak_bytes'] / 1024 / 1024:.2f} MiB, "
+              f"{queue['full_seconds']:.2f}s waiting for room, {queue['empty_seconds']:.2f}s waiting for files")
+    print(f"reorder window: {stats['reorder_seconds']:.2f}s waiting for the writer")
+
+def git_commit():
+    """
+    Returns the commit the working tree is on, or None outside a git repository.
+    """
+
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(files, seconds, workers, latency):
+    """
+    Measures each stage of the pipeline and the full script.main flow on a synthetic corpus.
+
+    Parameters:
+    files (int): The number of synthetic WAV files.
+    seconds (float): The length of each file.
+    workers (int): The number of workers for the full run.
+    latency (float): The simulated recognizer latency in seconds.
+
+    Returns:
+    dict: The results, ready to be saved as JSON.
+    """
+
+    transcripts = [''.join(map(str, sequence)) for sequence in random_sequences(files) if sequence]
+    directory = tempfile.mkdtemp(prefix="audio-bench-")
+    try:
+        filenames = generate_corpus(directory, files, seconds)
+        paths = [os.path.join(directory, filename) for filename in filenames]
+        recognizer = StubRecognizer(transcripts, latency=latency)
+        stages = {}
+
+        audio, stages['decode'] = measure_stage(lambda path: script.read_audio_file(path, recognizer), paths)
+        texts, stages['recognize'] = measure_stage(recognizer.recognize_google, audio, repeat=1)
+        del audio
+        sequences, stages['parse'] = measure_stage(script.parse_transcript, texts)
+        results, stages['analyse'] = measure_stage(script.find_longest_consecutive_count_and_order, sequences)
+        timestamps, stages['timestamp'] = measure_stage(script.get_timestamp, filenames)
+
+        rows = [script.AudioResult(filename, timestamp or "None", len(sequence), out_of_order, longest) for filename, timestamp, sequence, (longest, out_of_order) in zip(filenames, timestamps, sequences, results)]
+        with script.CsvResultSink(os.path.join(directory, "stage-output.csv"), 'w') as sink:
+            _, stages['write'] = measure_stage(sink.write, rows)
+
+        main_seconds = time_main(directory, workers, latency, transcripts)
+    finally:
+        shutil.rmtree(directory)
+
+    return {
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'parameters': {'files': files, 'seconds': seconds, 'workers': workers, 'latency': latency},
+        'main': {'seconds': main_seconds, 'files_per_second': files / main_seconds},
+        'stages': stages,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+def flatten_metrics(results):
+    """
+    Flattens the numeric metrics of a suite run into a dict keyed by dotted names such as 'stages.parse.p50_ms'.
+    """
+
+    metrics = {f"main.{name}": value for name, value in results['main'].items()}
+    for stage, stage_metrics in results['stages'].items():
+        metrics.update((f"stages.{stage}.{name}", value) for name, value in stage_metrics.items())
+    metrics['peak_rss_bytes'] = results['peak_rss_bytes']
+    return metrics
+
+def compare_results(baseline, results, threshold):
+    """
+    Prints how each metric changed from a baseline and returns the metrics that got worse by more than threshold.
+
+    Throughput metrics are better when higher, and latency and memory metrics are better when lower. Only
+    throughput, median latency and peak RSS count as regressions, since the tail latencies of stages that take
+    microseconds are too noisy to gate on.
+
+    Parameters:
+    baseline (dict): The results of an earlier run.
+    results (dict): The results of this run.
+    threshold (float): The relative change, e.g. 0.1 for 10%, beyond which a metric counts as a regression.
+
+    Returns:
+    list: The names of the regressed metrics.
+    """
+
+    regressions = []
+    baseline_metrics = flatten_metrics(baseline)
+    for name, value in flatten_metrics(results).items():
+        old_value = baseline_metrics.get(name)
+        if not old_value:
+            continue
+        change = (value - old_value) / old_value
+        higher_is_better = name.endswith('per_second')
+        gated = higher_is_better or name.endswith('p50_ms') or name == 'peak_rss_bytes'
+        regressed = gated and (-change > threshold if higher_is_better else change > threshold)
+        if regressed:
+            regressions.append(name)
+        print(f"{name}: {old_value:,.3f} -> {value:,.3f} ({change:+.1%}){' REGRESSION' if regressed else ''}")
+    return regressions
+
+def benchmark_suite(args):
+    """
+    Runs the full benchmark suite, optionally saving the results as a baseline or comparing them with one.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line arguments.
+
+    Returns:
+    int: 1 if any metric regressed past the threshold compared with the baseline, otherwise 0.
+    """
+
+    results = run_suite(args.files, args.seconds, args.workers, args.latency)
+
+    print(f"main: {results['main']['files_per_second']:.1f} files/s with {args.workers} workers")
+    for stage, metrics in results['stages'].items():
+        print(f"{stage}: {metrics['items_per_second']:,.0f}/s, p50 {metrics['p50_ms']:.3f}ms, p90 {metrics['p90_ms']:.3f}ms, p99 {metrics['p99_ms']:.3f}ms, peak {metrics['peak_allocated_bytes'] / 1024:,.0f} KiB")
+    print(f"peak RSS: {results['peak_rss_bytes'] / 1024 / 1024:.1f} MiB")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {args.save}")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.compare} (commit {baseline.get('commit')}):")
+        if compare_results(baseline, results, args.threshold):
+            return 1
+    return 0
+
+def main():
+    """
+    Runs the benchmark selected on the command line.
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark script.py without the network.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    pipeline = subparsers.add_parser('pipeline', help='Run script.main against a local stub recognizer')
+    pipeline.add_argument('--files', type=int, default=100, help='Number of synthetic WAV files (default: 100)')
+    pipeline.add_argument('--workers', type=int, default=8, help='Number of workers for the concurrent run (default: 8)')
+    pipeline.add_argument('--latency', type=float, default=0.05, help='Simulated recognizer latency in seconds (default: 0.05)')
+    pipeline.set_defaults(run=benchmark_pipeline)
+
+    engine = subparsers.add_parser('engine', help='Compare the thread pool and the async engine against a local fake recognizer')
+    engine.add_argument('--files', type=int, default=100, help='Number of synthetic WAV files (default: 100)')
+    engine.add_argument('--workers', type=int, default=8, help='Number of requests in flight (default: 8)')
+    engine.add_argument('--latency', type=float, default=0.05, help='Fake recognizer latency in seconds (default: 0.05)')
+    engine.add_argument('--rate', type=float, help='Rate limit of the async engine in requests per second (default: none)')
+    engine.add_argument('--retries', type=int, default=3, help='Retries of the async engine (default: 3)')
+    engine.set_defaults(run=benchmark_engine)
+
+    decode = subparsers.add_parser('decode', help='Compare decoding on worker threads and on worker processes')
+    decode.add_argument('--files', type=int, default=200, help='Number of synthetic WAV files (default: 200)')
+    decode.add_argument('--seconds', type=float, default=5.0, help='Length of each synthetic WAV file in seconds (default: 5)')
+    decode.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker threads and processes (default: the number of CPUs)')
+    decode.set_defaults(run=benchmark_decode)
+
+    reader = subparsers.add_parser('reader', help='Compare reading WAV files with sr.AudioFile and through a memory map')
+    reader.add_argument('--files', type=int, default=200, help='Number of synthetic WAV files (default: 200)')
+    reader.add_argument('--seconds', type=float, default=5.0, help='Length of each synthetic WAV file in seconds (default: 5)')
+    reader.set_defaults(run=benchmark_reader)
+
+    upload = subparsers.add_parser('upload', help='Compare the bytes uploaded with and without downsampling before upload')
+    upload.add_argument('--files', type=int, default=20, help='Number of synthetic WAV files (default: 20)')
+    upload.add_argument('--sample-rate', type=int, default=44100, help='Sample rate of the synthetic WAV files in Hz (default: 44100)')
+    upload.add_argument('--target-rate', type=int, default=16000, help='Sample rate to downsample to in Hz (default: 16000)')
+    upload.add_argument('--workers', type=int, default=4, help='Number of workers (default: 4)')
+    upload.set_defaults(run=benchmark_upload)
+
+    backpressure = subparsers.add_parser('backpressure', help='Sample the memory of the staged engine over a long run with slow recognition')
+    backpressure.add_argument('--files', type=int, default=20000, help='Number of files to process, cycling through a corpus of at most 100 (default: 20000)')
+    backpressure.add_argument('--seconds', type=float, default=5.0, help='Length of each synthetic WAV file in seconds (default: 5)')
+    backpressure.add_argument('--workers', type=int, default=8, help='Number of recognizer threads (default: 8)')
+    backpressure.add_argument('--decoders', type=int, default=2, help='Number of decoder threads (default: 2)')
+    backpressure.add_argument('--queue-files', type=int, default=16, help='Maximum number of files waiting between two stages (default: 16)')
+    backpressure.add_argument('--queue-mb', type=float, default=8, help='Maximum size of the decoded audio waiting to be recognised (default: 8)')
+    backpressure.add_argument('--latency', type=float, default=0.005, help='Simulated recognizer latency in seconds (default: 0.005)')
+    backpressure.set_defaults(run=benchmark_backpressure)
+
+    output = subparsers.add_parser('output', help='Compare aggregating a month of results from CSV and from Parquet (needs pyarrow)')
+    output.add_argument('--rows', type=int, default=1000000, help='Number of result rows (default: 1000000)')
+    output.set_defaults(run=benchmark_output)
+
+    analysis = subparsers.add_parser('analysis', help='Compare the scalar and batch sequence analysis')
+    analysis.add_argument('--sequences', type=int, default=1000000, help='Number of sequences to analyse (default: 1000000)')
+    analysis.set_defaults(run=benchmark_analysis)
+
+    transcript_parser = subparsers.add_parser('parser', help='Compare the original and the new transcript parser')
+    transcript_parser.add_argument('--transcripts', type=int, default=200000, help='Number of transcripts to parse (default: 200000)')
+    transcript_parser.set_defaults(run=benchmark_parser)
+
+    timestamp = subparsers.add_parser('timestamp', help='Compare the original and the new timestamp extraction')
+    timestamp.add_argument('--filenames', type=int, default=500000, help='Number of filenames to parse (default: 500000)')
+    timestamp.set_defaults(run=benchmark_timestamp)
+
+    startup = subparsers.add_parser('startup', help='Measure how long a fresh interpreter takes to import script.py')
+    startup.add_argument('--runs', type=int, default=10, help='Number of interpreters to start for each timing (default: 10)')
+    startup.add_argument('--top', type=int, default=10, help='Number of the slowest imports to list (default: 10)')
+    startup.set_defaults(run=benchmark_startup)
+
+    suite = subparsers.add_parser('suite', help='Measure every stage and the full run, and save or compare JSON baselines')
+    suite.add_argument('--files', type=int, default=200, help='Number of synthetic WAV files (default: 200)')
+    suite.add_argument('--seconds', type=float, default=5.0, help='Length of each synthetic WAV file in seconds (default: 5)')
+    suite.add_argument('--workers', type=int, default=8, help='Number of workers for the full run (default: 8)')
+    suite.add_argument('--latency', type=float, default=0.01, help='Simulated recognizer latency in seconds (default: 0.01)')
+    suite.add_argument('--save', help='Save the results to this JSON file')
+    suite.add_argument('--compare', help='Compare the results with this JSON file')
+    suite.add_argument('--threshold', type=float, default=0.1, help='Relative change that counts as a regression when comparing (default: 0.1)')
+    suite.set_defaults(run=benchmark_suite)
+
+    args = parser.parse_args()
+    sys.exit(args.run(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,44 @@
 import argparse
-import os
-import subprocess
+import sys
+import unittest
 
-def main():
-    parser = argparse.ArgumentParser(description='Run script and/or tests.')
-    parser.add_argument('commands', nargs='*', help='Commands to run')
+valid_commands = ['script', 'test']
+
+def split_args(argv):
+    # The commands come first. Everything after them, or after '--', is passed through to script.py (e.g. --workers 8)
+    if '--' in argv:
+        separator = argv.index('--')
+        return argv[:separator], argv[separator + 1:]
+    count = 0
+    while count < len(argv) and argv[count] in valid_commands:
+        count += 1
+    return argv[:count], argv[count:]
 
-    args = parser.parse_args()
+def main(argv=None):
+    command_args, script_args = split_args(sys.argv[1:] if argv is None else argv)
 
-    valid_commands = ['script', 'test']
+    parser = argparse.ArgumentParser(description='Run script and/or tests.', usage='%(prog)s {script,test} ... [-- script options]')
+    parser.add_argument('commands', nargs='*', help='Commands to run')
+    args = parser.parse_args(command_args)
 
     if not args.commands or not all(command in valid_commands for command in args.commands):
         print("Please specify 'script' and/or 'test' as arguments to run the corresponding parts.")
-        return
+        return 2
 
+    # Both run in this interpreter, so the imports are only paid for once
     if 'test' in args.commands:
         print("Running test.py...")
-        subprocess.run(["python3", "-m", "unittest", "test.py"])
+        result = unittest.main(module='test', argv=['test.py'], exit=False).result
+        if not result.wasSuccessful():
+            if 'script' in args.commands:
+                print("Tests failed, not running script.py.")
+            return 1
 
     if 'script' in args.commands:
         print("Running script.py...")
-        subprocess.run(["python3", "script.py"])
+        import script
+        script.run(script_args)
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -1,11 +1,56 @@
 import os
 import csv
 import re
-import speech_recognition as sr
+import contextlib
+import copy
+import functools
+import hashlib
+import importlib
+import io
+import itertools
+import json
+import math
+import mmap
+import random
+import sqlite3
+import struct
+import argparse
+import threading
+import time
+from collections import deque, namedtuple
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.error import HTTPError, URLError
 
-# Initialize recognizer
-r = sr.Recognizer()
+class _LazyModule:
+    """
+    A stand-in for a module that is only imported when one of its attributes is first used.
+
+    Unlike importlib.util.LazyLoader, the import is guarded by a lock, so worker threads can trigger it safely.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'>"
+
+# The heavier dependencies are imported on first use, so that starting the script for a single file, or only
+# importing it, does not pay for backends and engines that are never used
+np = _LazyModule('numpy')
+sr = _LazyModule('speech_recognition')
+asyncio = _LazyModule('asyncio')
+shared_memory = _LazyModule('multiprocessing.shared_memory')
+resource_tracker = _LazyModule('multiprocessing.resource_tracker')
 
 # Directory containing the audio files
 audio_dir = "audio"
@@ -13,9 +58,30 @@ audio_dir = "audio"
 # Output CSV file
 output_file = "output.csv"
 
+# On-disk cache of raw transcripts, keyed by the audio content
+cache_file = ".transcript_cache.sqlite"
+
+# On-disk index of the size, modification time and content hash of each audio file
+manifest_file = ".audio_manifest.sqlite"
+
+# Directory containing the Vosk model used by the offline backend
+vosk_model_dir = "model"
+
+# Directory containing the labelled clips used by the template matching backend
+templates_dir = "templates"
+
+# The words spoken in the recordings, mapped to the digits the analysis expects
+number_words = {'one': '1', 'two': '2', 'three': '3', 'four': '4', 'five': '5', 'six': '6', 'seven': '7', 'eight': '8', 'nine': '9', 'ten': '10'}
+
+# Per-thread copies of the shared recognizer used by the worker pool
+_thread_local = threading.local()
+
+# Guards the creation of the shared recognizer
+_recognizer_lock = threading.Lock()
+
 def get_total_files(audio_dir):
     """
-    Counts the total number of .wav files in a given directory.
+    Counts the total number of .wav files in a given directory and its subdirectories.
 
     Parameters:
     audio_dir (str): The directory to search for .wav files.
@@ -23,7 +89,94 @@ def get_total_files(audio_dir):
     Returns:
     int: The total number of .wav files in the directory.
     """
-    return len([name for name in os.listdir(audio_dir) if name.endswith(".wav")])
+    return sum(1 for _ in iter_audio_files(audio_dir))
+
+def iter_audio_files(directory):
+    """
+    Walks a directory and its subdirectories with os.scandir, yielding each .wav file as soon as it is found.
+
+    Only one directory listing is held in memory at a time, and the size and modification time come from the
+    directory entries, so no file is opened.
+
+    Parameters:
+    directory (str): The directory to search for .wav files.
+
+    Yields:
+    tuple: The path of the file relative to directory, its size in bytes and its modification time in nanoseconds.
+    """
+
+    pending = ['']
+    while pending:
+        relative_dir = pending.pop()
+        with os.scandir(os.path.join(directory, relative_dir)) as entries:
+            for entry in entries:
+                relative_path = os.path.join(relative_dir, entry.name)
+                if entry.is_dir():
+                    pending.append(relative_path)
+                elif entry.name.endswith(".wav") and entry.is_file():
+                    stat = entry.stat()
+                    yield relative_path, stat.st_size, stat.st_mtime_ns
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    Hashes the contents of a file, reading it a chunk at a time.
+
+    Parameters:
+    path (str): The path of the file.
+    chunk_size (int): The number of bytes to read at a time.
+
+    Returns:
+    str: The SHA-256 hex digest of the file's contents.
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# The value of every token a transcript can contain
+_token_values = {str(digit): digit for digit in range(10)}
+_token_values['10'] = 10
+_token_values.update((word, int(digits)) for word, digits in number_words.items())
+
+# The value of each character of a digit run once every "10" has been replaced by ":"
+_digit_values = {str(digit): digit for digit in range(10)}
+_digit_values[':'] = 10
+
+# Splits a transcript into tokens in a single pass. "10" is matched before single digits so that digit runs like
+# "12345678910" end in ten, and any character that is not a separator becomes a token so that it can be rejected.
+_transcript_token = re.compile(r'10|\d|[a-z]+|[^\s,.]')
+
+def parse_transcript(text):
+    """
+    Converts a transcript into an array of integers.
+
+    Accepts digit runs ('12345678910'), spaced digits ('1 2 3 10') and number words ('one two three ten'), in any
+    mix and case. Commas and full stops between numbers are ignored.
+
+    Parameters:
+    text (str): The transcript to convert.
+
+    Returns:
+    list: The converted array of integers.
+
+    Raises:
+    ValueError: If the input is not a string, contains anything other than numbers, or contains no numbers.
+    """
+
+    if not isinstance(text, str):
+        raise ValueError("Input must be a string.")
+    if text.isascii() and text.isdigit():
+        # Fast path for Google's usual output: a table lookup per character, with each "10" as one character
+        return list(map(_digit_values.__getitem__, text.replace('10', ':')))
+    try:
+        text_array_int = [_token_values[token] for token in _transcript_token.findall(text.lower())]
+    except KeyError as e:
+        raise ValueError(f"Input string must only contain numbers, found {e.args[0]!r}.")
+    if not text_array_int:
+        raise ValueError("Input string must contain at least one number.")
+    return text_array_int
 
 def get_audio_in_array_format_int(text):
     """
@@ -43,20 +196,68 @@ def get_audio_in_array_format_int(text):
         raise ValueError("Input must be a string.")
     if not text.isdigit():
         raise ValueError("Input string must only contain digits.")
-    text_with_spaces = ' '.join(text)
-    if '1 0' in text_with_spaces:
-        text_with_spaces = text_with_spaces.replace('1 0', '10')
-    text_array = text_with_spaces.split()
+    return parse_transcript(text)
+
+# The filename layouts get_timestamp understands, tried in order, as (compiled pattern, group numbers of the
+# year, month, day, hour, minute and second) pairs
+timestamp_layouts = []
+
+_timestamp_fields = ('year', 'month', 'day', 'hour', 'minute', 'second')
+
+def register_timestamp_layout(pattern):
+    """
+    Adds a filename layout for get_timestamp to try after the ones already registered.
+
+    Parameters:
+    pattern (str): A regular expression matched at the start of the filename, with named groups year (4 digits),
+    and month, day, hour, minute and second (2 digits each).
+
+    Returns:
+    re.Pattern: The compiled pattern.
+
+    Raises:
+    ValueError: If the pattern is missing one of the named groups.
+    """
+
+    compiled = re.compile(pattern)
+    missing = [field for field in _timestamp_fields if field not in compiled.groupindex]
+    if missing:
+        raise ValueError(f"Timestamp layout is missing the groups: {', '.join(missing)}")
+    timestamp_layouts.append((compiled, tuple(compiled.groupindex[field] for field in _timestamp_fields)))
+    return compiled
+
+register_timestamp_layout(r'(?P<month>\d{2})-(?P<day>\d{2})-(?P<year>\d{4}) (?P<hour>\d{2})-(?P<minute>\d{2})-(?P<second>\d{2})\.wav')
+register_timestamp_layout(r'(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})[ T](?P<hour>\d{2})-(?P<minute>\d{2})-(?P<second>\d{2})\.wav')
+register_timestamp_layout(r'(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})_(?P<hour>\d{2})(?P<minute>\d{2})(?P<second>\d{2})\.wav')
+
+@functools.lru_cache(maxsize=4096)
+def _is_valid_date(year, month, day):
+    # Recordings are grouped by day, so the same few dates are checked over and over
     try:
-        text_array_int = [int(word) for word in text_array]
+        datetime(int(year), int(month), int(day))
     except ValueError:
-        raise ValueError("Input string must be in formats like '1234678910'.")
-    return text_array_int
+        return False
+    return True
+
+def _match_timestamp(filename):
+    # Returns the ISO 8601 timestamp, None if no layout matches, or False if a layout matches but the date or time
+    # does not exist. Every field is zero-padded, so the time can be checked by comparing the digits as strings.
+    for pattern, groups in timestamp_layouts:
+        match = pattern.match(filename)
+        if match is not None:
+            year, month, day, hour, minute, second = match.group(*groups)
+            if hour < '24' and minute < '60' and second < '60' and _is_valid_date(year, month, day):
+                return f"{year}-{month}-{day}T{hour}:{minute}:{second}"
+            return False
+    return None
 
 def get_timestamp(filename):
     """
     Extracts the timestamp from a filename.
 
+    The layouts in timestamp_layouts are tried in order: 'mm-dd-yyyy hh-mm-ss.wav', then 'yyyy-mm-dd hh-mm-ss.wav'
+    and 'yyyymmdd_hhmmss.wav', then any added with register_timestamp_layout.
+
     Paramete
     filename (str): The filename to extract the timestamp from.
 
@@ -67,15 +268,67 @@ def get_timestamp(filename):
     ValueError: If the filename is not in the expected format.
     """
 
-    if not re.match(r'\d{2}-\d{2}-\d{4} \d{2}-\d{2}-\d{2}\.wav', filename):
-        return None
-    try:
-        date_str = filename.split('.')[0]
-        date_time_obj = datetime.strptime(date_str, '%m-%d-%Y %H-%M-%S')
-        return date_time_obj.isoformat()
-    except ValueError:
-        print(f"Invalid filename format for {filename}. Expected format: 'mm-dd-yyyy hh-mm-ss.wav'")
+    timestamp = _match_timestamp(filename)
+    if timestamp is False:
+        # A layout matched, so the message is about the date or time rather than any one layout
+        print(f"Invalid timestamp in filename {filename}: the date or time does not exist.")
         return None
+    return timestamp
+
+# The layout of the recordings' filenames, 'mm-dd-yyyy hh-mm-ss.wav', as used by get_timestamps to read the fields
+# of every filename at once: the positions of the digits, the characters between them, and the order in which the
+# characters form an ISO 8601 timestamp
+_default_layout = b"00-00-0000 00-00-00.wav"
+_default_layout_digits = [0, 1, 3, 4, 6, 7, 8, 9, 11, 12, 14, 15, 17, 18]
+_default_layout_separators = [2, 5, 10, 13, 16, 19, 20, 21, 22]
+_default_layout_iso = [6, 7, 8, 9, 2, 0, 1, 5, 3, 4, 10, 11, 12, 13, 14, 15, 16, 17, 18]
+_days_in_month = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+def get_timestamps(filenames):
+    """
+    Extracts the timestamps from a whole directory listing at once, e.g. when indexing an archive.
+
+    Filenames in the default 'mm-dd-yyyy hh-mm-ss.wav' layout are checked and converted together with NumPy; any
+    others are passed through the registered layouts one at a time. Unlike get_timestamp, filenames in
+    subdirectories are accepted and no message is printed for invalid dates.
+
+    Parameters:
+    filenames (list): The filenames or relative paths to extract the timestamps from.
+
+    Returns:
+    list: The timestamp of each file in ISO 8601 format, or None where it has none, in the order of filenames.
+    """
+
+    names = [filename.rpartition(os.sep)[2] for filename in filenames] if any(os.sep in filename for filename in filenames) else list(filenames)
+    timestamps = [None] * len(names)
+    fixed = np.flatnonzero(np.fromiter(map(len, names), np.int64, len(names)) == len(_default_layout))
+    joined = ''.join([names[i] for i in fixed.tolist()])
+    others = np.ones(len(names), bool)
+
+    if joined.isascii() and len(fixed):
+        chars = np.frombuffer(joined.encode(), np.uint8).reshape(-1, len(_default_layout))
+        digits = chars[:, _default_layout_digits].astype(np.int64) - ord('0')
+        layout = np.frombuffer(_default_layout, np.uint8)
+        shaped = np.all((digits >= 0) & (digits <= 9), axis=1) & np.all(chars[:, _default_layout_separators] == layout[_default_layout_separators], axis=1)
+        month, day = digits[:, 0] * 10 + digits[:, 1], digits[:, 2] * 10 + digits[:, 3]
+        year = digits[:, 4] * 1000 + digits[:, 5] * 100 + digits[:, 6] * 10 + digits[:, 7]
+        hour, minute, second = digits[:, 8] * 10 + digits[:, 9], digits[:, 10] * 10 + digits[:, 11], digits[:, 12] * 10 + digits[:, 13]
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        month_days = np.array(_days_in_month)[np.clip(month, 0, 12)] + ((month == 2) & leap)
+        valid = shaped & (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= month_days) & (hour < 24) & (minute < 60) & (second < 60)
+
+        iso = np.ascontiguousarray(chars[valid][:, _default_layout_iso])
+        iso[:, [4, 7]] = ord('-')
+        iso[:, 10] = ord('T')
+        iso[:, [13, 16]] = ord(':')
+        for index, timestamp in zip(fixed[valid].tolist(), iso.view(f'S{iso.shape[1]}').ravel().astype(str).tolist()):
+            timestamps[index] = timestamp
+        # A filename in the default layout with an impossible date has no timestamp, as in get_timestamp
+        others[fixed[shaped]] = False
+
+    for index in np.flatnonzero(others).tolist():
+        timestamps[index] = _match_timestamp(names[index]) or None
+    return timestamps
 
 def find_longest_consecutive_count_and_order(text_array_int):
     """
@@ -115,85 +368,3797 @@ def find_longest_consecutive_count_and_order(text_array_int):
     longest_consecutive_count = max(longest_consecutive_count, current_consecutive_count)
     return longest_consecutive_count, words_out_of_order
 
-def write_row_to_csv(writer, filename, timestamp_iso8601, count_of_audible_words, words_out_of_order, longest_consecutive_count):
+def pack_sequences(sequences):
     """
-    Writes a row to a CSV file.
+    Packs integer sequences of different lengths into one flat array and an array of offsets.
 
     Parameters:
-    writer (csv.DictWriter): The writer object to use for writing to the CSV file.
-    filename (str): The filename of the audio file.
-    timestamp_iso8601 (str): The timestamp of the audio file in ISO 8601 format.
-    count_of_audible_words (int): The count of audible words in the audio file.
-    words_out_of_order (bool): A boolean indicating if the words in the audio file are out of order.
-    longest_consecutive_count (int): The longest consecutive count of words in the audio file.
+    sequences (iterable): The integer sequences to pack.
 
-    Raises:
-    ValueError: If the inputs are not of the expected types.
+    Returns:
+    tuple: The concatenated values and the offsets, where sequence i is values[offsets[i]:offsets[i + 1]].
     """
-    
-    if not isinstance(writer, csv.DictWriter) or not isinstance(filename, str) or not isinstance(timestamp_iso8601, str) or not isinstance(count_of_audible_words, int) or not isinstance(words_out_of_order, bool) or not isinstance(longest_consecutive_count, int):
-        raise ValueError("Invalid input types. Expected types are: DictWriter, str, str, int, bool, int.")
-    writer.writerow({'Filename': filename, 'Timestamp': timestamp_iso8601, 'Count of Audible Words': count_of_audible_words, 'Words Out of Order': words_out_of_order, 'Longest Consecutive Count': longest_consecutive_count})
 
-def process_audio_file(filename, output_file, processed_files, total_files):
+    sequences = list(sequences)
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences)), out=offsets[1:])
+    values = np.fromiter(itertools.chain.from_iterable(sequences), dtype=np.int64, count=offsets[-1])
+    return values, offsets
+
+def find_longest_consecutive_count_and_order_batch(values, offsets=None, pad_value=-1):
     """
-    Processes an audio file and writes the results to a CSV file.
+    Analyses many integer sequences at once, giving the same results as find_longest_consecutive_count_and_order.
+
+    The sequences are given either as a padded 2-D array, with each row padded at the end with pad_value, or as a
+    flat array of values with an array of offsets as returned by pack_sequences. No Python-level loop runs over the
+    sequences or their elements. Empty sequences give a count of 0, not out of order and a longest count of 0,
+    which is the row written for files where nothing was recognised.
 
     Parameters:
-    filename (str): The filename of the audio file to process.
-    output_file (str): The filename of the CSV file to write the results to.
-    processed_files (int): The number of files that have already been processed.
-    total_files (int): The total number of files to process.
+    values (numpy.ndarray): The padded 2-D array of sequences, or the flat array of values when offsets is given.
+    offsets (numpy.ndarray): The start of each sequence in values, followed by the total length.
+    pad_value (int): The value that pads the rows of a 2-D array.
 
     Returns:
-    int: The updated number of processed files.
+    tuple: Arrays of the count of audible words, the longest consecutive count and whether the words are out of order.
+
+    Raises:
+    ValueError: If the values are not integers or the offsets do not describe the values.
     """
 
-    if not filename.endswith(".wav"):
-        return processed_files
-    if filename.endswith(".wav"):
-        audio_file = os.path.join(audio_dir, filename)
-        
-        with sr.AudioFile(audio_file) as source:
-            audio_data = r.record(source)
-        
-        timestamp_iso8601 = get_timestamp(filename) or "None"
+    values = np.asarray(values)
+    if not np.issubdtype(values.dtype, np.integer):
+        raise ValueError("Input must be an array of integers.")
+    if offsets is None:
+        if values.ndim != 2:
+            raise ValueError("Input must be a 2-D padded array when no offsets are given.")
+        mask = values != pad_value
+        offsets = np.zeros(values.shape[0] + 1, dtype=np.int64)
+        np.cumsum(mask.sum(axis=1), out=offsets[1:])
+        values = values[mask]
+    else:
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if values.ndim != 1 or offsets.ndim != 1 or offsets.size == 0 or offsets[0] != 0 or offsets[-1] != values.size or np.any(np.diff(offsets) < 0):
+            raise ValueError("Offsets must start at 0, never decrease and end at the number of values.")
 
-        try:
-            text = r.recognize_google(audio_data)
-            text_array_int = get_audio_in_array_format_int(text)
-            count_of_audible_words = len(text_array_int)
-            longest_consecutive_count, words_out_of_order = find_longest_consecutive_count_and_order(text_array_int)
-            with open(output_file, 'a', newline='') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=['Filename', 'Timestamp', 'Count of Audible Words', 'Words Out of Order', 'Longest Consecutive Count'])
-                write_row_to_csv(writer, filename, timestamp_iso8601, count_of_audible_words, words_out_of_order, longest_consecutive_count)
+    lengths = np.diff(offsets)
+    sequence_count = lengths.size
+    if values.size == 0:
+        zeros = np.zeros(sequence_count, dtype=np.int64)
+        return zeros, zeros.copy(), np.zeros(sequence_count, dtype=bool)
 
-        except Exception as e:
-            with open(output_file, 'a', newline='') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=['Filename', 'Timestamp', 'Count of Audible Words', 'Words Out of Order', 'Longest Consecutive Count'])
-                write_row_to_csv(writer, filename, timestamp_iso8601, 0, False, 0)
+    # Which sequence each value belongs to, and whether each value starts its sequence
+    sequence_ids = np.repeat(np.arange(sequence_count), lengths)
+    starts_sequence = np.zeros(values.size, dtype=bool)
+    starts_sequence[offsets[:-1][lengths > 0]] = True
 
-    processed_files += 1
-    percentage_complete = round((processed_files / total_files) * 100, 2)
-    print(f"Processing: {percentage_complete}% complete")
+    # Compare each value with the one before it in the same sequence
+    steps = np.diff(values)
+    same_sequence = ~starts_sequence[1:]
+    decreasing = (steps < 0) & same_sequence
+    words_out_of_order = np.bincount(sequence_ids[1:][decreasing], minlength=sequence_count) > 0
 
-    return processed_files  # return the updated value
+    # Split the values into runs that each count up by one, then take the longest run in each sequence
+    starts_run = starts_sequence.copy()
+    starts_run[1:] |= ~((steps == 1) & same_sequence)
+    run_ids = np.cumsum(starts_run) - 1
+    run_lengths = np.bincount(run_ids)
+    non_empty = lengths > 0
+    longest_consecutive_count = np.zeros(sequence_count, dtype=np.int64)
+    longest_consecutive_count[non_empty] = np.maximum.reduceat(run_lengths, run_ids[offsets[:-1][non_empty]])
+
+    return lengths, longest_consecutive_count, words_out_of_order
 
-def main():
+class AudioResult(namedtuple('AudioResult', ['filename', 'timestamp', 'count_of_audible_words', 'words_out_of_order', 'longest_consecutive_count', 'duplicate_of'], defaults=(None,))):
     """
-    The main function that processes all audio files in a directory and writes the results to a CSV file.
+    The result of analysing one audio file.
+
+    A named tuple, so each result is a single compact object with no per-instance dictionary, and it still unpacks
+    like the plain tuples the pipeline passed around before. The timestamp is an ISO 8601 string, or "None" when the
+    filename has none, and duplicate_of is the filename of the recording it was copied from, if any.
     """
 
-    total_files = get_total_files(audio_dir)
-    processed_files = 0
+    __slots__ = ()
+
+    # The output column of each field, in order. The 'Duplicate Of' column is only written when deduplicating.
+    fieldnames = ('Filename', 'Timestamp', 'Count of Audible Words', 'Words Out of Order', 'Longest Consecutive Count', 'Duplicate Of')
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Creates a result from a row keyed by the output column names, such as one read back from a CSV file.
+
+        Parameters:
+        row (dict): The row, with its values as written or as text.
+
+        Returns:
+        AudioResult: The result.
+        """
+
+        return cls(row['Filename'], row['Timestamp'], int(row['Count of Audible Words']), row['Words Out of Order'] in (True, 'True'),
+                   int(row['Longest Consecutive Count']), row.get('Duplicate Of') or None)
+
+    def as_row(self):
+        """
+        Returns:
+        dict: The result keyed by the output column names, without the 'Duplicate Of' column unless it is set.
+        """
+
+        row = dict(zip(self.fieldnames, self))
+        if self.duplicate_of is None:
+            del row['Duplicate Of']
+        return row
+
+# The field of AudioResult that holds each output column
+result_fields = dict(zip(AudioResult.fieldnames, AudioResult._fields))
+
+class ResultTable:
+    """
+    Results held in memory as one list per field rather than one object per row.
+
+    The CSV and Parquet sinks buffer their rows in a table between writes, and a table is itself a result sink, so
+    library callers can collect the results of main in one instead of reading them back from a file. Tables can be
+    sorted and summarised directly. Like a list, a table must not be appended to from several threads at once.
+    """
+
+    def __init__(self, results=()):
+        """
+        Parameters:
+        results (iterable): The AudioResult objects to start with.
+        """
+
+        self.columns = {field: [] for field in AudioResult._fields}
+        self._column_lists = list(self.columns.values())
+        for result in results:
+            self.append(result)
+
+    @classmethod
+    def from_csv(cls, path):
+        """
+        Loads the results from an output CSV file.
+
+        Parameters:
+        path (str): The CSV file to read.
+
+        Returns:
+        ResultTable: The results, in the order of the file.
+        """
+
+        with open(path, 'r', newline='') as csvfile:
+            return cls(map(AudioResult.from_row, csv.DictReader(csvfile)))
+
+    def append(self, result):
+        """
+        Adds a result to the end of the table.
+
+        Parameters:
+        result (AudioResult): The result to add.
+        """
+
+        for column, value in zip(self._column_lists, result):
+            column.append(value)
+
+    def clear(self):
+        """
+        Removes every result from the table.
+        """
+
+        for column in self._column_lists:
+            column.clear()
+
+    def __len__(self):
+        return len(self._column_lists[0])
+
+    def __iter__(self):
+        return map(AudioResult._make, zip(*self._column_lists))
+
+    def __getitem__(self, index):
+        return AudioResult._make(column[index] for column in self._column_lists)
+
+    def sorted_by(self, field='timestamp', reverse=False):
+        """
+        Sorts the results by one of their fields.
+
+        Parameters:
+        field (str): The AudioResult field to sort by. Results without a timestamp come after the others when
+        sorting by timestamp, since ISO 8601 timestamps otherwise sort in time order as text.
+        reverse (bool): Whether to sort in descending order.
+
+        Returns:
+        ResultTable: A new table with the results in order.
+        """
+
+        values = self.columns[field]
+        key = (lambda index: (values[index] == "None", values[index])) if field == 'timestamp' else values.__getitem__
+        order = sorted(range(len(self)), key=key, reverse=reverse)
+        table = ResultTable()
+        for name, column in self.columns.items():
+            table.columns[name].extend([column[index] for index in order])
+        return table
+
+    def summary(self):
+        """
+        Summarises the results.
+
+        Returns:
+        dict: The number of files, of files in which no words were recognised, of files with words out of order
+        and of duplicates, the total and mean number of audible words, the longest consecutive count, and the
+        earliest and latest timestamps (None if no file has one).
+        """
+
+        counts = self.columns['count_of_audible_words']
+        timestamps = [timestamp for timestamp in self.columns['timestamp'] if timestamp != "None"]
+        return {
+            'files': len(self),
+            'files_without_words': counts.count(0),
+            'files_out_of_order': sum(self.columns['words_out_of_order']),
+            'duplicates': len(self) - self.columns['duplicate_of'].count(None),
+            'audible_words': sum(counts),
+            'mean_audible_words': sum(counts) / len(self) if counts else 0.0,
+            'longest_consecutive_count': max(self.columns['longest_consecutive_count'], default=0),
+            'first_timestamp': min(timestamps, default=None),
+            'last_timestamp': max(timestamps, default=None),
+        }
+
+    def write(self, result):
+        """
+        Adds a result, so that a table can be used as a result sink.
+
+        Parameters:
+        result (AudioResult): The result to add.
+        """
+
+        self.append(result)
+
+    def writerow(self, row):
+        """
+        Adds a row keyed by the output column names, so that a table can be used as a result sink.
+
+        Parameters:
+        row (dict): The row to add.
+        """
+
+        self.append(AudioResult.from_row(row))
+
+    def flush(self):
+        """
+        Does nothing, as a table has nothing to write.
+        """
+
+    def close(self):
+        """
+        Does nothing, as a table has nothing to write.
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class CsvResultSink:
+    """
+    Buffers results and writes them to a single open CSV file.
+
+    Results are held in a ResultTable and written in batches once batch_size rows are waiting or flush_interval seconds
+    have passed since the last write, whichever comes first. The time threshold is only checked when a row is
+    added, and any remaining rows are written when the sink is flushed or closed. Rows may be added from several
+    threads at once.
+    """
+
+    fieldnames = list(AudioResult.fieldnames[:5])
+
+    def __init__(self, output_file, mode='a', batch_size=100, flush_interval=1.0, fieldnames=None):
+        """
+        Parameters:
+        output_file (str): The filename of the CSV file to write the results to.
+        mode (str): 'w' to truncate the file and write the header, or 'a' to append to it.
+        batch_size (int): The number of buffered rows that triggers a write.
+        flush_interval (float): The number of seconds after which buffered rows are written.
+        fieldnames (list): The columns to write, if not the default ones. Columns missing from a row are left empty.
+        """
+
+        self.fieldnames = fieldnames or self.fieldnames
+        self.output_file = output_file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._csvfile = open(output_file, mode, newline='')
+        if mode == 'w':
+            csv.DictWriter(self._csvfile, fieldnames=self.fieldnames).writeheader()
+            self._csvfile.flush()
+        self._results = ResultTable()
+        self._columns = [self._results.columns[result_fields[name]] for name in self.fieldnames]
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def write(self, result):
+        """
+        Adds a result to the buffer, writing the buffer out if a threshold has been reached.
+
+        Parameters:
+        result (AudioResult): The result to write.
+        """
+
+        with self._lock:
+            self._results.append(result)
+            if len(self._results) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def writerow(self, row):
+        """
+        Adds a row to the buffer, writing the buffer out if a threshold has been reached.
+
+        Parameters:
+        row (dict): The row to write, keyed by the CSV field names.
+        """
+
+        self.write(AudioResult.from_row(row))
+
+    def flush(self):
+        """
+        Writes all buffered rows to the CSV file.
+        """
+
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        # Each batch goes to the file in a single write, so an interrupted run leaves at most one partial line
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(zip(*self._columns))
+        self._csvfile.write(buffer.getvalue())
+        self._results.clear()
+        self._csvfile.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Writes all buffered rows and closes the CSV file.
+        """
+
+        with self._lock:
+            if self._csvfile.closed:
+                return
+            self._flush()
+            self._csvfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def load_pyarrow():
+    """
+    Imports pyarrow and its Parquet module, which are only needed for Parquet output.
+
+    Returns:
+    tuple: The pyarrow and pyarrow.parquet modules.
+
+    Raises:
+    ImportError: If the pyarrow package is not installed.
+    """
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet output requires the pyarrow package. Install it with 'pip install pyarrow'.")
+    return pyarrow, pyarrow.parquet
+
+class ParquetResultSink:
+    """
+    Buffers results and writes them to a Parquet file with typed columns.
+
+    The timestamp is stored as a native timestamp (null when the filename has none), the counts as integers and the
+    out of order flag as a boolean, so the results can be loaded without parsing any text. Each batch_size rows are
+    written as one row group as they arrive. Parquet files cannot be appended to, and the file is only readable once
+    the sink is closed. Rows may be added from several threads at once.
+    """
+
+    fieldnames = CsvResultSink.fieldnames
+
+    def __init__(self, output_file, batch_size=65536, fieldnames=None):
+        """
+        Parameters:
+        output_file (str): The filename of the Parquet file to write the results to.
+        batch_size (int): The number of rows in each row group.
+        fieldnames (list): The columns to write, if not the default ones. Columns missing from a row are null.
+
+        Raises:
+        ImportError: If the pyarrow package is not installed.
+        """
+
+        pyarrow, parquet = load_pyarrow()
+        self.fieldnames = fieldnames or self.fieldnames
+        self.output_file = output_file
+        self.batch_size = batch_size
+        self._pyarrow = pyarrow
+        types = {
+            'Filename': pyarrow.string(),
+            'Timestamp': pyarrow.timestamp('ms'),
+            'Count of Audible Words': pyarrow.int32(),
+            'Words Out of Order': pyarrow.bool_(),
+            'Longest Consecutive Count': pyarrow.int32(),
+            'Duplicate Of': pyarrow.string(),
+        }
+        self._schema = pyarrow.schema([(name, types[name]) for name in self.fieldnames])
+        self._writer = parquet.ParquetWriter(output_file, self._schema)
+        self._results = ResultTable()
+        self._lock = threading.Lock()
+
+    def write(self, result):
+        """
+        Adds a result to the buffer, writing a row group once batch_size results are waiting.
+
+        Parameters:
+        result (AudioResult): The result to write.
+        """
+
+        with self._lock:
+            self._results.append(result)
+            if len(self._results) >= self.batch_size:
+                self._flush()
+
+    def writerow(self, row):
+        """
+        Adds a row to the buffer, writing a row group once batch_size rows are waiting.
+
+        Parameters:
+        row (dict): The row to write, keyed by the CSV field names.
+        """
+
+        self.write(AudioResult.from_row(row))
+
+    def flush(self):
+        """
+        Writes all buffered rows as a row group.
+        """
+
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not len(self._results):
+            return
+        columns = {name: self._results.columns[result_fields[name]] for name in self.fieldnames}
+        columns['Timestamp'] = [datetime.fromisoformat(timestamp) if timestamp != "None" else None for timestamp in columns['Timestamp']]
+        self._writer.write_table(self._pyarrow.Table.from_pydict(columns, schema=self._schema))
+        self._results.clear()
+
+    def close(self):
+        """
+        Writes all buffered rows and closes the Parquet file.
+        """
+
+        with self._lock:
+            if self._writer is None:
+                return
+            self._flush()
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class DeduplicatedResultSink:
+    """
+    Writes the results of the first copy of each recording to another sink, along with a result for each of its
+    duplicates found by a Deduplicator.
+
+    A duplicate's result is a copy of the first copy's result with its own filename and timestamp, and the filename of
+    the first copy in its duplicate_of field. Results must be written in the order of filenames, as the engines do, so
+    that each duplicate can be written in its place as soon as the row before it has been written. A duplicate whose
+    first copy has no result, because it was never written, is analysed on its own instead.
+    """
+
+    field = AudioResult.fieldnames[5]
+
+    def __init__(self, sink, filenames, duplicates, results=None, analyse=None):
+        """
+        Parameters:
+        sink (CsvResultSink, ParquetResultSink or ResultTable): The sink to write the results to. File sinks must be
+        created with the 'Duplicate Of' field.
+        filenames (list): The filenames of all the audio files, including the duplicates, in the order of the rows.
+        duplicates (dict): The filename of the first copy of each duplicate, keyed by the duplicate's filename.
+        results (dict): The results or rows of first copies that were written by an earlier run, keyed by filename. The rows of
+        their duplicates that come before any other file are written straight away.
+        analyse (callable): Returns the result of a file from its filename, for duplicates whose first copy has no
+        result. Defaults to analyse_audio_file.
+        """
+
+        self.sink = sink
+        self.duplicates = duplicates
+        self.analyse = analyse or analyse_audio_file
+        self._originals = set(duplicates.values())
+        self._results = {filename: AudioResult.from_row(row) if isinstance(row, dict) else row for filename, row in (results or {}).items()}
+        self._followers = {None: []}
+        previous = None
+        for filename in filenames:
+            if filename in duplicates:
+                self._followers[previous].append(filename)
+            else:
+                previous = filename
+                self._followers[filename] = []
+        self._lock = threading.Lock()
+        self._write_followers(None)
+
+    def write(self, result):
+        """
+        Writes a result, followed by the results of the duplicates that come straight after it.
+
+        Parameters:
+        result (AudioResult): The result to write.
+        """
+
+        with self._lock:
+            self.sink.write(result)
+            if result.filename in self._originals:
+                self._results[result.filename] = result
+            self._write_followers(result.filename)
+
+    def writerow(self, row):
+        """
+        Writes a row, followed by the rows of the duplicates that come straight after it.
+
+        Parameters:
+        row (dict): The row to write, keyed by the CSV field names.
+        """
+
+        self.write(AudioResult.from_row(row))
+
+    def _write_followers(self, filename):
+        for duplicate in self._followers.pop(filename, ()):
+            original = self.duplicates[duplicate]
+            if original not in self._results:
+                self.sink.write(self.analyse(duplicate))
+                continue
+            timestamp_iso8601 = get_timestamp(os.path.basename(duplicate)) or "None"
+            self.sink.write(self._results[original]._replace(filename=duplicate, timestamp=timestamp_iso8601, duplicate_of=original))
 
-    with open(output_file, 'w', newline='') as csvfile:
-        fieldnames = ['Filename', 'Timestamp', 'Count of Audible Words', 'Words Out of Order', 'Longest Consecutive Count']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+    def flush(self):
+        """
+        Writes all buffered results of the underlying sink.
+        """
+
+        self.sink.flush()
+
+    def close(self):
+        """
+        Closes the underlying sink.
+        """
+
+        self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# The sinks that write_row_to_csv and process_audio_file accept in place of a csv.DictWriter or a filename
+result_sinks = (CsvResultSink, ParquetResultSink, DeduplicatedResultSink, ResultTable)
+
+def load_successful_rows(output_file):
+    """
+    Reads the rows of a previous run that do not need to be processed again.
+
+    A row is kept if it is complete and at least one word was recognised. Rows written for files that failed, and a
+    partial last line left by an interrupted run, are left out so that those files are processed again.
+
+    Parameters:
+    output_file (str): The filename of the CSV file written by the previous run.
+
+    Returns:
+    dict: The kept rows, keyed by filename.
+    """
+
+    with open(output_file, 'r', newline='') as csvfile:
+        lines = csvfile.read().splitlines(keepends=True)
+    if lines and not lines[-1].endswith('\n'):
+        lines.pop()
+
+    rows = {}
+    for row in csv.DictReader(lines):
+        if None in row.values() or None in row:
+            continue
+        count_of_audible_words = row['Count of Audible Words']
+        if count_of_audible_words.isdigit() and int(count_of_audible_words) > 0:
+            rows[row['Filename']] = row
+    return rows
+
+def rewrite_output_file(output_file, rows, fieldnames=None):
+    """
+    Atomically replaces a CSV file with the header and the given rows.
+
+    The rows are written to a temporary file in the same directory, which is then renamed over the original, so
+    the CSV file is never left half written.
+
+    Parameters:
+    output_file (str): The filename of the CSV file to replace.
+    rows (iterable): The rows to write, keyed by the CSV field names.
+    fieldnames (list): The columns to write. Defaults to those of CsvResultSink. Other columns are dropped.
+    """
+
+    temporary_file = f"{output_file}.tmp"
+    with open(temporary_file, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames or CsvResultSink.fieldnames, extrasaction='ignore')
         writer.writeheader()
+        writer.writerows(rows)
+        csvfile.flush()
+        os.fsync(csvfile.fileno())
+    os.replace(temporary_file, output_file)
+
+def replace_output_row(output_file, result, fieldnames=None):
+    """
+    Atomically replaces the row of a file in a CSV file with a new result, or adds it if the file has no row.
+
+    Parameters:
+    output_file (str): The filename of the CSV file.
+    result (AudioResult): The new result.
+    fieldnames (list): The columns to write. Defaults to those of CsvResultSink.
+    """
+
+    with open(output_file, 'r', newline='') as csvfile:
+        rows = [row for row in csv.DictReader(csvfile) if row['Filename'] != result.filename]
+    rows.append(result.as_row())
+    rewrite_output_file(output_file, rows, fieldnames)
+
+def write_row_to_csv(writer, filename, timestamp_iso8601, count_of_audible_words, words_out_of_order, longest_consecutive_count, duplicate_of=None):
+    """
+    Writes a row to a CSV file.
 
-    for filename in os.listdir(audio_dir):
-        processed_files = process_audio_file(filename, output_file, processed_files, total_files)  # update the variable with the returned value
+    An AudioResult can be unpacked into the arguments, as in write_row_to_csv(sink, *result).
+
+    Parameters:
+    writer (csv.DictWriter or a result sink): The writer object to use for writing to the output file.
+    filename (str): The filename of the audio file.
+    timestamp_iso8601 (str): The timestamp of the audio file in ISO 8601 format.
+    count_of_audible_words (int): The count of audible words in the audio file.
+    words_out_of_order (bool): A boolean indicating if the words in the audio file are out of order.
+    longest_consecutive_count (int): The longest consecutive count of words in the audio file.
+    duplicate_of (str): The filename of the recording the audio file is a copy of, if any.
+
+    Raises:
+    ValueError: If the inputs are not of the expected types.
+    """
+    
+    if not isinstance(writer, (csv.DictWriter,) + result_sinks) or not isinstance(filename, str) or not isinstance(timestamp_iso8601, str) or not isinstance(count_of_audible_words, int) or not isinstance(words_out_of_order, bool) or not isinstance(longest_consecutive_count, int) or not isinstance(duplicate_of, (str, type(None))):
+        raise ValueError("Invalid input types. Expected types are: DictWriter or a result sink, str, str, int, bool, int, str or None.")
+    result = AudioResult(filename, timestamp_iso8601, count_of_audible_words, words_out_of_order, longest_consecutive_count, duplicate_of)
+    if isinstance(writer, csv.DictWriter):
+        writer.writerow(result.as_row())
+    else:
+        writer.write(result)
+
+class TranscriptCache:
+    """
+    A persistent cache of raw transcripts stored in a SQLite file.
+
+    Entries are keyed by a hash of the audio file's bytes and the recognizer settings, so a transcript is reused
+    only when both the audio and the way it is recognised are unchanged. When the stored transcripts grow past
+    max_bytes, the least recently used entries are evicted. The cache may be used from several threads at once.
+
+    When a manifest is given, the hash of an unchanged file is read from it instead of being computed on every run.
+    """
+
+    def __init__(self, path=cache_file, max_bytes=64 * 1024 * 1024, manifest=None):
+        """
+        Parameters:
+        path (str): The filename of the SQLite database holding the cache.
+        max_bytes (int): The total size of the keys and transcripts to keep before evicting entries.
+        manifest (Manifest): The index of content hashes to build file keys from, if any.
+        """
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.manifest = manifest
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS transcripts (key TEXT PRIMARY KEY, transcript TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS transcripts_last_used ON transcripts (last_used)")
+        self._connection.commit()
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM transcripts").fetchone()[0]
+
+    @staticmethod
+    def make_key(audio_bytes, settings):
+        """
+        Builds the cache key for a piece of audio.
+
+        Parameters:
+        audio_bytes (bytes): The contents of the audio file.
+        settings (str): A description of the recognizer settings used to transcribe the audio.
+
+        Returns:
+        str: The hex digest identifying the audio and settings.
+        """
+
+        return TranscriptCache.make_hash_key(hashlib.sha256(audio_bytes).hexdigest(), settings)
+
+    @staticmethod
+    def make_hash_key(content_hash, settings):
+        """
+        Builds the cache key for audio whose contents have already been hashed.
+
+        Parameters:
+        content_hash (str): The SHA-256 hex digest of the audio file's contents.
+        settings (str): A description of the recognizer settings used to transcribe the audio.
+
+        Returns:
+        str: The same hex digest as make_key for the audio.
+        """
+
+        return hashlib.sha256(settings.encode() + b'\0' + content_hash.encode()).hexdigest()
+
+    @staticmethod
+    def make_file_key(audio_file, settings, chunk_size=1024 * 1024):
+        """
+        Builds the cache key for an audio file, reading it a chunk at a time.
+
+        Parameters:
+        audio_file (str): The path of the audio file.
+        settings (str): A description of the recognizer settings used to transcribe the audio.
+        chunk_size (int): The number of bytes to read at a time.
+
+        Returns:
+        str: The same hex digest as make_key for the file's contents.
+        """
+
+        return TranscriptCache.make_hash_key(hash_file(audio_file, chunk_size), settings)
+
+    def file_key(self, audio_file, settings):
+        """
+        Builds the cache key for an audio file, taking its hash from the manifest if there is one.
+
+        Parameters:
+        audio_file (str): The path of the audio file.
+        settings (str): A description of the recognizer settings used to transcribe the audio.
+
+        Returns:
+        str: The same hex digest as make_file_key.
+        """
+
+        if self.manifest is None:
+            return self.make_file_key(audio_file, settings)
+        return self.make_hash_key(self.manifest.content_hash(audio_file), settings)
+
+    def get(self, key):
+        """
+        Looks up a transcript and marks it as recently used.
+
+        Parameters:
+        key (str): The cache key built by make_key.
+
+        Returns:
+        str: The cached transcript, or None if it is not in the cache.
+        """
+
+        with self._lock:
+            row = self._connection.execute("SELECT transcript FROM transcripts WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute("UPDATE transcripts SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, transcript):
+        """
+        Stores a transcript, evicting the least recently used entries if the cache is over its size limit.
+
+        Parameters:
+        key (str): The cache key built by make_key.
+        transcript (str): The raw transcript returned by the recognizer.
+        """
+
+        size = len(key) + len(transcript.encode())
+        with self._lock:
+            row = self._connection.execute("SELECT size FROM transcripts WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._size -= row[0]
+            self._connection.execute("INSERT OR REPLACE INTO transcripts VALUES (?, ?, ?, ?)", (key, transcript, size, time.time()))
+            self._size += size
+            while self._size > self.max_bytes:
+                oldest = self._connection.execute("SELECT key, size FROM transcripts ORDER BY last_used LIMIT 100").fetchall()
+                for old_key, old_size in oldest:
+                    if self._size <= self.max_bytes:
+                        break
+                    self._connection.execute("DELETE FROM transcripts WHERE key = ?", (old_key,))
+                    self._size -= old_size
+            self._connection.commit()
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+
+        with self._lock:
+            self._connection.execute("DELETE FROM transcripts")
+            self._connection.commit()
+            self._size = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
+
+    def close(self):
+        """
+        Closes the SQLite database.
+        """
+
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class Manifest:
+    """
+    A persistent index of the audio files seen by earlier runs, stored in a SQLite file.
+
+    Each file is recorded with its size, modification time and a hash of its contents. A file whose size and
+    modification time are unchanged is assumed to have unchanged contents, so its hash is read from the index rather
+    than computed again. The manifest may be used from several threads at once.
+    """
+
+    def __init__(self, path=manifest_file):
+        """
+        Parameters:
+        path (str): The filename of the SQLite database holding the manifest.
+        """
+
+        self.path = path
+        self.hashed = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, hash TEXT NOT NULL)")
+        self._connection.commit()
+
+    def content_hash(self, audio_file, size=None, mtime_ns=None):
+        """
+        Returns the hash of an audio file's contents, only reading the file if it is new or has changed.
+
+        Parameters:
+        audio_file (str): The path of the audio file.
+        size (int): The size of the file in bytes, if already known from iter_audio_files.
+        mtime_ns (int): The modification time of the file in nanoseconds, if already known from iter_audio_files.
+
+        Returns:
+        str: The SHA-256 hex digest of the file's contents.
+        """
+
+        path = os.path.abspath(audio_file)
+        if size is None or mtime_ns is None:
+            stat = os.stat(path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        with self._lock:
+            row = self._connection.execute("SELECT hash FROM files WHERE path = ? AND size = ? AND mtime_ns = ?", (path, size, mtime_ns)).fetchone()
+        if row is not None:
+            return row[0]
+
+        content_hash = hash_file(path)
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (path, size, mtime_ns, content_hash))
+            self._connection.commit()
+            self.hashed += 1
+        return content_hash
+
+    def changed(self, directory, entries):
+        """
+        Finds the audio files that are new or have changed since they were last hashed, without reading them.
+
+        Parameters:
+        directory (str): The directory the entries were found in.
+        entries (iterable): The (relative path, size, mtime_ns) tuples yielded by iter_audio_files.
+
+        Yields:
+        tuple: The entries whose size or modification time differ from the manifest, or that are not in it.
+        """
+
+        for entry in entries:
+            relative_path, size, mtime_ns = entry
+            with self._lock:
+                row = self._connection.execute("SELECT size, mtime_ns FROM files WHERE path = ?", (os.path.abspath(os.path.join(directory, relative_path)),)).fetchone()
+            if row != (size, mtime_ns):
+                yield entry
+
+    def prune(self, directory, relative_paths):
+        """
+        Removes the files under a directory that no longer exist from the manifest.
+
+        Parameters:
+        directory (str): The directory that was scanned.
+        relative_paths (iterable): The paths, relative to directory, of the audio files it still contains.
+
+        Returns:
+        int: The number of entries removed.
+        """
+
+        root = os.path.join(os.path.abspath(directory), '')
+        present = {os.path.abspath(os.path.join(directory, path)) for path in relative_paths}
+        with self._lock:
+            stale = [(path,) for (path,) in self._connection.execute("SELECT path FROM files WHERE substr(path, 1, ?) = ?", (len(root), root)) if path not in present]
+            self._connection.executemany("DELETE FROM files WHERE path = ?", stale)
+            self._connection.commit()
+        return len(stale)
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self):
+        """
+        Closes the SQLite database.
+        """
+
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class Deduplicator:
+    """
+    Finds recordings that are copies of an earlier one, so that only the first copy is sent to the recognizer.
+
+    Exact copies are found by the hash of their contents. When a similarity is given, near-duplicates are also found,
+    e.g. the same clip re-encoded or at another volume. Each recording is decoded to an envelope of its loudness and a
+    mel spectrogram, frame_rate frames per second, and two recordings of the same length are near-duplicates when both
+    are correlated by at least the similarity. Different people counting at the same pace have matching envelopes,
+    but their voices give different spectra. Silent recordings, and those with a constant loudness, are only matched
+    exactly.
+    """
+
+    def __init__(self, similarity=None, manifest=None, frame_rate=50, min_dbfs=-50.0, mel_bands=24, max_frequency=4000):
+        """
+        Parameters:
+        similarity (float): The correlation, up to 1, above which two envelopes are near-duplicates. None to only find exact copies.
+        manifest (Manifest): The index to read the content hashes from, if any.
+        frame_rate (int): The number of envelope values per second of audio.
+        min_dbfs (float): The level, in decibels relative to full scale, that the loudest frame must reach for a
+        recording to be matched by its envelope.
+        mel_bands (int): The number of mel bands in the spectrogram.
+        max_frequency (float): The highest frequency in the spectrogram, in Hz, so that copies re-encoded at a lower
+        sample rate still match.
+        """
+
+        if similarity is not None and not 0 < similarity <= 1:
+            raise ValueError("similarity must be greater than 0 and at most 1")
+        self.similarity = similarity
+        self.manifest = manifest
+        self.frame_rate = frame_rate
+        self.min_dbfs = min_dbfs
+        self.mel_bands = mel_bands
+        self.max_frequency = max_frequency
+
+    def fingerprint(self, audio_file):
+        """
+        Computes the normalised loudness envelope and mel spectrogram of a recording.
+
+        Parameters:
+        audio_file (str): The path of the audio file.
+
+        Returns:
+        tuple: The root mean square of each frame, and the log mel energies of each frame, each scaled to a mean of 0
+        and a standard deviation of 1, or None if the recording is silent or its loudness is constant.
+        """
+
+        audio_data = decode_audio_file(audio_file)[0]
+        samples = np.frombuffer(audio_data.get_raw_data(convert_width=2), np.int16).astype(np.float64)
+        frame_size = max(audio_data.sample_rate // self.frame_rate, 1)
+        frames = len(samples) // frame_size
+        envelope = np.sqrt(np.mean(np.square(samples[:frames * frame_size].reshape(frames, frame_size)), axis=1))
+        if frames < 2 or envelope.max() < 32768 * 10 ** (self.min_dbfs / 20):
+            return None
+        deviation = envelope.std()
+        if deviation < 1e-6 * envelope.mean():
+            return None
+
+        power = np.square(np.abs(np.fft.rfft(samples[:frames * frame_size].reshape(frames, frame_size), axis=1)))
+        energies = power @ _mel_filterbank(audio_data.sample_rate, frame_size, self.mel_bands, min(self.max_frequency, audio_data.sample_rate / 2)).T
+        # The floor is relative to the loudest band, so a copy at another volume gives the same spectrogram
+        spectrum = np.log10(energies + energies.max() * 1e-6)
+        return (envelope - envelope.mean()) / deviation, (spectrum - spectrum.mean()) / spectrum.std()
+
+    def find_duplicates(self, directory, filenames, metrics=None):
+        """
+        Matches each recording against the ones before it.
+
+        Parameters:
+        directory (str): The directory containing the audio files.
+        filenames (list): The filenames of the audio files, relative to directory. The first of each set of copies is kept.
+        metrics (Metrics): The metrics to record the time taken and the number of duplicates in, if any.
+
+        Returns:
+        dict: The filename of the first copy of each duplicate, keyed by the duplicate's filename.
+        """
+
+        metrics = metrics or null_metrics
+        duplicates = {}
+        first_by_hash = {}
+        envelopes_by_length = {}
+        with metrics.time('dedup'):
+            for filename in filenames:
+                audio_file = os.path.join(directory, filename)
+                content_hash = self.manifest.content_hash(audio_file) if self.manifest is not None else hash_file(audio_file)
+                original = first_by_hash.setdefault(content_hash, filename)
+                if original != filename:
+                    duplicates[filename] = original
+                    continue
+                if self.similarity is None:
+                    continue
+
+                fingerprint = self.fingerprint(audio_file)
+                if fingerprint is None:
+                    continue
+                envelope, spectrum = fingerprint
+                # Lengths may differ by a frame after resampling, so the shorter envelope is compared
+                for length in (len(envelope) - 1, len(envelope), len(envelope) + 1):
+                    for candidate, other, other_spectrum in envelopes_by_length.get(length, ()):
+                        count = min(len(envelope), len(other))
+                        if (np.dot(envelope[:count], other[:count]) / count >= self.similarity
+                                and np.mean(spectrum[:count] * other_spectrum[:count]) >= self.similarity):
+                            duplicates[filename] = candidate
+                            break
+                    if filename in duplicates:
+                        break
+                else:
+                    envelopes_by_length.setdefault(len(envelope), []).append((filename, envelope, spectrum))
+        metrics.increment('duplicates', len(duplicates))
+        return duplicates
+
+class GoogleBackend:
+    """
+    Recognises speech with Google's online speech recognition service.
+    """
+
+    name = 'google'
+
+    # Google needs the whole recording in a single request, so it cannot be sent a chunk at a time
+    supports_streaming = False
+    streaming = False
+
+    def __init__(self, language='en-US', endpoint=None, preprocessor=None):
+        """
+        Parameters:
+        language (str): The language of the recordings.
+        endpoint (str): The URL of the recognition service. Defaults to Google's.
+        preprocessor (AudioPreprocessor): Converts the audio before it is uploaded, if given.
+        """
+
+        self.language = language
+        self.endpoint = endpoint
+        self.preprocessor = preprocessor
+
+    @property
+    def settings(self):
+        """
+        str: The settings that affect the transcript, for use in cache keys.
+        """
+
+        settings = f"{self.name}:{self.language}" + (f":{self.endpoint}" if self.endpoint else "")
+        if self.preprocessor is not None:
+            settings += f":{self.preprocessor.settings}"
+        return settings
+
+    def recognize(self, recognizer, audio_data):
+        """
+        Transcribes audio with Google's speech recognition service.
+
+        Parameters:
+        recognizer (sr.Recognizer): The recognizer to send the request with.
+        audio_data (sr.AudioData): The audio to transcribe.
+
+        Returns:
+        str: The transcript.
+
+        Raises:
+        sr.UnknownValueError: If the speech is unintelligible.
+        sr.RequestError: If the request to the service fails.
+        """
+
+        if self.endpoint:
+            return recognizer.recognize_google(audio_data, language=self.language, endpoint=self.endpoint)
+        return recognizer.recognize_google(audio_data, language=self.language)
+
+# Vosk models loaded by this process, keyed by model directory
+_vosk_models = {}
+_vosk_models_lock = threading.Lock()
+
+def load_vosk_model(model_dir):
+    """
+    Loads a Vosk model, reusing it if this process has already loaded it.
+
+    Parameters:
+    model_dir (str): The directory containing the Vosk model.
+
+    Returns:
+    vosk.Model: The loaded model.
+
+    Raises:
+    ImportError: If the vosk package is not installed.
+    ValueError: If the model directory does not exist.
+    """
+
+    try:
+        import vosk
+    except ImportError:
+        raise ImportError("The vosk backend requires the vosk package. Install it with 'pip install vosk'.")
+    if not os.path.isdir(model_dir):
+        raise ValueError(f"Vosk model directory '{model_dir}' does not exist. Download a model from https://alphacephei.com/vosk/models.")
+
+    with _vosk_models_lock:
+        if model_dir not in _vosk_models:
+            vosk.SetLogLevel(-1)
+            _vosk_models[model_dir] = vosk.Model(model_dir)
+        return _vosk_models[model_dir]
+
+class VoskBackend:
+    """
+    Recognises speech offline with a Vosk model, restricted to the words "one" to "ten".
+
+    The model is loaded once, when the backend is created, and shared by every file and worker thread. Each thread
+    keeps its own decoder, since Vosk decoders cannot be shared between threads. Restricting the decoder to the
+    number words makes decoding faster and stops it from hearing other words.
+
+    In streaming mode the audio is read and decoded chunk_frames frames at a time instead of being read into memory
+    in full, so memory use does not grow with the length of the recording.
+    """
+
+    name = 'vosk'
+    supports_streaming = True
+
+    # Vosk decoders are created for the sample rate of the audio, so it is not converted first
+    preprocessor = None
+
+    def __init__(self, model_dir=None, streaming=False, chunk_frames=4096):
+        """
+        Parameters:
+        model_dir (str): The directory containing the Vosk model. Defaults to vosk_model_dir.
+        streaming (bool): Whether to decode the audio a chunk at a time.
+        chunk_frames (int): The number of frames in each chunk when streaming.
+
+        Raises:
+        ImportError: If the vosk package is not installed.
+        ValueError: If the model directory does not exist.
+        """
+
+        self.model_dir = model_dir or vosk_model_dir
+        self.model = load_vosk_model(self.model_dir)
+        self.grammar = json.dumps(list(number_words) + ['[unk]'])
+        self.streaming = streaming
+        self.chunk_frames = chunk_frames
+        self._local = threading.local()
+
+    @property
+    def settings(self):
+        """
+        str: The settings that affect the transcript, for use in cache keys.
+        """
+
+        return f"{self.name}:{os.path.abspath(self.model_dir)}:{self.grammar}"
+
+    def recognize(self, recognizer, audio_data):
+        """
+        Transcribes audio with the Vosk model.
+
+        Parameters:
+        recognizer (sr.Recognizer): Unused, accepted for compatibility with the other backends.
+        audio_data (sr.AudioData): The audio to transcribe.
+
+        Returns:
+        str: The recognised numbers as digits, in the same format as Google's transcripts (e.g. '12345678910').
+
+        Raises:
+        sr.UnknownValueError: If no number words were recognised.
+        """
+
+        return self.recognize_stream([audio_data])
+
+    def recognize_stream(self, chunks):
+        """
+        Transcribes audio with the Vosk model, feeding it to the decoder a chunk at a time.
+
+        Parameters:
+        chunks (iterable): The consecutive sr.AudioData chunks of a recording.
+
+        Returns:
+        str: The recognised numbers as digits, in the same format as Google's transcripts (e.g. '12345678910').
+
+        Raises:
+        sr.UnknownValueError: If no number words were recognised.
+        Exception: Any error raised while reading the chunks, after the decoder has been reset.
+        """
+
+        import vosk
+
+        decoders = self._local.__dict__.setdefault('decoders', {})
+        decoder = None
+        try:
+            for chunk in chunks:
+                if decoder is None:
+                    # Vosk resamples internally, so each thread keeps a decoder per input sample rate
+                    if chunk.sample_rate not in decoders:
+                        decoders[chunk.sample_rate] = vosk.KaldiRecognizer(self.model, chunk.sample_rate, self.grammar)
+                    decoder = decoders[chunk.sample_rate]
+                # Audio read by read_wav_file is a memoryview over the file, but Vosk only accepts bytes
+                decoder.AcceptWaveform(bytes(chunk.get_raw_data(convert_width=2)))
+        except BaseException:
+            # The decoder is reused for the thread's next file, which must not start with this file's audio
+            if decoder is not None:
+                decoder.Reset()
+            raise
+        if decoder is None:
+            raise sr.UnknownValueError()
+
+        words = json.loads(decoder.FinalResult()).get('text', '').split()
+        digits = ''.join(number_words[word] for word in words if word in number_words)
+        if not digits:
+            raise sr.UnknownValueError()
+        return digits
+
+@functools.lru_cache(maxsize=None)
+def _mel_filterbank(sample_rate, fft_size, mel_bands, max_frequency):
+    """
+    Builds triangular mel filters over the bins of a real FFT.
+
+    Returns:
+    np.ndarray: The filter weights, one row per mel band.
+    """
+
+    mels = np.linspace(0, 2595 * np.log10(1 + max_frequency / 700), mel_bands + 2)
+    bins = np.fft.rfftfreq(fft_size, 1 / sample_rate)
+    edges = 700 * (10 ** (mels / 2595) - 1)
+    lower, centre, upper = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+    return np.maximum(0, np.minimum((bins - lower) / (centre - lower), (upper - bins) / (upper - centre)))
+
+@functools.lru_cache(maxsize=None)
+def _dct_matrix(mel_bands, coefficients):
+    """
+    Builds the orthonormal DCT-II matrix that turns log mel energies into cepstral coefficients.
+
+    Returns:
+    np.ndarray: The matrix, one row per coefficient.
+    """
+
+    k, n = np.arange(coefficients)[:, None], np.arange(mel_bands)[None, :]
+    matrix = np.sqrt(2 / mel_bands) * np.cos(np.pi * k * (2 * n + 1) / (2 * mel_bands))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+def mfcc_features(samples, sample_rate, frame_ms=25, hop_ms=10, mel_bands=26, coefficients=13, max_frequency=4000):
+    """
+    Computes the mel-frequency cepstral coefficients of a word, with the framing, FFT and filtering vectorised in NumPy.
+
+    The coefficients of each frame are taken from the log energies of mel bands up to max_frequency, so recordings at
+    different sample rates give comparable features. The first coefficient only measures loudness, so it is left out
+    and the recording level does not matter.
+
+    Parameters:
+    samples (np.ndarray): The samples of the word.
+    sample_rate (int): The sample rate of the samples.
+    frame_ms (int): The length of each analysis frame.
+    hop_ms (int): The time between the starts of consecutive frames.
+    mel_bands (int): The number of mel bands.
+    coefficients (int): The number of cepstral coefficients to compute, including the one that is left out.
+    max_frequency (float): The highest frequency covered by the mel bands, in Hz.
+
+    Returns:
+    np.ndarray: The coefficients after the first, one row per frame.
+    """
+
+    frame_length = sample_rate * frame_ms // 1000
+    hop_length = sample_rate * hop_ms // 1000
+    samples = np.asarray(samples, dtype=np.float64)
+    if len(samples) < frame_length:
+        samples = np.pad(samples, (0, frame_length - len(samples)))
+    frames = np.lib.stride_tricks.sliding_window_view(samples, frame_length)[::hop_length] * np.hamming(frame_length)
+    fft_size = 1 << (frame_length - 1).bit_length()
+    power = np.square(np.abs(np.fft.rfft(frames, fft_size))) / fft_size
+    filterbank = _mel_filterbank(sample_rate, fft_size, mel_bands, min(max_frequency, sample_rate / 2))
+    cepstrum = np.log(power @ filterbank.T + 1e-6) @ _dct_matrix(mel_bands, coefficients).T
+    return cepstrum[:, 1:]
+
+def dtw_distance(a, b):
+    """
+    Measures how far apart two feature sequences are with dynamic time warping, so words spoken at different speeds
+    can be compared.
+
+    Cells on the same anti-diagonal of the cost matrix only depend on earlier anti-diagonals, so each is computed in
+    one vectorised step.
+
+    Parameters:
+    a (np.ndarray): The first sequence, one row per frame.
+    b (np.ndarray): The second sequence, one row per frame.
+
+    Returns:
+    float: The cost of the cheapest alignment, divided by the combined length of the sequences.
+    """
+
+    cost = np.sqrt(np.square(a[:, None, :] - b[None, :, :]).sum(axis=2))
+    rows, columns = cost.shape
+    total = np.full((rows + 1, columns + 1), np.inf)
+    total[0, 0] = 0
+    for diagonal in range(2, rows + columns + 1):
+        i = np.arange(max(1, diagonal - columns), min(rows, diagonal - 1) + 1)
+        j = diagonal - i
+        total[i, j] = cost[i - 1, j - 1] + np.minimum(np.minimum(total[i - 1, j - 1], total[i - 1, j]), total[i, j - 1])
+    return total[rows, columns] / (rows + columns)
+
+class TemplateBank:
+    """
+    Recorded examples of the words "one" to "ten", as MFCC features, for TemplateBackend to match words against.
+
+    Templates are cut from labelled clips: the words of a clip are found with a voice activity detector and labelled
+    in the order they were spoken, so a single recording of someone counting from one to ten gives a template for
+    every number. For nearest-centroid matching, each template is stretched to a fixed number of frames and the
+    templates of each number are averaged.
+    """
+
+    def __init__(self, vad=None, frames=32):
+        """
+        Parameters:
+        vad (VoiceActivityDetector): The detector that finds the words in a clip. Defaults to one that separates words
+        by at least 100ms of silence, so that audio trimmed by another detector is still split into words.
+        frames (int): The number of frames each template is stretched to for nearest-centroid matching.
+        """
+
+        self.vad = vad or VoiceActivityDetector(min_silence_ms=100)
+        self.frames = frames
+        self.labels = []
+        self.templates = []
+        self._centroids = None
+
+    @classmethod
+    def from_directory(cls, directory, vad=None):
+        """
+        Loads the templates from a directory of labelled WAV files.
+
+        Each file is named after the numbers spoken in it, in words or digits, optionally followed by an underscore and
+        anything else to tell several takes apart, e.g. 'seven.wav', '7_take2.wav' or '1 2 3 4 5 6 7 8 9 10.wav'.
+
+        Parameters:
+        directory (str): The directory containing the labelled clips.
+        vad (VoiceActivityDetector): The detector that finds the words in each clip, if not the default one.
+
+        Returns:
+        TemplateBank: The templates.
+
+        Raises:
+        ValueError: If the directory does not exist or contains no clips, a filename is not a list of numbers, or the
+        number of words found in a clip does not match its name.
+        """
+
+        if not os.path.isdir(directory):
+            raise ValueError(f"Template directory '{directory}' does not exist. Record a clip of each number and name it after the number, e.g. 'seven.wav'.")
+        bank = cls(vad)
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(".wav"):
+                continue
+            labels = parse_transcript(os.path.splitext(filename)[0].split('_')[0])
+            bank.add(read_audio_file(os.path.join(directory, filename)), labels, filename)
+        if not bank.templates:
+            raise ValueError(f"Template directory '{directory}' contains no .wav files.")
+        return bank
+
+    def add(self, audio_data, labels, name="clip"):
+        """
+        Adds a template for each word of a labelled clip.
+
+        Parameters:
+        audio_data (sr.AudioData): The clip.
+        labels (list): The numbers spoken in the clip, in order.
+        name (str): The name of the clip, for error messages.
+
+        Raises:
+        ValueError: If the number of words found in the clip does not match the number of labels.
+        """
+
+        features = self.segment_features(audio_data)
+        if len(features) != len(labels):
+            raise ValueError(f"Found {len(features)} words in {name} but it is labelled with {len(labels)}.")
+        self.labels += labels
+        self.templates += features
+        self._centroids = None
+
+    def segment_features(self, audio_data):
+        """
+        Finds the words in a recording and computes the features of each.
+
+        Parameters:
+        audio_data (sr.AudioData): The recording.
+
+        Returns:
+        list: The MFCC features of each word, in order.
+        """
+
+        samples = np.frombuffer(audio_data.get_raw_data(convert_width=2), np.int16)
+        return [mfcc_features(samples[start:end], audio_data.sample_rate) for start, end in self.vad.find_segments(audio_data)]
+
+    @property
+    def digest(self):
+        """
+        str: A hash of the templates, so that cached transcripts are not reused once the templates change.
+        """
+
+        digest = hashlib.sha256(repr(self.labels).encode())
+        for features in self.templates:
+            digest.update(np.ascontiguousarray(features, dtype=np.float32).tobytes())
+        return digest.hexdigest()[:16]
+
+    def _stretch(self, features):
+        # Linear interpolation of every coefficient onto self.frames evenly spaced points in time
+        positions = np.linspace(0, len(features) - 1, self.frames)
+        lower = np.floor(positions).astype(int)
+        upper = np.minimum(lower + 1, len(features) - 1)
+        weight = (positions - lower)[:, None]
+        return ((1 - weight) * features[lower] + weight * features[upper]).ravel()
+
+    def classify(self, features, method='centroid', max_distance=None):
+        """
+        Labels words with the number of the closest template.
+
+        Parameters:
+        features (list): The MFCC features of each word.
+        method (str): 'centroid' to compare each word with the average template of each number, all at once, or
+        'dtw' to compare it with every template by dynamic time warping, which copes better with the speed of speech.
+        max_distance (float): The largest distance at which a word is labelled. Words further from every template are
+        dropped. None to label every word.
+
+        Returns:
+        list: The labels of the words that were close enough to a template, in order.
+
+        Raises:
+        ValueError: If the method is not recognised.
+        """
+
+        if not features:
+            return []
+        if method == 'centroid':
+            if self._centroids is None:
+                numbers = sorted(set(self.labels))
+                stretched = np.array([self._stretch(template) for template in self.templates])
+                labels = np.array(self.labels)
+                self._centroids = (np.array(numbers), np.array([stretched[labels == number].mean(axis=0) for number in numbers]))
+            numbers, centroids = self._centroids
+            words = np.array([self._stretch(word) for word in features])
+            distances = np.sqrt(np.square(words[:, None, :] - centroids[None, :, :]).sum(axis=2)) / np.sqrt(self.frames)
+        elif method == 'dtw':
+            numbers = np.array(self.labels)
+            distances = np.array([[dtw_distance(word, template) for template in self.templates] for word in features])
+        else:
+            raise ValueError(f"Unknown matching method '{method}'. Expected 'centroid' or 'dtw'.")
+        closest = distances.argmin(axis=1)
+        keep = np.ones(len(features), dtype=bool) if max_distance is None else distances[np.arange(len(features)), closest] <= max_distance
+        return numbers[closest[keep]].tolist()
+
+class TemplateBackend:
+    """
+    Recognises the numbers one to ten in this process, by matching each spoken word against a bank of recorded templates.
+
+    Only ten words ever need to be told apart, so no general-purpose speech recognizer is needed: the words are found
+    with voice activity detection and each is labelled with the closest template's number. Nothing is sent over the
+    network, and the same audio always gives the same transcript.
+    """
+
+    name = 'templates'
+
+    # Words are found in the whole recording, so it cannot be fed a chunk at a time
+    supports_streaming = False
+    streaming = False
+    preprocessor = None
+
+    def __init__(self, bank=None, method='centroid', max_distance=None):
+        """
+        Parameters:
+        bank (TemplateBank): The templates. Defaults to those loaded from templates_dir.
+        method (str): 'centroid' or 'dtw', as in TemplateBank.classify.
+        max_distance (float): The largest distance at which a word is labelled, as in TemplateBank.classify.
+
+        Raises:
+        ValueError: If the templates cannot be loaded, or the method is not recognised.
+        """
+
+        if method not in ('centroid', 'dtw'):
+            raise ValueError(f"Unknown matching method '{method}'. Expected 'centroid' or 'dtw'.")
+        self.bank = bank or TemplateBank.from_directory(templates_dir)
+        self.method = method
+        self.max_distance = max_distance
+
+    @property
+    def settings(self):
+        """
+        str: The settings that affect the transcript, for use in cache keys.
+        """
+
+        return f"{self.name}:{self.bank.digest}:{self.method}:{self.max_distance}"
+
+    def recognize(self, recognizer, audio_data):
+        """
+        Transcribes audio by matching its words against the templates.
+
+        Parameters:
+        recognizer (sr.Recognizer): Unused, accepted for compatibility with the other backends.
+        audio_data (sr.AudioData): The audio to transcribe.
+
+        Returns:
+        str: The recognised numbers as spaced digits (e.g. '1 2 3 10').
+
+        Raises:
+        sr.UnknownValueError: If no words were recognised.
+        """
+
+        numbers = self.bank.classify(self.bank.segment_features(audio_data), self.method, self.max_distance)
+        if not numbers:
+            raise sr.UnknownValueError()
+        return ' '.join(map(str, numbers))
+
+# Recognizer backends that can be selected from the command line
+backends = {GoogleBackend.name: GoogleBackend, VoskBackend.name: VoskBackend, TemplateBackend.name: TemplateBackend}
+
+# The backend used when none is given
+default_backend = GoogleBackend()
+
+def recognizer_settings(recognizer, backend=None, vad=None):
+    """
+    Describes the recognizer settings that affect the transcript, for use in cache keys.
+
+    Parameters:
+    recognizer (sr.Recognizer): The recognizer used to transcribe the audio.
+    backend (GoogleBackend or VoskBackend): The backend used to transcribe the audio. Defaults to default_backend.
+    vad (VoiceActivityDetector): The detector used to trim the audio, if any.
+
+    Returns:
+    str: The description of the recognizer settings.
+    """
+
+    settings = f"{type(recognizer).__name__}:{(backend or default_backend).settings}"
+    if vad is not None:
+        settings += f":{vad.settings}"
+    return settings
+
+def iter_audio_chunks(audio_file, chunk_frames=4096):
+    """
+    Reads an audio file a fixed number of frames at a time.
+
+    Only one chunk is held in memory at once, however long the recording is.
+
+    Parameters:
+    audio_file (str): The path of the audio file.
+    chunk_frames (int): The number of frames in each chunk.
+
+    Yields:
+    sr.AudioData: The consecutive chunks of the recording, as mono audio.
+    """
+
+    with sr.AudioFile(audio_file) as source:
+        while True:
+            buffer = source.stream.read(chunk_frames)
+            if not buffer:
+                break
+            yield sr.AudioData(buffer, source.SAMPLE_RATE, source.SAMPLE_WIDTH)
+
+class VoiceActivityDetector:
+    """
+    Finds the spoken words in a recording from the energy of short frames of audio.
+
+    A frame counts as speech when its mean energy is well above the recording's noise floor and above an absolute
+    minimum level. Runs of speech frames separated by less than min_silence_ms are merged into one word, and runs
+    shorter than min_speech_ms are dropped as clicks. All of the frame arithmetic is vectorised with NumPy.
+    """
+
+    def __init__(self, frame_ms=20, threshold=4.0, min_dbfs=-50.0, min_silence_ms=200, min_speech_ms=60, padding_ms=60, gap_ms=150):
+        """
+        Parameters:
+        frame_ms (int): The length of each analysis frame.
+        threshold (float): How many times the noise floor a frame's energy must be to count as speech.
+        min_dbfs (float): The minimum level of a speech frame, in decibels relative to full scale.
+        min_silence_ms (int): The shortest silence that separates two words.
+        min_speech_ms (int): The shortest run of speech that counts as a word.
+        padding_ms (int): The audio kept either side of each word.
+        gap_ms (int): The silence put between words when they are joined back together.
+        """
+
+        self.frame_ms = frame_ms
+        self.threshold = threshold
+        self.min_dbfs = min_dbfs
+        self.min_silence_ms = min_silence_ms
+        self.min_speech_ms = min_speech_ms
+        self.padding_ms = padding_ms
+        self.gap_ms = gap_ms
+
+    @property
+    def settings(self):
+        """
+        str: The settings that affect the audio sent to the recognizer, for use in cache keys.
+        """
+
+        return f"vad:{self.frame_ms}:{self.threshold}:{self.min_dbfs}:{self.min_silence_ms}:{self.min_speech_ms}:{self.padding_ms}:{self.gap_ms}"
+
+    def find_segments(self, audio_data):
+        """
+        Finds the word segments in a recording.
+
+        Parameters:
+        audio_data (sr.AudioData): The recording to search.
+
+        Returns:
+        list: The (start, end) sample offsets of each word, in order.
+        """
+
+        samples = np.frombuffer(audio_data.get_raw_data(convert_width=2), dtype='<i2')
+        frame_length = max(1, audio_data.sample_rate * self.frame_ms // 1000)
+        frame_count = len(samples) // frame_length
+        if frame_count == 0:
+            return []
+
+        frames = samples[:frame_count * frame_length].reshape(frame_count, frame_length).astype(np.float32)
+        energy = np.square(frames).mean(axis=1)
+        min_energy = (32768 * 10 ** (self.min_dbfs / 20)) ** 2
+        speech = energy > max(np.percentile(energy, 10) * self.threshold, min_energy)
+
+        # The edges of the runs of speech frames, as alternating start and end indices
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], speech.astype(np.int8), [0]))))
+        starts, ends = edges[0::2], edges[1::2]
+        if starts.size == 0:
+            return []
+
+        merge = (starts[1:] - ends[:-1]) * self.frame_ms < self.min_silence_ms
+        starts = np.concatenate((starts[:1], starts[1:][~merge]))
+        ends = np.concatenate((ends[:-1][~merge], ends[-1:]))
+        long_enough = (ends - starts) * self.frame_ms >= self.min_speech_ms
+        starts, ends = starts[long_enough], ends[long_enough]
+
+        padding = self.padding_ms // self.frame_ms
+        starts = np.maximum(starts - padding, 0) * frame_length
+        ends = np.minimum((ends + padding) * frame_length, len(samples))
+        return list(zip(starts.tolist(), ends.tolist()))
+
+    def trim(self, audio_data, segments):
+        """
+        Joins the word segments of a recording together, dropping the silence around and between them.
+
+        Parameters:
+        audio_data (sr.AudioData): The recording to trim.
+        segments (list): The (start, end) sample offsets of each word, as returned by find_segments.
+
+        Returns:
+        sr.AudioData: The words separated by gap_ms of silence.
+        """
+
+        width = audio_data.sample_width
+        gap = b'\x00' * (audio_data.sample_rate * self.gap_ms // 1000 * width)
+        frame_data = gap.join(audio_data.frame_data[start * width:end * width] for start, end in segments)
+        return sr.AudioData(frame_data, audio_data.sample_rate, width)
+
+@functools.lru_cache(maxsize=None)
+def _resampling_filter(up, down, half_taps=10):
+    """
+    Designs the polyphase low-pass filter for resampling by up/down.
+
+    The filter is a Kaiser-windowed sinc cut off at the Nyquist frequency of the lower of the two rates, like the
+    default of scipy.signal.resample_poly, so it removes the frequencies that would alias without the ringing of a
+    brick-wall cut.
+
+    Parameters:
+    up (int): The upsampling factor.
+    down (int): The downsampling factor.
+    half_taps (int): The number of zero crossings of the sinc on each side of its centre.
+
+    Returns:
+    tuple: The filter bank, with one row of taps for each of the up phases, and the delay of the filter.
+    """
+
+    rate = max(up, down)
+    half_len = half_taps * rate
+    offsets = np.arange(-half_len, half_len + 1)
+    taps = np.sinc(offsets / rate) * np.kaiser(len(offsets), 5.0)
+    # Each phase of the bank then has a gain of one
+    taps *= up / taps.sum()
+    columns = -(-len(taps) // up)
+    bank = np.zeros(columns * up)
+    bank[:len(taps)] = taps
+    return bank.reshape(columns, up).T.copy(), half_len
+
+def _resample_blocks(samples, up, down, block_size=4096):
+    """
+    Resamples samples by up/down with a polyphase filter, a block of output samples at a time, so that the memory
+    used on top of the input and output does not grow with the length of the recording.
+
+    Parameters:
+    samples (np.ndarray): The samples to resample.
+    up (int): The upsampling factor.
+    down (int): The downsampling factor.
+    block_size (int): The number of output samples computed at once.
+
+    Returns:
+    generator: The resampled samples, as float arrays of up to block_size samples.
+    """
+
+    bank, half_len = _resampling_filter(up, down)
+    taps = np.arange(bank.shape[1])
+    count = -(-len(samples) * up // down)
+    for start in range(0, count, block_size):
+        # Output sample n is centred on input position n * down / up
+        newest, phases = np.divmod(np.arange(start, min(start + block_size, count)) * down + half_len, up)
+        first, last = newest[0] - taps[-1], newest[-1] + 1
+        window = np.zeros(last - first)
+        valid_first, valid_last = max(first, 0), min(last, len(samples))
+        if valid_first < valid_last:
+            window[valid_first - first:valid_last - first] = samples[valid_first:valid_last]
+        yield np.einsum('ij,ij->i', window[(newest - first)[:, None] - taps], bank[phases])
+
+@functools.lru_cache(maxsize=None)
+def _flac_audio_data_class():
+    # Defined on first use, as speech_recognition is only imported then
+    class FlacAudioData(sr.AudioData):
+        """
+        Audio that carries its 16-bit FLAC encoding, made ahead of time by an AudioPreprocessor, for recognize_google
+        to upload instead of encoding the audio again.
+        """
+
+        def __init__(self, audio_data, flac_data):
+            super().__init__(audio_data.frame_data, audio_data.sample_rate, audio_data.sample_width)
+            self.flac_data = flac_data
+
+        def get_flac_data(self, convert_rate=None, convert_width=None):
+            # recognize_google asks for 16-bit FLAC at the audio's own rate, which is what was encoded
+            if convert_rate in (None, self.sample_rate) and convert_width in (None, 2) and self.sample_width == 2:
+                return self.flac_data
+            return super().get_flac_data(convert_rate, convert_width)
+
+    return FlacAudioData
+
+class AudioPreprocessor:
+    """
+    Converts audio to the sample rate and width the recognizer needs before it is sent, so that requests are smaller.
+
+    Samples are resampled with a polyphase windowed-sinc filter, which also removes the frequencies above the new
+    Nyquist limit, and requantised to the new width, a block at a time. Audio that is already in the target format
+    is passed through unchanged. With flac=True, the audio is also encoded to FLAC up front. That is the format
+    recognize_google uploads, so the encoded bytes are kept on the audio for recognize_google to reuse, and the
+    size of the upload can be reported.
+    """
+
+    def __init__(self, sample_rate=16000, sample_width=2, flac=False):
+        """
+        Parameters:
+        sample_rate (int): The sample rate to send, in Hz. Audio recorded at a lower rate is not upsampled. None to
+        keep the rate of each recording.
+        sample_width (int): The number of bytes per sample to send.
+        flac (bool): Whether to encode the audio to FLAC as part of preprocessing.
+        """
+
+        if sample_width not in (1, 2, 3, 4):
+            raise ValueError("sample_width must be 1, 2, 3 or 4 bytes")
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.flac = flac
+
+    @property
+    def settings(self):
+        """
+        str: The settings that affect the transcript, for use in cache keys.
+        """
+
+        return f"preprocess:{self.sample_rate}:{self.sample_width}"
+
+    def convert(self, audio_data):
+        """
+        Resamples and requantises audio to the target format.
+
+        Parameters:
+        audio_data (sr.AudioData): The audio to convert.
+
+        Returns:
+        sr.AudioData: The converted audio, or audio_data itself if it is already in the target format.
+        """
+
+        sample_rate = audio_data.sample_rate if self.sample_rate is None else min(self.sample_rate, audio_data.sample_rate)
+        if sample_rate == audio_data.sample_rate and self.sample_width == audio_data.sample_width:
+            return audio_data
+
+        # Read the samples as integers, and the factor that puts them on a 32-bit scale, whatever their width
+        width = audio_data.sample_width
+        if width == 3:
+            raw = np.frombuffer(audio_data.frame_data, np.uint8)[:len(audio_data.frame_data) // 3 * 3].reshape(-1, 3)
+            samples = raw[:, 0].astype(np.int32) << 8 | raw[:, 1].astype(np.int32) << 16 | raw[:, 2].astype(np.int32) << 24
+            scale = 1.0
+        else:
+            samples = np.frombuffer(audio_data.frame_data, {1: np.int8, 2: np.int16, 4: np.int32}[width])
+            scale = 2.0 ** (32 - 8 * width)
+        scale *= 2.0 ** (8 * self.sample_width - 32)
+
+        block_size = 4096
+        if sample_rate != audio_data.sample_rate:
+            divisor = math.gcd(sample_rate, audio_data.sample_rate)
+            up, down = sample_rate // divisor, audio_data.sample_rate // divisor
+            count = -(-len(samples) * up // down)
+            blocks = _resample_blocks(samples, up, down, block_size)
+        else:
+            count = len(samples)
+            blocks = (samples[start:start + block_size] for start in range(0, count, block_size))
+
+        limit = 2 ** (8 * self.sample_width - 1)
+        frame_data = np.empty(count * self.sample_width, np.uint8)
+        start = 0
+        for block in blocks:
+            quantised = np.clip(np.rint(block * scale), -limit, limit - 1)
+            end = start + len(quantised)
+            if self.sample_width == 3:
+                values = quantised.astype(np.int32)
+                frame_data[start * 3:end * 3] = np.stack([values & 0xFF, values >> 8 & 0xFF, values >> 16 & 0xFF], axis=1).reshape(-1)
+            else:
+                frame_data[start * self.sample_width:end * self.sample_width] = quantised.astype({1: np.int8, 2: np.int16, 4: np.int32}[self.sample_width]).view(np.uint8)
+            start = end
+        return sr.AudioData(frame_data.tobytes(), sample_rate, self.sample_width)
+
+    def preprocess(self, audio_data, metrics=None):
+        """
+        Converts audio before it is sent to the recognizer, counting the bytes it saves.
+
+        The bytes_saved counter is increased by the reduction in the size of the samples, and preprocessed_files by
+        one. With flac=True, upload_bytes is increased by the size of the FLAC data that will be uploaded.
+
+        Parameters:
+        audio_data (sr.AudioData): The decoded audio.
+        metrics (Metrics): The metrics to record the preprocessing time and counters in, if any.
+
+        Returns:
+        sr.AudioData: The audio to send to the recognizer.
+        """
+
+        metrics = metrics or null_metrics
+        with metrics.time('preprocess'):
+            converted = self.convert(audio_data)
+            if self.flac:
+                flac_data = converted.get_flac_data(convert_width=2)
+                # A new object, as convert returns audio_data itself when there is nothing to change
+                converted = _flac_audio_data_class()(converted, flac_data)
+        metrics.increment('preprocessed_files')
+        metrics.increment('bytes_saved', len(audio_data.frame_data) - len(converted.frame_data))
+        if self.flac:
+            metrics.increment('upload_bytes', len(flac_data))
+        return converted
+
+def get_word_segments(audio_file, vad=None):
+    """
+    Finds the start and end times of the words spoken in an audio file.
+
+    Parameters:
+    audio_file (str): The path of the audio file.
+    vad (VoiceActivityDetector): The detector to use. Defaults to one with the default settings.
+
+    Returns:
+    list: The (start, end) times of each word, in seconds.
+    """
+
+    vad = vad or VoiceActivityDetector()
+    audio_data = read_audio_file(audio_file)
+    return [(start / audio_data.sample_rate, end / audio_data.sample_rate) for start, end in vad.find_segments(audio_data)]
+
+class _StageTimer:
+    """
+    Adds the time spent inside a with block to one of a Metrics object's stages.
+    """
+
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.record(self.stage, time.perf_counter() - self.start)
+
+class Metrics:
+    """
+    Collects per-stage timings and counters for a run.
+
+    Stages are timed with "with metrics.time('decode'):" blocks, and counters are updated with increment. Both may
+    be used from several threads at once.
+    """
+
+    enabled = True
+
+    # Counters reported even when they stay at zero
+    counters = ('files', 'bytes', 'cache_hits', 'cache_misses', 'unintelligible', 'recognizer_errors', 'retries', 'failed_files')
+
+    def __init__(self):
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(self.counters, 0)
+        self._stages = {}
+        self._gauges = {}
+
+    def time(self, stage):
+        """
+        Returns a context manager that adds the time spent inside it to a stage.
+
+        Parameters:
+        stage (str): The name of the stage, e.g. 'decode' or 'recognize'.
+        """
+
+        return _StageTimer(self, stage)
+
+    def record(self, stage, seconds):
+        """
+        Adds one call of a stage that took the given number of seconds.
+
+        Parameters:
+        stage (str): The name of the stage.
+        seconds (float): The time the call took.
+        """
+
+        with self._lock:
+            calls, total, longest = self._stages.get(stage, (0, 0.0, 0.0))
+            self._stages[stage] = (calls + 1, total + seconds, max(longest, seconds))
+
+    def increment(self, counter, amount=1):
+        """
+        Adds to a counter.
+
+        Parameters:
+        counter (str): The name of the counter, e.g. 'files' or 'cache_hits'.
+        amount (int): The amount to add.
+        """
+
+        with self._lock:
+            self._counts[counter] = self._counts.get(counter, 0) + amount
+
+    def gauge(self, name, value):
+        """
+        Sets a gauge, a value that is replaced rather than added to, such as the peak depth of a queue.
+
+        Parameters:
+        name (str): The name of the gauge, e.g. 'queue_decoded_peak_bytes'.
+        value (float): The value.
+        """
+
+        with self._lock:
+            self._gauges[name] = value
+
+    def snapshot(self):
+        """
+        Returns the current values of the counters and stages.
+
+        Returns:
+        dict: The elapsed seconds, the counters, the gauges, and the calls, total and maximum seconds of each stage.
+        """
+
+        with self._lock:
+            return {
+                'started': self.started,
+                'elapsed_seconds': time.perf_counter() - self._start,
+                'counters': dict(self._counts),
+                'gauges': dict(self._gauges),
+                'stages': {stage: {'calls': calls, 'total_seconds': total, 'max_seconds': longest} for stage, (calls, total, longest) in self._stages.items()},
+            }
+
+    def summary(self):
+        """
+        Formats the metrics as a human-readable end-of-run summary.
+
+        Returns:
+        str: The summary, one line per counter and stage.
+        """
+
+        snapshot = self.snapshot()
+        elapsed = snapshot['elapsed_seconds']
+        lines = [f"Run time: {elapsed:.2f}s ({snapshot['counters']['files'] / elapsed if elapsed else 0:.1f} files/s)"]
+        lines += [f"{counter}: {value}" for counter, value in snapshot['counters'].items()]
+        lines += [f"{name}: {value}" for name, value in snapshot['gauges'].items()]
+        for stage, stats in snapshot['stages'].items():
+            mean_ms = stats['total_seconds'] / stats['calls'] * 1000
+            lines.append(f"{stage}: {stats['total_seconds']:.2f}s total, {stats['calls']} calls, {mean_ms:.2f}ms mean, {stats['max_seconds'] * 1000:.2f}ms max")
+        if snapshot['counters'].get('preprocessed_files'):
+            lines.append(f"Bytes saved per file: {snapshot['counters']['bytes_saved'] / snapshot['counters']['preprocessed_files']:.0f}")
+        return '\n'.join(lines)
+
+    def to_prometheus(self):
+        """
+        Formats the metrics in the Prometheus text exposition format.
+
+        Returns:
+        str: The metrics, ready to be written to a file for the node exporter's textfile collector.
+        """
+
+        snapshot = self.snapshot()
+        lines = ['# TYPE audio_run_seconds gauge', f"audio_run_seconds {snapshot['elapsed_seconds']}"]
+        for counter, value in snapshot['counters'].items():
+            lines += [f"# TYPE audio_{counter}_total counter", f"audio_{counter}_total {value}"]
+        for name, value in snapshot['gauges'].items():
+            lines += [f"# TYPE audio_{name} gauge", f"audio_{name} {value}"]
+        for name, key, kind in (('audio_stage_calls_total', 'calls', 'counter'), ('audio_stage_seconds_total', 'total_seconds', 'counter'), ('audio_stage_max_seconds', 'max_seconds', 'gauge')):
+            lines.append(f"# TYPE {name} {kind}")
+            for stage, stats in snapshot['stages'].items():
+                lines.append(f'{name}{{stage="{stage}"}} {stats[key]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, format='prometheus'):
+        """
+        Writes the metrics to a file.
+
+        Prometheus output replaces the file, while JSON lines output appends one line per run.
+
+        Parameters:
+        path (str): The file to write to.
+        format (str): 'prometheus' or 'jsonl'.
+
+        Raises:
+        ValueError: If the format is not recognised.
+        """
+
+        if format == 'prometheus':
+            with open(f"{path}.tmp", 'w') as f:
+                f.write(self.to_prometheus())
+            os.replace(f"{path}.tmp", path)
+        elif format == 'jsonl':
+            with open(path, 'a') as f:
+                f.write(json.dumps(self.snapshot()) + '\n')
+        else:
+            raise ValueError(f"Unknown metrics format '{format}'. Expected 'prometheus' or 'jsonl'.")
+
+class NullMetrics:
+    """
+    A stand-in for Metrics that records nothing, used when instrumentation is off.
+    """
+
+    enabled = False
+
+    _timer = contextlib.nullcontext()
+
+    def time(self, stage):
+        return self._timer
+
+    def record(self, stage, seconds):
+        pass
+
+    def increment(self, counter, amount=1):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+# The metrics used when none are given
+null_metrics = NullMetrics()
+
+def get_default_recognizer():
+    """
+    Returns the shared recognizer, creating it on first use.
+
+    Returns:
+    sr.Recognizer: The module-level recognizer, also available as r once created.
+    """
+
+    global r
+    try:
+        return r
+    except NameError:
+        with _recognizer_lock:
+            if 'r' not in globals():
+                r = sr.Recognizer()
+        return r
+
+def __getattr__(name):
+    # Lets other modules use script.r before anything in the script has needed the recognizer
+    if name == 'r':
+        return get_default_recognizer()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def get_recognizer(base=None):
+    """
+    Returns a recognizer that is safe to use from the calling thread.
+
+    The main thread uses the shared recognizer directly. Worker threads each get their own shallow copy of it, so
+    they share its settings but never mutate the same instance concurrently.
+
+    Parameters:
+    base (sr.Recognizer): The recognizer to share. Defaults to the module-level recognizer.
+
+    Returns:
+    sr.Recognizer: The recognizer to use in the calling thread.
+    """
+
+    base = base if base is not None else get_default_recognizer()
+    if threading.current_thread() is threading.main_thread():
+        return base
+    recognizers = _thread_local.__dict__.setdefault('recognizers', {})
+    if id(base) not in recognizers:
+        recognizers[id(base)] = copy.copy(base)
+    return recognizers[id(base)]
+
+def read_wav_file(audio_file, map_file=True):
+    """
+    Reads a mono PCM WAV file without copying its samples, by parsing the RIFF header and memory-mapping the file.
+
+    The returned audio's frame data is a read-only memoryview over the mapping, so a NumPy view of the samples
+    (np.frombuffer(audio_data.frame_data, '<i2')) costs no copy either, and any conversion of the sample rate or width
+    only happens when a backend asks for it through get_raw_data. The file stays mapped until the last view of it is
+    released. Reading a mapping past the end of a file that has since been truncated kills the process with SIGBUS,
+    which cannot be caught, so files that may be rewritten while they are in use are read into memory instead.
+
+    Parameters:
+    audio_file (str): The path of the audio file.
+    map_file (bool): Whether to map the file. False to read it, for files that may be truncated or rewritten.
+
+    Returns:
+    sr.AudioData: The audio, or None if the file is not a mono WAV file of 16, 24 or 32-bit integer samples. The
+    8-bit samples of WAV files are unsigned and stereo files need mixing down, so both need converting when read.
+    """
+
+    with open(audio_file, 'rb') as f:
+        if not map_file:
+            mapping = f.read()
+        else:
+            try:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped
+                return None
+    if len(mapping) < 12 or mapping[:4] != b'RIFF' or mapping[8:12] != b'WAVE':
+        if map_file:
+            mapping.close()
+        return None
+
+    audio_format = None
+    offset = 12
+    while offset + 8 <= len(mapping):
+        chunk_id = mapping[offset:offset + 4]
+        size, = struct.unpack_from('<I', mapping, offset + 4)
+        start = offset + 8
+        if chunk_id == b'fmt ' and size >= 16:
+            format_tag, channels, sample_rate, _, block_align, bits = struct.unpack_from('<HHIIHH', mapping, start)
+            if format_tag == 0xFFFE and size >= 40:
+                # WAVE_FORMAT_EXTENSIBLE keeps the real format in the first two bytes of its subformat GUID
+                format_tag, = struct.unpack_from('<H', mapping, start + 24)
+            audio_format = format_tag, channels, sample_rate, block_align, bits
+        elif chunk_id == b'data' and audio_format is not None:
+            format_tag, channels, sample_rate, block_align, bits = audio_format
+            if format_tag != 1 or channels != 1 or block_align not in (2, 3, 4) or bits != 8 * block_align or sample_rate == 0:
+                break
+            # Writers that were interrupted, or stream, can leave a size larger than the file
+            length = min(size, len(mapping) - start) // block_align * block_align
+            return sr.AudioData(memoryview(mapping)[start:start + length], sample_rate, block_align)
+        offset = start + size + (size & 1)
+    if map_file:
+        mapping.close()
+    return None
+
+def read_audio_file(audio_file, recognizer=None, map_file=True):
+    """
+    Reads a whole audio file, through read_wav_file where possible and sr.AudioFile otherwise.
+
+    Parameters:
+    audio_file (str): The path of the audio file.
+    recognizer (sr.Recognizer): The recognizer to record other formats with. Defaults to the shared recognizer.
+    map_file (bool): Whether WAV files may be memory-mapped, as in read_wav_file.
+
+    Returns:
+    sr.AudioData: The audio, as sr.AudioFile would have read it.
+    """
+
+    audio_data = read_wav_file(audio_file, map_file)
+    if audio_data is None:
+        with sr.AudioFile(audio_file) as source:
+            audio_data = (recognizer or get_default_recognizer()).record(source)
+    return audio_data
+
+def decode_audio_file(audio_file, recognizer=None, vad=None, metrics=None, map_file=True):
+    """
+    Decodes an audio file in the current process, trimming the silence from it when a voice activity detector is given.
+
+    Parameters:
+    audio_file (str): The path of the audio file.
+    recognizer (sr.Recognizer): The recognizer to decode the audio with. Defaults to the shared recognizer.
+    vad (VoiceActivityDetector): The detector used to trim the silence from the audio, if any.
+    metrics (Metrics): The metrics to record stage timings in, if any.
+    map_file (bool): Whether WAV files may be memory-mapped, as in read_wav_file.
+
+    Returns:
+    tuple: The decoded audio, whether it contains any speech, and the (start, end) frames of each word in the
+    untrimmed audio, or None without a voice activity detector.
+    """
+
+    metrics = metrics or null_metrics
+    with metrics.time('decode'):
+        audio_data = read_audio_file(audio_file, recognizer, map_file)
+    if vad is None:
+        return audio_data, True, None
+    with metrics.time('vad'):
+        segments = vad.find_segments(audio_data)
+        audio_data = vad.trim(audio_data, segments)
+    return audio_data, bool(segments), segments
+
+def _decode_to_shared_memory(audio_file, vad=None, map_file=True):
+    """
+    Decodes an audio file in a worker process of a ProcessDecoder and copies the samples into a new shared memory block.
+
+    The block is left for the parent process to read and unlink, so only its name crosses the process boundary. The
+    workers share the parent's resource tracker, which forgets the block when the parent unlinks it.
+
+    Returns:
+    tuple: The name of the block, the number of bytes of audio, the sample rate, the sample width, whether the audio
+    contains any speech, the word segments as in decode_audio_file, and the seconds spent decoding and detecting
+    voice activity.
+    """
+
+    start = time.perf_counter()
+    audio_data = read_audio_file(audio_file, map_file=map_file)
+    decoded = time.perf_counter()
+    has_speech = True
+    segments = None
+    if vad is not None:
+        segments = vad.find_segments(audio_data)
+        audio_data = vad.trim(audio_data, segments)
+        has_speech = bool(segments)
+    timings = (decoded - start, time.perf_counter() - decoded if vad is not None else None)
+
+    frame_data = audio_data.frame_data
+    block = shared_memory.SharedMemory(create=True, size=max(len(frame_data), 1))
+    try:
+        block.buf[:len(frame_data)] = frame_data
+    finally:
+        block.close()
+    return block.name, len(frame_data), audio_data.sample_rate, audio_data.sample_width, has_speech, segments, timings
+
+@functools.lru_cache(maxsize=None)
+def _attached_block_class():
+    # Defined on first use, as the shared_memory module is only imported then
+    class AttachedBlock(shared_memory.SharedMemory):
+        """
+        A shared memory block whose samples may still be in use when the interpreter exits, in which case the
+        mapping is left to the operating system instead of raising an error from the destructor.
+        """
+
+        def __del__(self):
+            with contextlib.suppress(BufferError):
+                super().__del__()
+
+    return AttachedBlock
+
+class ProcessDecoder:
+    """
+    Decodes audio files, and trims their silence, on a pool of worker processes so that the CPU-bound work is not
+    serialised by the GIL.
+
+    Each worker writes the decoded samples into a shared memory block and returns only its name. The calling thread
+    gets the samples as a read-only view of the block, without copying them, and the block is closed once nothing
+    refers to them any more. Recognition, caching and writing stay in the parent process, so a ProcessDecoder
+    can be passed as the decoder of analyse_audio_file and is safe to call from several threads. Each call decodes
+    one file, so main runs at least as many workers as there are processes to keep them all busy.
+    """
+
+    def __init__(self, workers=None, map_files=True):
+        """
+        Parameters:
+        workers (int): The number of worker processes. Defaults to the number of CPUs.
+        map_files (bool): Whether the workers may memory-map WAV files, as in read_wav_file. False for files that may
+        be rewritten while they are decoded.
+        """
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.workers = workers or os.cpu_count() or 1
+        self.map_files = map_files
+        # Started before the workers, so that they register their blocks with it rather than with trackers of their own
+        resource_tracker.ensure_running()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._blocks = []
+        self._lock = threading.Lock()
+
+    def __call__(self, audio_file, recognizer=None, vad=None, metrics=None):
+        """
+        Decodes an audio file on a worker process. Takes the same arguments and returns the same values as decode_audio_file.
+
+        The recognizer is not sent to the worker: decoding only depends on the file.
+        """
+
+        metrics = metrics or null_metrics
+        name, size, sample_rate, sample_width, has_speech, segments, (decode_seconds, vad_seconds) = self.executor.submit(_decode_to_shared_memory, audio_file, vad, self.map_files).result()
+        block = _attached_block_class()(name=name)
+        # The mapping outlives the name, so the block is only kept until the samples are no longer used
+        block.unlink()
+        frame_data = block.buf[:size].toreadonly()
+        with self._lock:
+            self._close_unused_blocks()
+            self._blocks.append(block)
+        metrics.record('decode', decode_seconds)
+        if vad_seconds is not None:
+            metrics.record('vad', vad_seconds)
+        return sr.AudioData(frame_data, sample_rate, sample_width), has_speech, segments
+
+    def _close_unused_blocks(self):
+        # A block cannot be closed while views of its samples exist, and closing it again later is safe
+        blocks = []
+        for block in self._blocks:
+            try:
+                block.close()
+            except BufferError:
+                blocks.append(block)
+        self._blocks = blocks
+
+    def close(self):
+        """
+        Shuts down the worker processes, and closes the blocks whose samples are no longer in use.
+        """
+
+        self.executor.shutdown()
+        with self._lock:
+            self._close_unused_blocks()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def prepare_audio_file(filename, recognizer, directory=None, cache=None, backend=None, vad=None, metrics=None, decoder=None):
+    """
+    Gets an audio file ready for recognition, by looking up its cached transcript or decoding its audio.
+
+    Parameters:
+    filename (str): The filename of the audio file.
+    recognizer (sr.Recognizer): The recognizer to decode the audio with.
+    directory (str): The directory containing the audio file. Defaults to audio_dir.
+    cache (TranscriptCache): The cache of raw transcripts to use, if any.
+    backend (GoogleBackend or VoskBackend): The backend that will transcribe the audio. Defaults to default_backend.
+    vad (VoiceActivityDetector): The detector used to trim the silence from the audio, if any.
+    metrics (Metrics): The metrics to record stage timings and counters in, if any.
+    decoder (ProcessDecoder): The decoder to use instead of decode_audio_file, if any.
+
+    Returns:
+    tuple: The path of the audio file, its cached transcript (or None), its cache key (or None), the decoded audio
+    (None for streaming backends or when the transcript is cached), whether the audio contains any speech, and the
+    word segments found by the voice activity detector (None when it did not run).
+    """
+
+    backend = backend or default_backend
+    metrics = metrics or null_metrics
+    audio_file = os.path.join(directory or audio_dir, filename)
+    text = cache_key = audio_data = segments = None
+    has_speech = True
+
+    metrics.increment('files')
+    if metrics.enabled:
+        metrics.increment('bytes', os.path.getsize(audio_file))
+
+    if cache is not None:
+        with metrics.time('cache'):
+            cache_key = cache.file_key(audio_file, recognizer_settings(recognizer, backend, vad))
+            text = cache.get(cache_key)
+        metrics.increment('cache_misses' if text is None else 'cache_hits')
+
+    if text is None and not backend.streaming:
+        audio_data, has_speech, segments = (decoder or decode_audio_file)(audio_file, recognizer, vad, metrics)
+        preprocessor = getattr(backend, 'preprocessor', None)
+        if has_speech and preprocessor is not None:
+            audio_data = preprocessor.preprocess(audio_data, metrics)
+
+    return audio_file, text, cache_key, audio_data, has_speech, segments
+
+def recognize_audio(audio_file, audio_data, recognizer, backend=None, metrics=None):
+    """
+    Sends audio prepared by prepare_audio_file to the backend.
+
+    Parameters:
+    audio_file (str): The path of the audio file, read a chunk at a time by streaming backends.
+    audio_data (sr.AudioData): The decoded audio, for backends that take the whole recording.
+    recognizer (sr.Recognizer): The recognizer to send the request with.
+    backend (GoogleBackend or VoskBackend): The backend that transcribes the audio. Defaults to default_backend.
+    metrics (Metrics): The metrics to record the recognition time in, if any.
+
+    Returns:
+    str: The transcript.
+
+    Raises:
+    sr.UnknownValueError: If the speech is unintelligible.
+    sr.RequestError: If the request to the backend fails.
+    """
+
+    backend = backend or default_backend
+    with (metrics or null_metrics).time('recognize'):
+        if backend.streaming:
+            return backend.recognize_stream(iter_audio_chunks(audio_file, backend.chunk_frames))
+        return backend.recognize(recognizer, audio_data)
+
+def finish_audio_file(filename, text, metrics=None, segments=None):
+    """
+    Analyses the transcript of an audio file into a result.
+
+    When the word segments found by voice activity detection are given, the number of words heard is added to the
+    'spoken_words' counter, so that it can be compared with the audible words that were recognised.
+
+    Parameters:
+    filename (str): The filename of the audio file.
+    text (str): The transcript, or None if the audio could not be recognised.
+    metrics (Metrics): The metrics to record stage timings and counters in, if any.
+    segments (list): The (start, end) frames of each word found by the voice activity detector, if it ran.
+
+    Returns:
+    AudioResult: The filename, timestamp, count of audible words, words out of order flag and longest consecutive count.
+    """
+
+    metrics = metrics or null_metrics
+    timestamp_iso8601 = get_timestamp(os.path.basename(filename)) or "None"
+    if segments is not None:
+        metrics.increment('spoken_words', len(segments))
+
+    try:
+        if text is None:
+            raise sr.UnknownValueError()
+        with metrics.time('parse'):
+            text_array_int = parse_transcript(text)
+        with metrics.time('analyse'):
+            count_of_audible_words = len(text_array_int)
+            longest_consecutive_count, words_out_of_order = find_longest_consecutive_count_and_order(text_array_int)
+        return AudioResult(filename, timestamp_iso8601, count_of_audible_words, words_out_of_order, longest_consecutive_count)
+    except Exception:
+        metrics.increment('failed_files')
+        return AudioResult(filename, timestamp_iso8601, 0, False, 0)
+
+def analyse_audio_file(filename, recognizer=None, directory=None, cache=None, backend=None, vad=None, metrics=None, decoder=None):
+    """
+    Transcribes an audio file and analyses the transcribed numbers.
+
+    When a cache is given, the audio is only decoded and sent to the recognizer if its transcript is not cached.
+    Failed recognitions are not cached, so they are retried on the next run. Streaming backends are given the audio
+    a chunk at a time rather than the whole recording. When a voice activity detector is given, only the words it
+    finds are sent to the backend, and a recording with no words is not sent at all.
+
+    Parameters:
+    filename (str): The filename of the audio file to analyse.
+    recognizer (sr.Recognizer): The recognizer to use. Defaults to the shared recognizer.
+    directory (str): The directory containing the audio file. Defaults to audio_dir.
+    cache (TranscriptCache): The cache of raw transcripts to use, if any.
+    backend (GoogleBackend or VoskBackend): The backend that transcribes the audio. Defaults to default_backend.
+    vad (VoiceActivityDetector): The detector used to trim the silence from the audio, if any.
+    metrics (Metrics): The metrics to record stage timings and counters in, if any.
+    decoder (ProcessDecoder): The decoder that decodes the audio on worker processes, if any.
+
+    Returns:
+    AudioResult: The filename, timestamp, count of audible words, words out of order flag and longest consecutive count.
+    """
+
+    recognizer = get_recognizer(recognizer)
+    metrics = metrics or null_metrics
+    audio_file, text, cache_key, audio_data, has_speech, segments = prepare_audio_file(filename, recognizer, directory, cache, backend, vad, metrics, decoder)
+
+    if text is None and has_speech:
+        try:
+            text = recognize_audio(audio_file, audio_data, recognizer, backend, metrics)
+        except sr.UnknownValueError:
+            metrics.increment('unintelligible')
+        except Exception:
+            metrics.increment('recognizer_errors')
+        else:
+            if cache is not None:
+                cache.put(cache_key, text)
+
+    return finish_audio_file(filename, text, metrics, segments)
+
+def report_progress(processed_files, total_files):
+    """
+    Prints the percentage of files processed so far.
+
+    Parameters:
+    processed_files (int): The number of files that have been processed.
+    total_files (int): The total number of files to process.
+    """
+
+    percentage_complete = round((processed_files / total_files) * 100, 2)
+    print(f"Processing: {percentage_complete}% complete")
+
+def process_audio_file(filename, output_file, processed_files, total_files, recognizer=None, directory=None, cache=None, backend=None, vad=None, metrics=None, decoder=None):
+    """
+    Processes an audio file and writes the results to a CSV file.
+
+    Parameters:
+    filename (str): The filename of the audio file to process.
+    output_file (str or a result sink): The filename of the CSV file to append the results to, or an open sink.
+    processed_files (int): The number of files that have already been processed.
+    total_files (int): The total number of files to process.
+    recognizer (sr.Recognizer): The recognizer to use. Defaults to the shared recognizer.
+    directory (str): The directory containing the audio file. Defaults to audio_dir.
+    cache (TranscriptCache): The cache of raw transcripts to use, if any.
+    backend (GoogleBackend or VoskBackend): The backend that transcribes the audio. Defaults to default_backend.
+    vad (VoiceActivityDetector): The detector used to trim the silence from the audio, if any.
+    metrics (Metrics): The metrics to record stage timings and counters in, if any.
+    decoder (ProcessDecoder): The decoder that decodes the audio on worker processes, if any.
+
+    Returns:
+    int: The updated number of processed files.
+    """
+
+    if not filename.endswith(".wav"):
+        return processed_files
+
+    metrics = metrics or null_metrics
+    result = analyse_audio_file(filename, recognizer, directory, cache, backend, vad, metrics, decoder)
+    with metrics.time('write'):
+        if isinstance(output_file, result_sinks):
+            output_file.write(result)
+        else:
+            with CsvResultSink(output_file) as sink:
+                sink.write(result)
+
+    processed_files += 1
+    report_progress(processed_files, total_files)
+
+    return processed_files  # return the updated value
+
+def process_audio_files_concurrently(filenames, sink, total_files, workers, recognizer=None, directory=None, cache=None, backend=None, vad=None, metrics=None, decoder=None):
+    """
+    Processes audio files on a bounded pool of worker threads and writes the results to a CSV file.
+
+    Recognition runs concurrently, but rows are written in the order of filenames. Completed results that are
+    waiting on an earlier file are held back, and no new file is submitted while more than twice the number of
+    workers are in flight or held back, so memory stays bounded when a single file is slow.
+
+    Parameters:
+    filenames (list): The filenames of the .wav files to process, in the order the rows should be written.
+    sink (CsvResultSink, ParquetResultSink or ResultTable): The sink to write the results to.
+    total_files (int): The total number of files to process.
+    workers (int): The number of worker threads.
+    recognizer (sr.Recognizer): The recognizer to share between workers. Defaults to the shared recognizer.
+    directory (str): The directory containing the audio files. Defaults to audio_dir.
+    cache (TranscriptCache): The cache of raw transcripts to use, if any.
+    backend (GoogleBackend or VoskBackend): The backend shared by the workers. Defaults to default_backend.
+    vad (VoiceActivityDetector): The detector used to trim the silence from the audio, if any.
+    metrics (Metrics): The metrics to record stage timings and counters in, if any.
+    decoder (ProcessDecoder): The decoder that decodes the audio on worker processes, if any.
+
+    Returns:
+    int: The number of processed files.
+    """
+
+    metrics = metrics or null_metrics
+    window = workers * 2
+    processed_files = 0
+    next_to_submit = 0
+    next_to_write = 0
+    in_flight = {}
+    completed = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while next_to_write < len(filenames):
+            while next_to_submit < len(filenames) and next_to_submit < next_to_write + window:
+                future = executor.submit(analyse_audio_file, filenames[next_to_submit], recognizer, directory, cache, backend, vad, metrics, decoder)
+                in_flight[future] = next_to_submit
+                next_to_submit += 1
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                completed[in_flight.pop(future)] = future.result()
+                processed_files += 1
+                report_progress(processed_files, total_files)
+
+            while next_to_write in completed:
+                with metrics.time('write'):
+                    sink.write(completed.pop(next_to_write))
+                next_to_write += 1
+
+    return processed_files
+
+transient_http_codes = {408, 429, 500, 502, 503, 504}
+
+def is_transient_error(error):
+    """
+    Checks whether a failed recognition is worth retrying.
+
+    Timeouts, dropped connections, rate limiting (429) and server errors (5xx) are transient. Unintelligible audio,
+    rejected requests and bad credentials fail the same way every time, so they are not retried.
+
+    Parameters:
+    error (Exception): The error raised by the backend.
+
+    Returns:
+    bool: True if the request may succeed when retried.
+    """
+
+    if isinstance(error, sr.UnknownValueError):
+        return False
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    if isinstance(error, sr.RequestError):
+        # recognize_google wraps the urllib error, which is left as the context of the RequestError
+        cause = error.__cause__ or error.__context__
+        if isinstance(cause, HTTPError):
+            return cause.code in transient_http_codes
+        return isinstance(cause, (URLError, TimeoutError, ConnectionError))
+    return False
+
+def backoff_delay(attempt, base=0.5, maximum=30.0):
+    """
+    Picks how long to wait before retrying, using exponential backoff with full jitter.
+
+    Parameters:
+    attempt (int): The number of attempts that have already failed, starting at 1.
+    base (float): The delay ceiling after the first failure, in seconds.
+    maximum (float): The largest delay ceiling, in seconds.
+
+    Returns:
+    float: A random delay between 0 and min(maximum, base * 2 ** (attempt - 1)) seconds.
+    """
+
+    return random.uniform(0, min(maximum, base * 2 ** (attempt - 1)))
+
+class TokenBucket:
+    """
+    Limits how often requests are sent: tokens are added at a fixed rate up to a burst capacity, and each request
+    waits until it can take one.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        Parameters:
+        rate (float): The number of requests allowed per second.
+        capacity (float): The number of requests that may be sent at once after an idle period. Defaults to 1.
+        """
+
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity or 1
+        self.tokens = self.capacity
+        self.updated = None
+        self.lock = None
+
+    async def acquire(self):
+        """
+        Waits until a request may be sent, then takes a token.
+        """
+
+        # The lock is created on first use so that it belongs to the running event loop
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if self.updated is not None:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class AsyncEngine:
+    """
+    Recognises audio files on an asyncio event loop, with a cap on the requests in flight, an optional rate limit,
+    a timeout on each request and retries with jittered exponential backoff for transient failures.
+
+    Decoding and the blocking recognizer calls run on a thread pool the size of the concurrency limit; the event
+    loop only schedules them, so the number of open requests and their rate are controlled in one place. The timeout
+    is the socket timeout of the recognizer, so a request that times out has stopped before it is retried, and never
+    keeps a thread busy alongside its retry.
+    """
+
+    def __init__(self, concurrency=8, rate=None, retries=3, timeout=None, backoff_base=0.5, backoff_max=30.0):
+        """
+        Parameters:
+        concurrency (int): The maximum number of files being recognised at once.
+        rate (float): The maximum number of recognition requests per second, including retries. None for no limit.
+        retries (int): The number of times a request that failed with a transient error is retried.
+        timeout (float): The number of seconds to wait for each request before retrying it, set as the recognizer's
+        operation_timeout. None to keep the recognizer's own timeout. Backends that do not make requests ignore it.
+        backoff_base (float): The delay ceiling after the first failure, in seconds.
+        backoff_max (float): The largest delay ceiling, in seconds.
+        """
+
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self.concurrency = concurrency
+        self.rate = rate
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def run(self, filenames, sink, total_files, recognizer=None, directory=None, cache=None, backend=None, vad=None, metrics=None, decoder=None):
+        """
+        Processes audio files and writes the results to a CSV file in the order of filenames.
+
+        Parameters:
+        filenames (list): The filenames of the .wav files to process, in the order the rows should be written.
+        sink (CsvResultSink, ParquetResultSink or ResultTable): The sink to write the results to.
+        total_files (int): The total number of files to process.
+        recognizer (sr.Recognizer): The recognizer to copy for each thread. Defaults to the shared recognizer.
+        directory (str): The directory containing the audio files. Defaults to audio_dir.
+        cache (TranscriptCache): The cache of raw transcripts to use, if any.
+        backend (GoogleBackend or VoskBackend): The backend that transcribes the audio. Defaults to default_backend.
+        vad (VoiceActivityDetector): The detector used to trim the silence from the audio, if any.
+        metrics (Metrics): The metrics to record stage timings and counters in, if any.
+        decoder (ProcessDecoder): The decoder that decodes the audio on worker processes, if any.
+
+        Returns:
+        int: The number of processed files.
+        """
+
+        if self.timeout is not None:
+            # A copy, so the timeout only applies to this engine's requests
+            recognizer = copy.copy(recognizer if recognizer is not None else get_default_recognizer())
+            recognizer.operation_timeout = self.timeout
+        return asyncio.run(self._run(filenames, sink, total_files, recognizer, directory, cache, backend, vad, metrics or null_metrics, decoder))
+
+    async def _run(self, filenames, sink, total_files, recognizer, directory, cache, backend, vad, metrics, decoder):
+        limiter = TokenBucket(self.rate) if self.rate else None
+        window = self.concurrency * 2
+        processed_files = 0
+        next_to_submit = 0
+        next_to_write = 0
+        in_flight = {}
+        completed = {}
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while next_to_write < len(filenames):
+                while next_to_submit < len(filenames) and next_to_submit < next_to_write + window:
+                    task = asyncio.ensure_future(self._analyse(executor, limiter, filenames[next_to_submit], recognizer, directory, cache, backend, vad, metrics, decoder))
+                    in_flight[task] = next_to_submit
+                    next_to_submit += 1
+
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    completed[in_flight.pop(task)] = task.result()
+                    processed_files += 1
+                    report_progress(processed_files, total_files)
+
+                while next_to_write in completed:
+                    with metrics.time('write'):
+                        sink.write(completed.pop(next_to_write))
+                    next_to_write += 1
+
+        return processed_files
+
+    async def _analyse(self, executor, limiter, filename, recognizer, directory, cache, backend, vad, metrics, decoder):
+        loop = asyncio.get_running_loop()
+        audio_file, text, cache_key, audio_data, has_speech, segments = await loop.run_in_executor(
+            executor, lambda: prepare_audio_file(filename, get_recognizer(recognizer), directory, cache, backend, vad, metrics, decoder))
+
+        if text is None and has_speech:
+            try:
+                text = await self._recognize(loop, executor, limiter, audio_file, audio_data, recognizer, backend, metrics)
+            except sr.UnknownValueError:
+                metrics.increment('unintelligible')
+            except Exception:
+                metrics.increment('recognizer_errors')
+            else:
+                if cache is not None:
+                    cache.put(cache_key, text)
+
+        return finish_audio_file(filename, text, metrics, segments)
+
+    async def _recognize(self, loop, executor, limiter, audio_file, audio_data, recognizer, backend, metrics):
+        def send():
+            return recognize_audio(audio_file, audio_data, get_recognizer(recognizer), backend, metrics)
+
+        attempt = 0
+        while True:
+            if limiter is not None:
+                await limiter.acquire()
+            try:
+                return await loop.run_in_executor(executor, send)
+            except Exception as e:
+                attempt += 1
+                if attempt > self.retries or not is_transient_error(e):
+                    raise
+                metrics.increment('retries')
+                await asyncio.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_max))
+
+class BoundedQueue:
+    """
+    A first-in, first-out queue between two pipeline stages, bounded by both the number of items and their total size.
+
+    put blocks while the queue is full and get while it is empty, so a fast stage waits for a slow one instead of
+    piling up work in memory. An item larger than max_bytes is still let into an empty queue, so that it cannot
+    block the pipeline forever. The time spent blocked is recorded in the metrics as the '<name>_full' and
+    '<name>_empty' stages. Once the queue is closed, put drops its item and get returns None when the queue is empty.
+    """
+
+    def __init__(self, name, max_items, max_bytes=None, metrics=None):
+        """
+        Parameters:
+        name (str): The name of the queue in the metrics and in stats.
+        max_items (int): The maximum number of items in the queue.
+        max_bytes (int): The maximum total size of the items in the queue, in bytes. None for no limit.
+        metrics (Metrics): The metrics to record the time spent blocked in, if any.
+
+        Raises:
+        ValueError: If max_items or max_bytes is less than 1.
+        """
+
+        if max_items < 1 or (max_bytes is not None and max_bytes < 1):
+            raise ValueError("A queue must have room for at least one item and one byte")
+        self.name = name
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.metrics = metrics or null_metrics
+        self._items = deque()
+        self._bytes = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self.peak_items = 0
+        self.peak_bytes = 0
+        self.full_seconds = 0.0
+        self.empty_seconds = 0.0
+
+    def _full(self, size):
+        return self._items and (len(self._items) >= self.max_items or (self.max_bytes is not None and self._bytes + size > self.max_bytes))
+
+    def put(self, item, size=0):
+        """
+        Adds an item to the end of the queue, waiting until there is room for it.
+
+        Parameters:
+        item: The item to add. Must not be None.
+        size (int): The size of the item in bytes.
+
+        Returns:
+        bool: True if the item was added, or False if the queue was closed.
+        """
+
+        with self._condition:
+            if self._full(size) and not self._closed:
+                start = time.perf_counter()
+                while self._full(size) and not self._closed:
+                    self._condition.wait()
+                waited = time.perf_counter() - start
+                self.full_seconds += waited
+                self.metrics.record(f'{self.name}_full', waited)
+            if self._closed:
+                return False
+            self._items.append((item, size))
+            self._bytes += size
+            self.peak_items = max(self.peak_items, len(self._items))
+            self.peak_bytes = max(self.peak_bytes, self._bytes)
+            self._condition.notify_all()
+            return True
+
+    def get(self):
+        """
+        Removes the item at the front of the queue, waiting until there is one.
+
+        Returns:
+        The item, or None if the queue is closed and empty.
+        """
+
+        with self._condition:
+            if not self._items and not self._closed:
+                start = time.perf_counter()
+                while not self._items and not self._closed:
+                    self._condition.wait()
+                waited = time.perf_counter() - start
+                self.empty_seconds += waited
+                self.metrics.record(f'{self.name}_empty', waited)
+            if not self._items:
+                return None
+            item, size = self._items.popleft()
+            self._bytes -= size
+            self._condition.notify_all()
+            return item
+
+    def close(self, discard=False):
+        """
+        Closes the queue. Items already in it can still be taken unless they are discarded.
+
+        Parameters:
+        discard (bool): Whether to drop the items still in the queue, e.g. when the pipeline is stopping on an error.
+        """
+
+        with self._condition:
+            self._closed = True
+            if discard:
+                self._items.clear()
+                self._bytes = 0
+            self._condition.notify_all()
+
+    def stats(self):
+        """
+        Returns:
+        dict: The current and peak number of items and bytes in the queue, and the seconds spent waiting for room
+        (full) and for items (empty).
+        """
+
+        with self._condition:
+            return {'items': len(self._items), 'bytes': self._bytes, 'peak_items': self.peak_items, 'peak_bytes': self.peak_bytes,
+                    'full_seconds': self.full_seconds, 'empty_seconds': self.empty_seconds}
+
+def audio_data_bytes(audio_data):
+    """
+    Returns:
+    int: The number of bytes of samples held by decoded audio, or 0 for None.
+    """
+
+    return memoryview(audio_data.frame_data).nbytes if audio_data is not None else 0
+
+class StagedEngine:
+    """
+    Processes audio files in a pipeline of stages running on their own threads, joined by bounded queues.
+
+    A walker thread feeds the filenames to the decoder threads, which look up cached transcripts and decode the
+    audio. The recognizer threads send the decoded audio to the backend and analyse the transcripts, and the calling
+    thread writes the results in the order of filenames. The queue of decoded audio is bounded by its total size as
+    well as by its length, so when recognition is slower than the disk the decoders wait rather than filling memory.
+    At most window files are in flight between the walker and the writer, which bounds the results held back
+    waiting for a slow earlier file. Memory use therefore depends on the queue sizes, not on the number of files.
+
+    Queue depths and the time each stage spent blocked are available from stats while a run is going and
+    afterwards, and are recorded in the metrics.
+    """
+
+    def __init__(self, decoders=2, recognizers=8, queue_files=16, queue_bytes=64 * 1024 * 1024):
+        """
+        Parameters:
+        decoders (int): The number of threads that decode audio.
+        recognizers (int): The number of threads that send audio to the backend.
+        queue_files (int): The maximum number of files waiting in each queue.
+        queue_bytes (int): The maximum number of bytes of decoded audio waiting to be recognised.
+
+        Raises:
+        ValueError: If any of the sizes is less than 1.
+        """
+
+        if min(decoders, recognizers, queue_files, queue_bytes) < 1:
+            raise ValueError("decoders, recognizers, queue_files and queue_bytes must be at least 1")
+        self.decoders = decoders
+        self.recognizers = recognizers
+        self.queue_files = queue_files
+        self.queue_bytes = queue_bytes
+        # Room for every queue to be full and every thread busy, so the window only binds behind a slow file
+        self.window = 3 * queue_files + decoders + recognizers
+        self._queues = ()
+        self._reorder_seconds = 0.0
+
+    def stats(self):
+        """
+        Returns:
+        dict: The stats of each queue of the current or last run, keyed by queue name, and the seconds the walker
+        spent waiting for the writer to catch up with a slow file.
+        """
+
+        return {'queues': {queue.name: queue.stats() for queue in self._queues}, 'reorder_seconds': self._reorder_seconds}
+
+    def run(self, filenames, sink, total_files, recognizer=None, directory=None, cache=None, backend=None, vad=None, metrics=None, decoder=None):
+        """
+        Processes audio files and writes the results to a CSV file in the order of filenames.
+
+        Parameters:
+        filenames (list): The filenames of the .wav files to process, in the order the rows should be written.
+        sink (CsvResultSink, ParquetResultSink or ResultTable): The sink to write the results to.
+        total_files (int): The total number of files to process.
+        recognizer (sr.Recognizer): The recognizer to copy for each thread. Defaults to the shared recognizer.
+        directory (str): The directory containing the audio files. Defaults to audio_dir.
+        cache (TranscriptCache): The cache of raw transcripts to use, if any.
+        backend (GoogleBackend or VoskBackend): The backend that transcribes the audio. Defaults to default_backend.
+        vad (VoiceActivityDetector): The detector used to trim the silence from the audio, if any.
+        metrics (Metrics): The metrics to record stage timings, counters and queue depths in, if any.
+        decoder (ProcessDecoder): The decoder that decodes the audio on worker processes, if any.
+
+        Returns:
+        int: The number of processed files.
+
+        Raises:
+        Exception: The first error raised by a stage, after the other stages have stopped.
+        """
+
+        metrics = metrics or null_metrics
+        walked = BoundedQueue('walked', self.queue_files, metrics=metrics)
+        decoded = BoundedQueue('decoded', self.queue_files, self.queue_bytes, metrics)
+        results = BoundedQueue('results', self.queue_files, metrics=metrics)
+        self._queues = (walked, decoded, results)
+        self._reorder_seconds = 0.0
+        admission = threading.Semaphore(self.window)
+        errors = []
+        stopping = threading.Event()
+        decoders_left = [self.decoders]
+        lock = threading.Lock()
+
+        def stop(error):
+            with lock:
+                errors.append(error)
+            stopping.set()
+            for queue in self._queues:
+                queue.close(discard=True)
+            admission.release(self.window)
+
+        def walk():
+            for item in enumerate(filenames):
+                if not admission.acquire(blocking=False):
+                    start = time.perf_counter()
+                    admission.acquire()
+                    waited = time.perf_counter() - start
+                    self._reorder_seconds += waited
+                    metrics.record('reorder_full', waited)
+                if stopping.is_set() or not walked.put(item):
+                    return
+            walked.close()
+
+        def decode():
+            try:
+                while (item := walked.get()) is not None:
+                    index, filename = item
+                    prepared = prepare_audio_file(filename, get_recognizer(recognizer), directory, cache, backend, vad, metrics, decoder)
+                    if not decoded.put((index, filename, prepared), audio_data_bytes(prepared[3])):
+                        return
+            except Exception as e:
+                stop(e)
+            finally:
+                with lock:
+                    decoders_left[0] -= 1
+                    if not decoders_left[0]:
+                        decoded.close()
+
+        def recognize():
+            try:
+                while (item := decoded.get()) is not None:
+                    index, filename, (audio_file, text, cache_key, audio_data, has_speech, segments) = item
+                    if text is None and has_speech:
+                        try:
+                            text = recognize_audio(audio_file, audio_data, get_recognizer(recognizer), backend, metrics)
+                        except sr.UnknownValueError:
+                            metrics.increment('unintelligible')
+                        except Exception:
+                            metrics.increment('recognizer_errors')
+                        else:
+                            if cache is not None:
+                                cache.put(cache_key, text)
+                    del audio_data, item
+                    if not results.put((index, finish_audio_file(filename, text, metrics, segments))):
+                        return
+            except Exception as e:
+                stop(e)
+
+        threads = [threading.Thread(target=walk, name='walker', daemon=True)]
+        threads += [threading.Thread(target=decode, name=f'decoder-{i}', daemon=True) for i in range(self.decoders)]
+        threads += [threading.Thread(target=recognize, name=f'recognizer-{i}', daemon=True) for i in range(self.recognizers)]
+        for thread in threads:
+            thread.start()
+
+        processed_files = 0
+        next_to_write = 0
+        completed = {}
+        try:
+            while next_to_write < len(filenames):
+                item = results.get()
+                if item is None:
+                    raise errors[0]
+                completed[item[0]] = item[1]
+                processed_files += 1
+                report_progress(processed_files, total_files)
+                while next_to_write in completed:
+                    with metrics.time('write'):
+                        sink.write(completed.pop(next_to_write))
+                    next_to_write += 1
+                    admission.release()
+        except BaseException as e:
+            if not stopping.is_set():
+                stop(e)
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+            for queue in self._queues:
+                metrics.gauge(f'queue_{queue.name}_peak_items', queue.peak_items)
+                metrics.gauge(f'queue_{queue.name}_peak_bytes', queue.peak_bytes)
+
+        return processed_files
+
+def main(workers=1, recognizer=None, cache=None, resume=False, backend=None, vad=None, metrics=None, engine=None, decoder=None, output_format='csv', deduplicator=None, shard=None):
+    """
+    The main function that processes all audio files in a directory and writes the results to a CSV file.
+
+    Files are found in audio_dir and its subdirectories, and processed in order of their relative path so that the
+    output is the same regardless of the number of workers. Files in subdirectories are written with their relative path.
+
+    In resume mode, files that already have a successful row in the existing CSV file are skipped. The failed rows
+    are dropped and the remaining files are appended as they are processed, after the rows of the previous run, so
+    the file is read and rewritten once however many files it already holds. The new rows are in filename order among
+    themselves, but the file as a whole is not sorted.
+
+    With a deduplicator, only the first copy of each recording is processed. Every row gets a 'Duplicate Of' column,
+    which names the first copy on the rows of its duplicates, whose results are copied from it.
+
+    With a decoder, at least as many files as it has worker processes are processed at once, so that every process
+    has a file to decode.
+
+    With a shard, only the files that shard_of assigns to it are processed, and the rows are written to the partial
+    output file named by shard_output_file, next to a list of the files assigned to the shard. merge_shard_outputs
+    combines the partial output files of every shard into output_file.
+
+    Parameters:
+    workers (int): The number of files to recognise concurrently. 1 processes the files one at a time.
+    recognizer (sr.Recognizer): The recognizer to use. Defaults to the shared recognizer.
+    cache (TranscriptCache): The cache of raw transcripts to use, if any.
+    resume (bool): Whether to only process the files without a successful row in the existing CSV file.
+    backend (GoogleBackend or VoskBackend): The backend that transcribes the audio. Defaults to default_backend.
+    vad (VoiceActivityDetector): The detector used to trim the silence from the audio, if any.
+    metrics (Metrics): The metrics to record stage timings and counters in, if any.
+    engine (AsyncEngine or StagedEngine): The engine that schedules recognition, if any. Takes the place of workers.
+    decoder (ProcessDecoder): The decoder that decodes the audio on worker processes, if any.
+    output_format (str): 'csv' to write output_file, 'parquet' to write a Parquet file with the same name and a
+    .parquet extension instead, or 'table' to write no file and return the results.
+    deduplicator (Deduplicator): The deduplicator that finds copies of earlier recordings, if any.
+    shard (tuple): The index of the shard to process, from 0, and the number of shards. None to process every file.
+
+    Returns:
+    ResultTable: The results in the order of their filenames with 'table' output, otherwise None.
+
+    Raises:
+    ValueError: If resume mode is combined with Parquet output, which cannot be appended to, or the shard is invalid.
+    """
+
+    if output_format not in ('csv', 'parquet', 'table'):
+        raise ValueError(f"Unknown output format '{output_format}'. Expected 'csv', 'parquet' or 'table'.")
+    if resume and output_format != 'csv':
+        raise ValueError("Resume mode needs CSV output.")
+    if shard is not None and not 0 <= shard[0] < shard[1]:
+        raise ValueError(f"Shard {shard[0]}/{shard[1]} does not exist. Shards are numbered from 0 to one less than the number of shards.")
+
+    metrics = metrics or null_metrics
+    processed_files = 0
+    target_file = output_file if shard is None else shard_output_file(output_file, *shard)
+    written_file = target_file if output_format == 'csv' else os.path.splitext(target_file)[0] + '.parquet'
+
+    # A single scan of the directory tree gives both the files to process and the total, so they cannot disagree
+    entries = sorted(iter_audio_files(audio_dir))
+    dataset_filenames = [relative_path for relative_path, size, mtime_ns in entries]
+    if shard is not None:
+        entries = [entry for entry in entries if shard_of(entry[0], shard[1]) == shard[0]]
+        if output_format != 'table':
+            # The size and digest of the whole listing let the merge check that the shards split the same dataset
+            dataset_digest = hashlib.sha256('\n'.join(dataset_filenames).encode()).hexdigest()
+            with open(f"{written_file}.files", 'w') as f:
+                json.dump({'shard': shard[0], 'shards': shard[1], 'dataset_files': len(dataset_filenames), 'dataset_digest': dataset_digest,
+                           'files': [entry[0] for entry in entries]}, f)
+        print(f"Shard {shard[0]}/{shard[1]}: {len(entries)} of {len(dataset_filenames)} files")
+    filenames = [relative_path for relative_path, size, mtime_ns in entries]
+    total_files = len(filenames)
+
+    manifest = cache.manifest if cache is not None else None
+    if manifest is not None:
+        changed_files = sum(1 for _ in manifest.changed(audio_dir, entries))
+        removed_files = manifest.prune(audio_dir, dataset_filenames)
+        print(f"Manifest: {changed_files} new or changed files, {removed_files} removed")
+
+    fieldnames = CsvResultSink.fieldnames + ([DeduplicatedResultSink.field] if deduplicator is not None else [])
+    all_filenames = filenames
+    previous_rows = {}
+    resume = resume and os.path.exists(target_file)
+    if resume:
+        previous_rows = load_successful_rows(target_file)
+        rewrite_output_file(target_file, previous_rows.values(), fieldnames)
+        filenames = [filename for filename in filenames if filename not in previous_rows]
+        total_files = len(filenames)
+        print(f"Resuming: {len(previous_rows)} files already processed, {total_files} to go")
+
+    duplicates = {}
+    if deduplicator is not None:
+        # Files from the previous run are included, so that new copies of them are found too
+        duplicates = deduplicator.find_duplicates(audio_dir, all_filenames, metrics)
+        duplicates = {duplicate: original for duplicate, original in duplicates.items() if duplicate not in previous_rows}
+        unique_filenames = [filename for filename in filenames if filename not in duplicates]
+        print(f"Deduplication: {len(duplicates)} copies of {len(set(duplicates.values()))} recordings will not be recognised")
+    else:
+        unique_filenames = filenames
+    total_files = len(unique_filenames)
+
+    # A single sink owns the output file for the whole run
+    if output_format == 'parquet':
+        sink = ParquetResultSink(written_file, fieldnames=fieldnames)
+    elif output_format == 'table':
+        sink = table = ResultTable()
+    else:
+        sink = CsvResultSink(target_file, 'a' if resume else 'w', fieldnames=fieldnames)
+    if deduplicator is not None:
+        analyse = functools.partial(analyse_audio_file, recognizer=recognizer, cache=cache, backend=backend, vad=vad, metrics=metrics, decoder=decoder)
+        sink = DeduplicatedResultSink(sink, filenames, duplicates, previous_rows, analyse)
+    if decoder is not None:
+        workers = max(workers, decoder.workers)
+    with sink:
+        if engine is not None:
+            engine.run(unique_filenames, sink, total_files, recognizer, cache=cache, backend=backend, vad=vad, metrics=metrics, decoder=decoder)
+        elif workers > 1:
+            process_audio_files_concurrently(unique_filenames, sink, total_files, workers, recognizer, cache=cache, backend=backend, vad=vad, metrics=metrics, decoder=decoder)
+        else:
+            for filename in unique_filenames:
+                processed_files = process_audio_file(filename, sink, processed_files, total_files, recognizer, cache=cache, backend=backend, vad=vad, metrics=metrics, decoder=decoder)  # update the variable with the returned value
+
+    if output_format == 'table':
+        return table
+
+def shard_of(filename, shards):
+    """
+    Picks the shard that processes an audio file.
+
+    The shard depends only on the file's relative path, hashed with SHA-256 rather than Python's per-process string
+    hash, so every node of a distributed run assigns the files the same way without talking to the others.
+
+    Parameters:
+    filename (str): The path of the audio file, relative to audio_dir.
+    shards (int): The number of shards.
+
+    Returns:
+    int: The index of the shard, from 0 to shards - 1.
+    """
+
+    digest = hashlib.sha256(filename.replace(os.sep, '/').encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % shards
+
+def shard_output_file(output_file, shard, shards):
+    """
+    Names the partial output file of a shard, e.g. output.shard-0-of-4.csv for output.csv.
+
+    Parameters:
+    output_file (str): The output file of the whole run.
+    shard (int): The index of the shard.
+    shards (int): The number of shards.
+
+    Returns:
+    str: The filename of the shard's partial output.
+    """
+
+    stem, extension = os.path.splitext(output_file)
+    return f"{stem}.shard-{shard}-of-{shards}{extension}"
+
+def merge_shard_outputs(output_file, output_format='csv'):
+    """
+    Combines the partial output files of every shard into one output file, sorted by filename.
+
+    The partial files are found next to output_file, along with the list of the files each shard was assigned. Nothing
+    is written unless every shard of the run has finished, all of them split the same dataset between them, and each
+    file of the dataset was assigned to a shard and has exactly one row.
+
+    Parameters:
+    output_file (str): The output file of the whole run. With output_format 'parquet', the merged file has the same
+    name with a .parquet extension, as in main.
+    output_format (str): 'csv' or 'parquet', as the shards were run with.
+
+    Returns:
+    int: The number of rows written.
+
+    Raises:
+    ValueError: If no partial output files are found, a shard is missing or belongs to a run with a different number of
+    shards, the shards saw different datasets or were not assigned all of it, or files are missing, duplicated or
+    were not assigned to the shard that wrote them.
+    """
+
+    if output_format not in ('csv', 'parquet'):
+        raise ValueError(f"Unknown output format '{output_format}'. Expected 'csv' or 'parquet'.")
+    stem = os.path.splitext(output_file)[0]
+    extension = '.csv' if output_format == 'csv' else '.parquet'
+    pattern = re.compile(re.escape(os.path.basename(stem)) + r"\.shard-(\d+)-of-(\d+)" + re.escape(extension) + "$")
+    directory = os.path.dirname(stem) or '.'
+    partials = {}
+    for filename in os.listdir(directory):
+        match = pattern.match(filename)
+        if match:
+            partials[int(match[1]), int(match[2])] = os.path.join(directory, filename)
+    if not partials:
+        raise ValueError(f"No partial output files were found for {stem}{extension}.")
+    counts = {shards for _, shards in partials}
+    if len(counts) > 1:
+        raise ValueError(f"Partial output files from runs with different numbers of shards were found: {sorted(counts)}.")
+    shards = counts.pop()
+    missing_shards = [shard for shard in range(shards) if (shard, shards) not in partials]
+    if missing_shards:
+        raise ValueError(f"The partial output of shards {missing_shards} of {shards} is missing.")
+
+    # Check every shard's rows against the files it was assigned before writing anything
+    pyarrow = parquet = None
+    if output_format == 'parquet':
+        pyarrow, parquet = load_pyarrow()
+    tables = []
+    rows = []
+    fieldnames = None
+    seen = set()
+    all_assigned = set()
+    datasets = set()
+    duplicated, missing, unexpected = [], [], []
+    for shard in range(shards):
+        partial = partials[shard, shards]
+        if not os.path.exists(f"{partial}.files"):
+            raise ValueError(f"The list of files assigned to shard {shard} of {shards} ({partial}.files) is missing.")
+        with open(f"{partial}.files", 'r') as f:
+            listing = json.load(f)
+        # The partial file may have been renamed, so the shard it was written by is checked against its name
+        if (listing['shard'], listing['shards']) != (shard, shards):
+            raise ValueError(f"{partial}.files was written by shard {listing['shard']} of {listing['shards']}, not shard {shard} of {shards}.")
+        assigned = listing['files']
+        all_assigned.update(assigned)
+        datasets.add((listing.get('dataset_files'), listing.get('dataset_digest')))
+        if output_format == 'parquet':
+            table = parquet.read_table(partial)
+            tables.append(table)
+            filenames = table.column('Filename').to_pylist()
+        else:
+            with open(partial, 'r', newline='') as csvfile:
+                reader = csv.DictReader(csvfile)
+                shard_rows = list(reader)
+            if fieldnames is not None and reader.fieldnames != fieldnames:
+                raise ValueError(f"{partial} has the columns {reader.fieldnames}, but the other shards have {fieldnames}.")
+            fieldnames = reader.fieldnames
+            rows += shard_rows
+            filenames = [row['Filename'] for row in shard_rows]
+        for filename in filenames:
+            if filename in seen:
+                duplicated.append(filename)
+            seen.add(filename)
+        missing += sorted(set(assigned) - set(filenames))
+        unexpected += [filename for filename in filenames if shard_of(filename, shards) != shard]
+
+    dataset_files, dataset_digest = datasets.pop() if len(datasets) == 1 else (None, None)
+    if dataset_digest is None:
+        raise ValueError(f"The {shards} shards did not all split the same list of audio files. Run every shard on the same audio directory.")
+    if len(all_assigned) != dataset_files:
+        raise ValueError(f"The {shards} shards were assigned {len(all_assigned)} of the {dataset_files} audio files between them.")
+
+    problems = [f"{len(names)} {kind} (e.g. {names[0]})" for kind, names in (('missing', missing), ('duplicated', duplicated), ('in the wrong shard', unexpected)) if names]
+    if problems:
+        raise ValueError(f"The partial outputs of {shards} shards cannot be merged: {', '.join(problems)}.")
+
+    if output_format == 'parquet':
+        merged = pyarrow.concat_tables(tables).sort_by('Filename')
+        parquet.write_table(merged, stem + '.parquet')
+        return merged.num_rows
+    rewrite_output_file(output_file, sorted(rows, key=lambda row: row['Filename']), fieldnames)
+    return len(rows)
+
+class PollingWatcher:
+    """
+    Finds new and changed .wav files by scanning a directory tree every poll_interval seconds.
+
+    Used where inotify is not available, e.g. on other operating systems or network file systems.
+    """
+
+    def __init__(self, directory, poll_interval=1.0):
+        """
+        Parameters:
+        directory (str): The directory to watch, including its subdirectories.
+        poll_interval (float): The number of seconds between scans.
+        """
+
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self._known = {}
+        self._next_scan = 0.0
+
+    def poll(self, timeout):
+        """
+        Waits up to timeout seconds for the next scan, then returns the files that appeared or changed since the last one.
+
+        Parameters:
+        timeout (float): The longest time to wait, in seconds.
+
+        Returns:
+        list: The paths of the files, relative to directory.
+        """
+
+        delay = self._next_scan - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(delay, 0))
+        self._next_scan = time.monotonic() + self.poll_interval
+
+        changed = []
+        known = {}
+        for relative_path, size, mtime_ns in iter_audio_files(self.directory):
+            known[relative_path] = (size, mtime_ns)
+            if self._known.get(relative_path) != (size, mtime_ns):
+                changed.append(relative_path)
+        self._known = known
+        return changed
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    """
+    Finds .wav files as they are finished, using Linux inotify through ctypes.
+
+    A file is reported when a writer closes it or when it is moved into the tree, so a file copied in place or
+    renamed from a temporary name is seen as soon as it is complete. New subdirectories are watched as they appear.
+    """
+
+    # The inotify event flags, from <sys/inotify.h>
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    def __init__(self, directory):
+        """
+        Parameters:
+        directory (str): The directory to watch, including its subdirectories.
+
+        Raises:
+        OSError: If inotify is not available.
+        """
+
+        import ctypes
+        import ctypes.util
+
+        self.directory = directory
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError("inotify is not available on this system")
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._get_errno = ctypes.get_errno
+        self._watches = {}
+        self._pending = []
+        self._add_tree('')
+
+    def _add_tree(self, relative_dir):
+        # Files already in a directory by the time it is watched would never produce an event, so report them too
+        self._add_watch(relative_dir)
+        for relative_path, size, mtime_ns in iter_audio_files(os.path.join(self.directory, relative_dir)):
+            self._pending.append(os.path.join(relative_dir, relative_path))
+        for root, dirs, files in os.walk(os.path.join(self.directory, relative_dir)):
+            for name in dirs:
+                self._add_watch(os.path.relpath(os.path.join(root, name), self.directory))
+
+    def _add_watch(self, relative_dir):
+        path = os.path.join(self.directory, relative_dir)
+        watch = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+        if watch < 0:
+            raise OSError(self._get_errno(), f"Cannot watch {path}")
+        self._watches[watch] = '' if relative_dir == '.' else relative_dir
+
+    def poll(self, timeout):
+        """
+        Waits up to timeout seconds for files to be finished, and returns them.
+
+        Parameters:
+        timeout (float): The longest time to wait, in seconds.
+
+        Returns:
+        list: The paths of the files, relative to directory.
+        """
+
+        import select
+
+        if not self._pending:
+            readable, _, _ = select.select([self._fd], [], [], timeout)
+            if readable:
+                self._read_events()
+        changed, self._pending = self._pending, []
+        return changed
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            watch, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b'\0'))
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                # Events were lost, so fall back to reporting every file for the caller to check
+                self._pending.extend(relative_path for relative_path, size, mtime_ns in iter_audio_files(self.directory))
+            elif mask & self.IN_IGNORED:
+                self._watches.pop(watch, None)
+            elif watch in self._watches:
+                relative_path = os.path.join(self._watches[watch], name)
+                if mask & self.IN_ISDIR:
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        self._add_tree(relative_path)
+                elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO) and name.endswith(".wav"):
+                    self._pending.append(relative_path)
+
+    def close(self):
+        """
+        Stops watching and closes the inotify file descriptor.
+        """
+
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+def create_watcher(directory, poll_interval=1.0, use_inotify=True):
+    """
+    Creates the best watcher available for a directory.
+
+    Parameters:
+    directory (str): The directory to watch, including its subdirectories.
+    poll_interval (float): The number of seconds between scans if the directory has to be polled.
+    use_inotify (bool): Whether to try inotify before falling back to polling.
+
+    Returns:
+    InotifyWatcher or PollingWatcher: The watcher.
+    """
+
+    if use_inotify:
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(directory, poll_interval)
+
+def watch(recognizer=None, cache=None, backend=None, vad=None, metrics=None, decoder=None, settle=1.0, poll_interval=1.0, use_inotify=True, stop=None):
+    """
+    Processes the .wav files in audio_dir as they arrive, appending a row to the output CSV file for each one.
+
+    The files already in audio_dir are processed first, except those with a successful row in the output CSV file,
+    as in resume mode. After that, each new or rewritten file is processed once its size and modification time have
+    stayed the same for settle seconds, so a file that is still being written is not read early. The recognizer, the cache and the output file stay open
+    between files, and each row is flushed as soon as it is written. A rewritten file that already has a row gets
+    its row replaced, by rewriting the output CSV file, rather than a second row. A file that cannot be read gets a row
+    with no audible words, and the watch carries on.
+
+    Parameters:
+    recognizer (sr.Recognizer): The recognizer to use. Defaults to the shared recognizer.
+    cache (TranscriptCache): The cache of raw transcripts to use, if any.
+    backend (GoogleBackend or VoskBackend): The backend that transcribes the audio. Defaults to default_backend.
+    vad (VoiceActivityDetector): The detector used to trim the silence from the audio, if any.
+    metrics (Metrics): The metrics to record stage timings and counters in, if any.
+    decoder (ProcessDecoder): The decoder that decodes the audio on worker processes, if any. It must be created
+    with map_files=False.
+    settle (float): The number of seconds a file must stay unchanged before it is processed.
+    poll_interval (float): The number of seconds between scans when inotify is not available.
+    use_inotify (bool): Whether to use inotify when it is available.
+    stop (threading.Event): Stops watching when set. Defaults to watching until interrupted.
+
+    Returns:
+    int: The number of processed files.
+
+    Raises:
+    ValueError: If the decoder memory-maps the files.
+    """
+
+    if decoder is None:
+        # A watched file can be rewritten while it is decoded, and reading a mapping of a truncated file kills the process
+        decoder = functools.partial(decode_audio_file, map_file=False)
+    elif decoder.map_files:
+        raise ValueError("Watch mode needs a ProcessDecoder created with map_files=False, as watched files can be rewritten while they are decoded.")
+    stop = stop or threading.Event()
+    processed = {}
+    resume = os.path.exists(output_file) and os.path.getsize(output_file) > 0
+    if resume:
+        previous_rows = load_successful_rows(output_file)
+        rewrite_output_file(output_file, previous_rows.values())
+        processed = {filename: None for filename in previous_rows}
+
+    processed_files = 0
+    pending = {}
+    watcher = create_watcher(audio_dir, poll_interval, use_inotify)
+    print(f"Watching {audio_dir} with {type(watcher).__name__}")
+    sink = CsvResultSink(output_file, 'a' if resume else 'w', batch_size=1)
+    try:
+        while not stop.is_set():
+            for relative_path in watcher.poll(min(settle, poll_interval) / 2 if pending else poll_interval):
+                pending[relative_path] = None
+
+            now = time.monotonic()
+            for relative_path, last_seen in list(pending.items()):
+                try:
+                    stat = os.stat(os.path.join(audio_dir, relative_path))
+                except FileNotFoundError:
+                    del pending[relative_path]
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if processed.get(relative_path, ()) is None:
+                    # Processed by a previous run: only process it again if it changes from now on
+                    processed[relative_path] = signature
+                    del pending[relative_path]
+                elif processed.get(relative_path) == signature:
+                    del pending[relative_path]
+                elif last_seen is None or last_seen[0] != signature:
+                    pending[relative_path] = (signature, now)
+                elif now - last_seen[1] >= settle:
+                    del pending[relative_path]
+                    try:
+                        result = analyse_audio_file(relative_path, recognizer, cache=cache, backend=backend, vad=vad, metrics=metrics, decoder=decoder)
+                    except Exception as e:
+                        # An unreadable file gets a failed row instead of stopping the watch, and is only read again if it changes
+                        print(f"Could not process {relative_path}: {e}")
+                        (metrics or null_metrics).increment('failed_files')
+                        result = AudioResult(relative_path, get_timestamp(os.path.basename(relative_path)) or "None", 0, False, 0)
+                    with (metrics or null_metrics).time('write'):
+                        if relative_path not in processed:
+                            sink.write(result)
+                        else:
+                            # The sink appends to the file it opened, so it is reopened on the rewritten file
+                            sink.close()
+                            replace_output_row(output_file, result)
+                            sink = CsvResultSink(output_file, 'a', batch_size=1)
+                    processed_files += 1
+                    report_progress(processed_files, processed_files + len(pending))
+                    processed[relative_path] = signature
+    finally:
+        sink.close()
+        watcher.close()
+    return processed_files
+
+def parse_shard(value):
+    """
+    Parses a --shard argument of the form I/N.
+
+    Parameters:
+    value (str): The argument.
+
+    Returns:
+    tuple: The index of the shard and the number of shards.
+
+    Raises:
+    argparse.ArgumentTypeError: If the argument is not of the form I/N with 0 <= I < N.
+    """
+
+    match = re.fullmatch(r"(\d+)/(\d+)", value)
+    if not match or not int(match[1]) < int(match[2]):
+        raise argparse.ArgumentTypeError(f"'{value}' is not a shard of the form I/N, with I from 0 to N - 1")
+    return int(match[1]), int(match[2])
+
+def parse_args(argv=None):
+    """
+    Parses the command line arguments for the script.
+
+    Parameters:
+    argv (list): The arguments to parse. Defaults to sys.argv.
+
+    Returns:
+    argparse.Namespace: The parsed arguments.
+    """
+
+    parser = argparse.ArgumentParser(description='Process the audio files and write the results to a CSV file.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of files to recognise concurrently (default: 1)')
+    parser.add_argument('--engine', choices=['threads', 'async', 'staged'], default='threads', help='Schedule recognition on worker threads, on an asyncio event loop with rate limiting and retries, or in a pipeline of decoding and recognition stages with bounded queues (default: threads)')
+    parser.add_argument('--rate', type=float, help='Maximum recognition requests per second, including retries (async engine only)')
+    parser.add_argument('--retries', type=int, default=3, help='Times to retry a request after a timeout, rate limit or server error (async engine only, default: 3)')
+    parser.add_argument('--timeout', type=float, help='Socket timeout in seconds of each recognition request before retrying it (async engine only)')
+    parser.add_argument('--backoff', type=float, default=0.5, help='Delay ceiling in seconds after the first failed request, doubling on each retry (async engine only, default: 0.5)')
+    parser.add_argument('--backoff-max', type=float, default=30.0, help='Largest delay ceiling in seconds between retries (async engine only, default: 30)')
+    parser.add_argument('--decoders', type=int, default=2, help='Number of threads decoding audio ahead of the recognizers (staged engine only, default: 2)')
+    parser.add_argument('--queue-files', type=int, default=16, help='Maximum number of files waiting between two stages (staged engine only, default: 16)')
+    parser.add_argument('--queue-mb', type=float, default=64, help='Maximum size of the decoded audio waiting to be recognised (staged engine only, default: 64)')
+    parser.add_argument('--processes', type=int, default=0, help='Decode the audio, and run voice activity detection, on this many worker processes (default: 0, decode in the worker threads)')
+    parser.add_argument('--backend', choices=sorted(backends), default=GoogleBackend.name, help='Speech recognition backend (default: google)')
+    parser.add_argument('--vosk-model', default=vosk_model_dir, help=f'Directory containing the Vosk model for the vosk backend (default: {vosk_model_dir})')
+    parser.add_argument('--templates', default=templates_dir, help=f'Directory of labelled clips, named after the numbers spoken in them, for the templates backend (default: {templates_dir})')
+    parser.add_argument('--template-method', choices=['centroid', 'dtw'], default='centroid', help='Match words against the average template of each number, or against every template by dynamic time warping (templates backend only, default: centroid)')
+    parser.add_argument('--stream', action='store_true', help='Decode each file a chunk at a time instead of reading it into memory (vosk backend only)')
+    parser.add_argument('--chunk-frames', type=int, default=4096, help='Number of frames per chunk when streaming (default: 4096)')
+    parser.add_argument('--vad', action='store_true', help='Only send the spoken words of each file to the recognizer, not the silence between them')
+    parser.add_argument('--sample-rate', type=int, help='Resample the audio to at most this rate in Hz before uploading it (google backend only, e.g. 16000)')
+    parser.add_argument('--flac', action='store_true', help='Encode the audio to FLAC while preprocessing and report the upload size, keeping its sample rate unless --sample-rate is given (google backend only)')
+    parser.add_argument('--dedup', action='store_true', help='Only recognise the first of several identical recordings, and copy its result to the others')
+    parser.add_argument('--dedup-similarity', type=float, help='Also treat recordings whose loudness envelopes and spectrograms are correlated by at least this much, e.g. 0.98, as copies (implies --dedup)')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='Write the results as CSV, or as typed columns to a Parquet file next to it (default: csv)')
+    parser.add_argument('--watch', action='store_true', help='Keep running and process each new .wav file as soon as it has been written')
+    parser.add_argument('--settle', type=float, default=1.0, help='Seconds a new file must stay unchanged before it is processed in watch mode (default: 1)')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between directory scans in watch mode without inotify (default: 1)')
+    parser.add_argument('--polling', action='store_true', help='Scan the directory in watch mode even where inotify is available')
+    parser.add_argument('--shard', type=parse_shard, metavar='I/N', help='Only process the files in shard I of N, numbered from 0, and write them to a partial output file')
+    parser.add_argument('--merge', action='store_true', help='Combine the partial output files of every shard into the output file, checking that no file is missing or duplicated, and exit')
+    parser.add_argument('--resume', action='store_true', help='Only process files without a successful row in the existing output CSV file')
+    parser.add_argument('--metrics', action='store_true', help='Time each stage and print a summary at the end of the run')
+    parser.add_argument('--metrics-file', help='Also write the metrics to this file (implies --metrics)')
+    parser.add_argument('--metrics-format', choices=['prometheus', 'jsonl'], default='prometheus', help='Format of the metrics file (default: prometheus)')
+    parser.add_argument('--cache-file', default=cache_file, help=f'SQLite file caching raw transcripts (default: {cache_file})')
+    parser.add_argument('--cache-size-mb', type=float, default=64, help='Size of the transcript cache before old entries are evicted (default: 64)')
+    parser.add_argument('--manifest-file', default=manifest_file, help=f'SQLite file indexing the size, modification time and hash of each audio file (default: {manifest_file})')
+    parser.add_argument('--no-manifest', action='store_true', help='Hash every audio file on every run instead of reusing the hashes of unchanged files')
+    parser.add_argument('--no-cache', action='store_true', help='Recognise every file without reading or updating the transcript cache. The manifest is still used unless --no-manifest is given')
+    parser.add_argument('--clear-cache', action='store_true', help='Empty the transcript cache before processing')
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.no_cache and args.clear_cache:
+        parser.error("--clear-cache has no cache to empty with --no-cache")
+    if args.watch and (args.format != 'csv' or args.engine != 'threads'):
+        parser.error("--watch writes CSV one file at a time and cannot be combined with --format parquet or another --engine")
+    if args.watch and (args.dedup or args.dedup_similarity is not None):
+        parser.error("--dedup compares the whole dataset and cannot be combined with --watch")
+    if args.dedup_similarity is not None and not 0 < args.dedup_similarity <= 1:
+        parser.error("--dedup-similarity must be greater than 0 and at most 1")
+    if args.shard is not None and (args.watch or args.merge):
+        parser.error("--shard processes a fixed share of the files and cannot be combined with --watch or --merge")
+    if args.resume and args.format != 'csv':
+        parser.error("--resume needs --format csv, as Parquet files cannot be appended to")
+    if args.processes < 0:
+        parser.error("--processes cannot be negative")
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate must be positive")
+    if args.retries < 0:
+        parser.error("--retries cannot be negative")
+    if args.engine != 'async' and (args.rate is not None or args.timeout is not None):
+        parser.error("--rate and --timeout need --engine async")
+    if args.decoders < 1 or args.queue_files < 1 or args.queue_mb <= 0:
+        parser.error("--decoders and --queue-files must be at least 1, and --queue-mb must be positive")
+    if args.stream and not backends[args.backend].supports_streaming:
+        parser.error(f"--stream is not supported by the {args.backend} backend")
+    if (args.sample_rate is not None or args.flac) and args.backend != GoogleBackend.name:
+        parser.error("--sample-rate and --flac need --backend google")
+    if args.sample_rate is not None and args.sample_rate < 8000:
+        parser.error("--sample-rate must be at least 8000, the lowest rate the recognizer accepts")
+    if args.stream and args.vad:
+        parser.error("--vad needs the whole recording and cannot be combined with --stream")
+    return args
+
+def create_backend(args):
+    """
+    Creates the recognizer backend selected on the command line.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line arguments.
+
+    Returns:
+    GoogleBackend, VoskBackend or TemplateBackend: The backend, with any model or templates already loaded.
+    """
+
+    if args.backend == VoskBackend.name:
+        return VoskBackend(args.vosk_model, args.stream, args.chunk_frames)
+    if args.backend == TemplateBackend.name:
+        return TemplateBackend(TemplateBank.from_directory(args.templates), args.template_method)
+    if args.sample_rate is not None or args.flac:
+        return GoogleBackend(preprocessor=AudioPreprocessor(args.sample_rate, flac=args.flac))
+    return backends[args.backend]()
+
+def run(argv=None):
+    """
+    Runs the script with command line arguments, e.g. from run.py without starting another interpreter.
+
+    Parameters:
+    argv (list): The arguments to parse. Defaults to sys.argv.
+    """
+
+    args = parse_args(argv)
+    if args.merge:
+        rows = merge_shard_outputs(output_file, args.format)
+        print(f"Merged {rows} rows")
+        return
+    backend = create_backend(args)
+    vad = VoiceActivityDetector() if args.vad else None
+    metrics = Metrics() if args.metrics or args.metrics_file else None
+    engine = None
+    if args.engine == 'async':
+        engine = AsyncEngine(args.workers, args.rate, args.retries, args.timeout, args.backoff, args.backoff_max)
+    elif args.engine == 'staged':
+        engine = StagedEngine(args.decoders, args.workers, args.queue_files, max(1, int(args.queue_mb * 1024 * 1024)))
+    with contextlib.nullcontext() if args.no_manifest else Manifest(args.manifest_file) as manifest, \
+            contextlib.nullcontext() if args.no_cache else TranscriptCache(args.cache_file, int(args.cache_size_mb * 1024 * 1024), manifest) as cache, \
+            ProcessDecoder(args.processes, map_files=not args.watch) if args.processes else contextlib.nullcontext() as decoder:
+        if cache is not None and args.clear_cache:
+            cache.clear()
+        if args.watch:
+            try:
+                watch(cache=cache, backend=backend, vad=vad, metrics=metrics, decoder=decoder, settle=args.settle, poll_interval=args.poll_interval, use_inotify=not args.polling)
+            except KeyboardInterrupt:
+                print("Stopped watching")
+        else:
+            deduplicator = Deduplicator(args.dedup_similarity, manifest) if args.dedup or args.dedup_similarity is not None else None
+            main(workers=args.workers, cache=cache, resume=args.resume, backend=backend, vad=vad, metrics=metrics, engine=engine, decoder=decoder, output_format=args.format, deduplicator=deduplicator, shard=args.shard)
+        if cache is not None:
+            print(f"Transcript cache: {cache.hits} hits, {cache.misses} misses")
+    if metrics is not None:
+        print(metrics.summary())
+        if args.metrics_file:
+            metrics.write(args.metrics_file, args.metrics_format)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run()
@@ -2,6 +2,20 @@ import unittest
 import os
 import script
 import csv
+import shutil
+import tempfile
+import threading
+import contextlib
+import io
+import json
+import benchmark
+import asyncio
+import importlib.util
+import subprocess
+import sys
+import time
+import wave
+from urllib.error import HTTPError
 
 class TestScript(unittest.TestCase):
 
@@ -400,5 +414,1372 @@ class TestScript(unittest.TestCase):
                 pass  # No row in the CSV file after the header, as expected
         os.remove("test-output-empty.csv")
 
+    def run_main(self, directory, **kwargs):
+        """
+        Runs script.main over a directory with its output silenced and returns the rows of the output CSV file.
+        """
+
+        original_audio_dir, original_output_file = script.audio_dir, script.output_file
+        script.audio_dir, script.output_file = directory, os.path.join(directory, "output.csv")
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                script.main(**kwargs)
+            with open(script.output_file, 'r') as csvfile:
+                return list(csv.reader(csvfile))
+        finally:
+            script.audio_dir, script.output_file = original_audio_dir, original_output_file
+
+    def test_main_concurrent_matches_sequential(self):
+        """
+        Tests if running with several workers writes the same rows, in the same order, as running with one.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            filenames = benchmark.generate_corpus(directory, 12, seconds=0.1)
+            sequential = self.run_main(directory, workers=1, recognizer=benchmark.StubRecognizer(latency=0))
+            concurrent = self.run_main(directory, workers=4, recognizer=benchmark.StubRecognizer(latency=0.01))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(concurrent, sequential)
+        self.assertEqual([row[0] for row in concurrent[1:]], sorted(filenames))
+        self.assertEqual(concurrent[1], [sorted(filenames)[0], '2021-09-30T00:00:00', '10', 'False', '10'])
+
+    def test_get_recognizer_worker_thread(self):
+        """
+        Tests if worker threads get their own copy of the shared recognizer while the main thread uses it directly.
+        """
+
+        shared = benchmark.StubRecognizer()
+        recognizers = []
+        worker = threading.Thread(target=lambda: recognizers.extend([script.get_recognizer(shared), script.get_recognizer(shared)]))
+        worker.start()
+        worker.join()
+        self.assertIs(script.get_recognizer(shared), shared)
+        self.assertIsNot(recognizers[0], shared)
+        self.assertIs(recognizers[0], recognizers[1])
+
+    def test_csv_result_sink_batches_rows(self):
+        """
+        Tests if the sink holds rows back until the batch size is reached and writes the rest when closed.
+        """
+
+        directory = tempfile.mkdtemp()
+        output_path = os.path.join(directory, "output.csv")
+        try:
+            sink = script.CsvResultSink(output_path, 'w', batch_size=3, flush_interval=60)
+            script.write_row_to_csv(sink, "a.wav", "None", 10, False, 10)
+            script.write_row_to_csv(sink, "b.wav", "None", 5, True, 3)
+            with open(output_path, 'r') as csvfile:
+                self.assertEqual(len(list(csv.reader(csvfile))), 1)
+            script.write_row_to_csv(sink, "c.wav", "None", 0, False, 0)
+            with open(output_path, 'r') as csvfile:
+                self.assertEqual(len(list(csv.reader(csvfile))), 4)
+            script.write_row_to_csv(sink, "d.wav", "None", 1, False, 1)
+            sink.close()
+            with open(output_path, 'r') as csvfile:
+                rows = list(csv.reader(csvfile))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(rows[0], script.CsvResultSink.fieldnames)
+        self.assertEqual(rows[-1], ["d.wav", "None", "1", "False", "1"])
+
+    def test_csv_result_sink_many_threads(self):
+        """
+        Tests if the sink keeps every row intact when rows are added from several threads at once.
+        """
+
+        directory = tempfile.mkdtemp()
+        output_path = os.path.join(directory, "output.csv")
+        try:
+            with script.CsvResultSink(output_path, 'w', batch_size=7) as sink:
+                def add_rows(thread_index):
+                    for i in range(50):
+                        script.write_row_to_csv(sink, f"{thread_index}-{i}.wav", "None", i, False, i)
+                threads = [threading.Thread(target=add_rows, args=(t,)) for t in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            with open(output_path, 'r') as csvfile:
+                rows = list(csv.reader(csvfile))[1:]
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(sorted(row[0] for row in rows), sorted(f"{t}-{i}.wav" for t in range(4) for i in range(50)))
+        self.assertTrue(all(len(row) == 5 for row in rows))
+
+    def test_transcript_cache_skips_recognizer_on_rerun(self):
+        """
+        Tests if a second run with the cache reuses the transcripts instead of calling the recognizer again.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            benchmark.generate_corpus(directory, 5, seconds=0.1)
+            recognizer = benchmark.StubRecognizer(latency=0)
+            with script.TranscriptCache(os.path.join(directory, "cache.sqlite")) as cache:
+                first = self.run_main(directory, recognizer=recognizer, cache=cache)
+                self.assertEqual(recognizer.calls, 5)
+                second = self.run_main(directory, workers=2, recognizer=recognizer, cache=cache)
+                self.assertEqual(recognizer.calls, 5)
+                self.assertEqual(cache.hits, 5)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(first, second)
+
+    def test_transcript_cache_evicts_least_recently_used(self):
+        """
+        Tests if the cache evicts the least recently used entries once it grows past its size limit.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            keys = [script.TranscriptCache.make_key(bytes([i]), "settings") for i in range(3)]
+            entry_size = len(keys[0]) + len("12345678910")
+            with script.TranscriptCache(os.path.join(directory, "cache.sqlite"), max_bytes=2 * entry_size) as cache:
+                cache.put(keys[0], "12345678910")
+                cache.put(keys[1], "12345678910")
+                cache.get(keys[0])
+                cache.put(keys[2], "12345678910")
+                self.assertEqual(cache.get(keys[0]), "12345678910")
+                self.assertIsNone(cache.get(keys[1]))
+                self.assertEqual(cache.get(keys[2]), "12345678910")
+                cache.clear()
+                self.assertEqual(len(cache), 0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_transcript_cache_key_depends_on_settings(self):
+        """
+        Tests if the same audio recognised with different settings gets a different cache key.
+        """
+
+        self.assertNotEqual(script.TranscriptCache.make_key(b"audio", "a"), script.TranscriptCache.make_key(b"audio", "b"))
+        self.assertEqual(script.TranscriptCache.make_key(b"audio", "a"), script.TranscriptCache.make_key(b"audio", "a"))
+
+    def test_main_resume_only_processes_new_and_failed_files(self):
+        """
+        Tests if resume mode skips files with a successful row and reprocesses failed and new files.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            filenames = benchmark.generate_corpus(directory, 4, seconds=0.1)
+            self.run_main(directory, recognizer=benchmark.StubRecognizer(("12345678910", None), latency=0))
+            benchmark.write_wav(os.path.join(directory, "10-01-2021 00-00-00.wav"), 0.1)
+            with open(os.path.join(directory, "output.csv"), 'a', newline='') as csvfile:
+                csvfile.write("09-30-2021 00-00-02.wav,2021-09")  # partial line left by an interrupted run
+            recognizer = benchmark.StubRecognizer(("13247810",), latency=0)
+            rows = self.run_main(directory, recognizer=recognizer, resume=True)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(recognizer.calls, 3)
+        self.assertEqual([row[0] for row in rows[1:]], [filenames[0], filenames[2], filenames[1], filenames[3], "10-01-2021 00-00-00.wav"])
+        self.assertEqual(rows[1], [filenames[0], '2021-09-30T00:00:00', '10', 'False', '10'])
+        self.assertEqual(rows[3], [filenames[1], '2021-09-30T00:00:01', '7', 'True', '2'])
+
+    def test_load_successful_rows(self):
+        """
+        Tests if only complete rows with recognised words are kept from a previous run.
+        """
+
+        directory = tempfile.mkdtemp()
+        output_path = os.path.join(directory, "output.csv")
+        try:
+            with open(output_path, 'w', newline='') as csvfile:
+                csvfile.write("Filename,Timestamp,Count of Audible Words,Words Out of Order,Longest Consecutive Count\r\n")
+                csvfile.write("a.wav,None,10,False,10\r\n")
+                csvfile.write("b.wav,None,0,False,0\r\n")
+                csvfile.write("c.wav,None,5\r\n")
+                csvfile.write("d.wav,None,10,False,1")
+            rows = script.load_successful_rows(output_path)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(list(rows), ["a.wav"])
+
+    def test_main_with_backend(self):
+        """
+        Tests if main transcribes the audio with the given backend.
+        """
+
+        class DigitsBackend:
+            name = 'digits'
+            settings = 'digits'
+            streaming = False
+
+            def recognize(self, recognizer, audio_data):
+                return "12310"
+
+        directory = tempfile.mkdtemp()
+        try:
+            benchmark.generate_corpus(directory, 2, seconds=0.1)
+            rows = self.run_main(directory, workers=2, backend=DigitsBackend())
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual([row[2:] for row in rows[1:]], [['4', 'False', '3'], ['4', 'False', '3']])
+
+    def test_recognizer_settings_depend_on_backend(self):
+        """
+        Tests if transcripts from different backends get different cache keys.
+        """
+
+        self.assertNotEqual(script.recognizer_settings(script.r, script.GoogleBackend('en-US')), script.recognizer_settings(script.r, script.GoogleBackend('en-AU')))
+        self.assertEqual(script.recognizer_settings(script.r), script.recognizer_settings(script.r, script.GoogleBackend()))
+
+    def test_vosk_backend_missing_model(self):
+        """
+        Tests if the Vosk backend fails straight away when the package or the model is missing.
+        """
+
+        with self.assertRaises((ImportError, ValueError)):
+            script.VoskBackend("no-such-model-directory")
+
+    def test_parse_args_backend(self):
+        """
+        Tests if the backend can be selected from the command line.
+        """
+
+        self.assertEqual(script.parse_args([]).backend, 'google')
+        self.assertEqual(script.parse_args(['--backend', 'vosk', '--vosk-model', 'models/en']).vosk_model, 'models/en')
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, script.parse_args, ['--backend', 'unknown'])
+            self.assertRaises(SystemExit, script.parse_args, ['--backend', 'google', '--stream'])
+        self.assertTrue(script.parse_args(['--backend', 'vosk', '--stream']).stream)
+
+    def test_parse_args_clear_cache_needs_cache(self):
+        """
+        Tests if emptying the cache is rejected rather than ignored when the cache is turned off.
+        """
+
+        self.assertTrue(script.parse_args(['--no-cache']).no_cache)
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, script.parse_args, ['--no-cache', '--clear-cache'])
+
+    def test_run_splits_commands_from_script_options(self):
+        """
+        Tests if run.py only reads commands before the script options, and never treats an option value as a command.
+        """
+
+        import run
+        self.assertEqual(run.split_args(['script', 'test', '--workers', '8']), (['script', 'test'], ['--workers', '8']))
+        self.assertEqual(run.split_args(['script', '--', 'test']), (['script'], ['test']))
+        self.assertEqual(run.split_args(['--workers', '8', 'script']), ([], ['--workers', '8', 'script']))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(run.main(['--workers', '8', 'script']), 2)
+
+    def test_iter_audio_chunks(self):
+        """
+        Tests if reading a file in chunks gives back the same audio as reading it in full.
+        """
+
+        directory = tempfile.mkdtemp()
+        audio_path = os.path.join(directory, "long.wav")
+        try:
+            benchmark.write_wav(audio_path, seconds=1.0, marker=12345)
+            chunks = list(script.iter_audio_chunks(audio_path, chunk_frames=3000))
+            with script.sr.AudioFile(audio_path) as source:
+                audio_data = script.r.record(source)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual([len(chunk.frame_data) for chunk in chunks], [6000] * 5 + [2000])
+        self.assertEqual(b''.join(chunk.frame_data for chunk in chunks), audio_data.frame_data)
+
+    def test_main_with_streaming_backend(self):
+        """
+        Tests if a streaming backend is given the audio a chunk at a time instead of the whole recording.
+        """
+
+        class ChunkCountingBackend:
+            name = 'chunks'
+            settings = 'chunks'
+            streaming = True
+            chunk_frames = 400
+            largest_chunk = 0
+
+            def recognize_stream(self, chunks):
+                for chunk in chunks:
+                    self.largest_chunk = max(self.largest_chunk, len(chunk.frame_data))
+                return "12345678910"
+
+        backend = ChunkCountingBackend()
+        directory = tempfile.mkdtemp()
+        try:
+            benchmark.generate_corpus(directory, 2, seconds=0.5)
+            rows = self.run_main(directory, backend=backend)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(backend.largest_chunk, 800)
+        self.assertEqual(rows[1][2:], ['10', 'False', '10'])
+
+    def test_voice_activity_detector_finds_words(self):
+        """
+        Tests if the detector finds one segment per word and trims the silence around them.
+        """
+
+        directory = tempfile.mkdtemp()
+        audio_path = os.path.join(directory, "words.wav")
+        try:
+            benchmark.write_counting_wav(audio_path, words=3, word_seconds=0.3, gap_seconds=0.4)
+            with script.sr.AudioFile(audio_path) as source:
+                audio_data = script.r.record(source)
+            segment_times = script.get_word_segments(audio_path)
+        finally:
+            shutil.rmtree(directory)
+        vad = script.VoiceActivityDetector()
+        segments = vad.find_segments(audio_data)
+        self.assertEqual(len(segments), 3)
+        for (start, end), expected_start in zip(segment_times, (0.4, 1.1, 1.8)):
+            self.assertAlmostEqual(start, expected_start - 0.06, delta=0.03)
+            self.assertAlmostEqual(end, expected_start + 0.36, delta=0.03)
+        trimmed = vad.trim(audio_data, segments)
+        self.assertEqual(len(trimmed.frame_data), sum(end - start for start, end in segments) * 2 + 2 * 0.15 * 16000 * 2)
+
+    def test_voice_activity_detector_silence(self):
+        """
+        Tests if the detector finds no words in a silent recording.
+        """
+
+        audio_data = script.sr.AudioData(b'\x00\x00' * 16000, 16000, 2)
+        self.assertEqual(script.VoiceActivityDetector().find_segments(audio_data), [])
+
+    def test_main_with_vad(self):
+        """
+        Tests if only the words are sent to the recognizer, silent files are not sent at all, and the words found are
+        passed on to the analysis.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            benchmark.write_counting_wav(os.path.join(directory, "09-30-2021 00-00-00.wav"), words=2)
+            benchmark.write_wav(os.path.join(directory, "09-30-2021 00-00-01.wav"), seconds=1.0)
+            recognizer = benchmark.StubRecognizer(("12",), latency=0)
+            sizes = []
+            recognize_google = recognizer.recognize_google
+            recognizer.recognize_google = lambda audio_data, **kwargs: sizes.append(len(audio_data.frame_data)) or recognize_google(audio_data)
+            metrics = script.Metrics()
+            rows = self.run_main(directory, recognizer=recognizer, vad=script.VoiceActivityDetector(), metrics=metrics)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(metrics.snapshot()['counters']['spoken_words'], 2)
+        self.assertEqual(len(sizes), 1)
+        self.assertLess(sizes[0], 2 * 0.5 * 16000 * 2 + 0.15 * 16000 * 2)
+        self.assertEqual([row[2:] for row in rows[1:]], [['2', 'False', '2'], ['0', 'False', '0']])
+
+    def test_find_longest_consecutive_count_and_order_batch_matches_scalar(self):
+        """
+        Tests if the batch analysis gives the same results as calling the scalar function on each sequence.
+        """
+
+        sequences = benchmark.random_sequences(500) + [[1, 2, 3, 1, 2], [5, 4, 3, 2, 1], [2, 2, 2, 2, 2], [7], []]
+        counts, longest, out_of_order = script.find_longest_consecutive_count_and_order_batch(*script.pack_sequences(sequences))
+        for i, sequence in enumerate(sequences):
+            if sequence:
+                self.assertEqual((longest[i], out_of_order[i]), script.find_longest_consecutive_count_and_order(sequence))
+                self.assertEqual(counts[i], len(sequence))
+        self.assertEqual((counts[-1], longest[-1], out_of_order[-1]), (0, 0, False))
+
+    def test_find_longest_consecutive_count_and_order_batch_padded(self):
+        """
+        Tests if the batch analysis accepts sequences as a padded 2-D array.
+        """
+
+        padded = script.np.array([[1, 2, 3, 1, 2], [1, 3, 4, -1, -1], [-1, -1, -1, -1, -1]])
+        counts, longest, out_of_order = script.find_longest_consecutive_count_and_order_batch(padded)
+        self.assertEqual(counts.tolist(), [5, 3, 0])
+        self.assertEqual(longest.tolist(), [3, 2, 0])
+        self.assertEqual(out_of_order.tolist(), [True, False, False])
+
+    def test_find_longest_consecutive_count_and_order_batch_value_error(self):
+        """
+        Tests if the batch analysis raises ValueError for non-integer values or inconsistent offsets.
+        """
+
+        self.assertRaises(ValueError, script.find_longest_consecutive_count_and_order_batch, script.np.array([[1.0, 2.0]]))
+        self.assertRaises(ValueError, script.find_longest_consecutive_count_and_order_batch, script.np.array([1, 2, 3]), script.np.array([0, 2]))
+        self.assertRaises(ValueError, script.find_longest_consecutive_count_and_order_batch, script.np.array([1, 2, 3]))
+
+    def test_parse_transcript_digit_run(self):
+        """
+        Tests if a run of digits is parsed the same way as get_audio_in_array_format_int, with "10" read as ten.
+        """
+
+        for sample_text in ["13247810", "12345678910", "121035", "110", "100"]:
+            self.assertEqual(script.parse_transcript(sample_text), benchmark.legacy_get_audio_in_array_format_int(sample_text))
+
+    def test_parse_transcript_spaced_digits_and_words(self):
+        """
+        Tests if spaced digits, number words and punctuation between numbers are parsed.
+        """
+
+        self.assertEqual(script.parse_transcript("1 2 3 10"), [1, 2, 3, 10])
+        self.assertEqual(script.parse_transcript("one two three"), [1, 2, 3])
+        self.assertEqual(script.parse_transcript("One, 2 three. Ten"), [1, 2, 3, 10])
+
+    def test_parse_transcript_value_error(self):
+        """
+        Tests if the parser raises ValueError for non-strings, words that are not numbers and empty transcripts.
+        """
+
+        self.assertRaises(ValueError, script.parse_transcript, 12345)
+        self.assertRaises(ValueError, script.parse_transcript, "1234abc5678910")
+        self.assertRaises(ValueError, script.parse_transcript, "one two eleven")
+        self.assertRaises(ValueError, script.parse_transcript, " ")
+
+    def test_benchmark_suite_compare(self):
+        """
+        Tests if the benchmark suite reports every stage and flags only the metrics that got worse.
+        """
+
+        results = benchmark.run_suite(files=5, seconds=0.1, workers=2, latency=0)
+        self.assertEqual(set(results['stages']), {'decode', 'recognize', 'parse', 'analyse', 'timestamp', 'write'})
+        self.assertGreater(results['main']['files_per_second'], 0)
+        self.assertGreater(results['peak_rss_bytes'], 0)
+
+        slower = json.loads(json.dumps(results))
+        slower['main']['files_per_second'] /= 2
+        slower['stages']['parse']['p50_ms'] *= 2
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(benchmark.compare_results(results, results, 0.1), [])
+            self.assertEqual(sorted(benchmark.compare_results(results, slower, 0.1)), ['main.files_per_second', 'stages.parse.p50_ms'])
+
+    def test_main_with_metrics(self):
+        """
+        Tests if a run records each stage and counts files, bytes, cache hits and unintelligible audio.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            benchmark.generate_corpus(directory, 4, seconds=0.1)
+            recognizer = benchmark.StubRecognizer(("12345678910", None), latency=0)
+            with script.TranscriptCache(os.path.join(directory, "cache.sqlite")) as cache:
+                self.run_main(directory, recognizer=recognizer, cache=cache)
+                metrics = script.Metrics()
+                self.run_main(directory, recognizer=recognizer, cache=cache, metrics=metrics)
+            snapshot = metrics.snapshot()
+            prometheus = metrics.to_prometheus()
+            metrics.write(os.path.join(directory, "metrics.jsonl"), 'jsonl')
+            metrics.write(os.path.join(directory, "metrics.jsonl"), 'jsonl')
+            with open(os.path.join(directory, "metrics.jsonl"), 'r') as f:
+                lines = [json.loads(line) for line in f]
+        finally:
+            shutil.rmtree(directory)
+        counters = snapshot['counters']
+        self.assertEqual((counters['files'], counters['cache_hits'], counters['cache_misses'], counters['unintelligible'], counters['recognizer_errors'], counters['failed_files']), (4, 2, 2, 1, 0, 1))
+        self.assertEqual(counters['bytes'], 4 * (44 + 2 * 1600))
+        self.assertEqual(snapshot['stages']['recognize']['calls'], 2)
+        self.assertEqual(snapshot['stages']['write']['calls'], 4)
+        self.assertIn('audio_files_total 4', prometheus)
+        self.assertIn('audio_stage_calls_total{stage="decode"} 2', prometheus)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0]['counters'], counters)
+
+    def test_null_metrics(self):
+        """
+        Tests if the no-op metrics accept the same calls as Metrics without recording anything.
+        """
+
+        with script.null_metrics.time('decode'):
+            script.null_metrics.increment('files')
+        self.assertFalse(script.null_metrics.enabled)
+        self.assertRaises(ValueError, script.Metrics().write, "metrics.txt", 'xml')
+
+    def run_engine(self, directory, responses, engine, latency=0):
+        """
+        Runs script.main over a directory with the async engine against a local fake recognizer.
+
+        Returns:
+        tuple: The rows of the output CSV file, the metrics counters and the number of requests the fake recognizer received.
+        """
+
+        metrics = script.Metrics()
+        with benchmark.FakeRecognitionServer(responses, latency) as server:
+            rows = self.run_main(directory, backend=script.GoogleBackend(endpoint=server.endpoint), metrics=metrics, engine=engine)
+        return rows, metrics.snapshot()['counters'], server.requests
+
+    def test_async_engine_retries_transient_errors(self):
+        """
+        Tests if the async engine retries rate limited and failed requests until they succeed.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            benchmark.generate_corpus(directory, 3, seconds=0.1)
+            engine = script.AsyncEngine(concurrency=1, retries=5, backoff_base=0)
+            rows, counters, requests = self.run_engine(directory, (429, 503, "12345678910"), engine)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual([row[2:] for row in rows[1:]], [['10', 'False', '10']] * 3)
+        self.assertEqual((requests, counters['failed_files']), (3 + counters['retries'], 0))
+        self.assertGreaterEqual(counters['retries'], 2)
+
+    def test_async_engine_does_not_retry_unknown_value(self):
+        """
+        Tests if the async engine gives up straight away on unintelligible audio, and after its retries on timeouts.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            benchmark.generate_corpus(directory, 2, seconds=0.1)
+            engine = script.AsyncEngine(concurrency=2, retries=3, backoff_base=0)
+            unknown_rows, unknown_counters, unknown_requests = self.run_engine(directory, (None,), engine)
+            engine = script.AsyncEngine(concurrency=2, retries=1, timeout=0.05, backoff_base=0)
+            timeout_rows, timeout_counters, timeout_requests = self.run_engine(directory, ("12345678910",), engine, latency=0.3)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual([row[2:] for row in unknown_rows[1:]], [['0', 'False', '0']] * 2)
+        self.assertEqual((unknown_requests, unknown_counters['retries'], unknown_counters['unintelligible'], unknown_counters['recognizer_errors']), (2, 0, 2, 0))
+        self.assertEqual([row[2:] for row in timeout_rows[1:]], [['0', 'False', '0']] * 2)
+        self.assertEqual((timeout_requests, timeout_counters['retries'], timeout_counters['unintelligible'], timeout_counters['recognizer_errors']), (4, 2, 0, 2))
+        self.assertIsNone(script.get_default_recognizer().operation_timeout)
+
+    def test_async_engine_matches_sequential(self):
+        """
+        Tests if the async engine writes the same rows, in the same order, as a sequential run.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            benchmark.generate_corpus(directory, 12, seconds=0.1)
+            with benchmark.FakeRecognitionServer(("1234",)) as server:
+                backend = script.GoogleBackend(endpoint=server.endpoint)
+                sequential = self.run_main(directory, backend=backend)
+                concurrent = self.run_main(directory, backend=backend, engine=script.AsyncEngine(concurrency=4, rate=1000))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(concurrent, sequential)
+
+    def test_is_transient_error(self):
+        """
+        Tests if timeouts, rate limiting and server errors are retried, but rejected requests and unintelligible audio are not.
+        """
+
+        def request_error(code):
+            try:
+                try:
+                    raise HTTPError("http://localhost", code, "error", {}, None)
+                except HTTPError as e:
+                    raise sr_request_error("recognition request failed")
+            except sr_request_error as e:
+                return e
+
+        sr_request_error = script.sr.RequestError
+        self.assertTrue(script.is_transient_error(request_error(429)))
+        self.assertTrue(script.is_transient_error(request_error(503)))
+        self.assertFalse(script.is_transient_error(request_error(400)))
+        self.assertTrue(script.is_transient_error(TimeoutError()))
+        self.assertFalse(script.is_transient_error(script.sr.UnknownValueError()))
+        self.assertFalse(script.is_transient_error(ValueError()))
+
+    def test_token_bucket_limits_rate(self):
+        """
+        Tests if the token bucket spaces requests out to its rate.
+        """
+
+        async def acquire(bucket, count):
+            for _ in range(count):
+                await bucket.acquire()
+
+        bucket = script.TokenBucket(rate=50)
+        start = time.monotonic()
+        asyncio.run(acquire(bucket, 6))
+        self.assertGreaterEqual(time.monotonic() - start, 5 / 50 * 0.9)
+        self.assertRaises(ValueError, script.TokenBucket, 0)
+
+    def test_main_with_process_decoder(self):
+        """
+        Tests if decoding on worker processes writes the same rows as decoding in threads, and frees its shared memory.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            benchmark.generate_corpus(directory, 4, seconds=0.1)
+            benchmark.write_counting_wav(os.path.join(directory, "2021-09-30 00-00-09.wav"), words=5)
+            vad = script.VoiceActivityDetector()
+            threads = self.run_main(directory, workers=2, recognizer=benchmark.StubRecognizer(latency=0), vad=vad)
+            metrics = script.Metrics()
+            shared_blocks = set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+            with script.ProcessDecoder(2) as decoder:
+                processes = self.run_main(directory, workers=2, recognizer=benchmark.StubRecognizer(latency=0), vad=vad, metrics=metrics, decoder=decoder)
+            leaked_blocks = set(os.listdir("/dev/shm")) - shared_blocks if os.path.isdir("/dev/shm") else set()
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(processes, threads)
+        self.assertEqual(processes[-1][2:], ['10', 'False', '10'])
+        self.assertEqual(metrics.snapshot()['stages']['decode']['calls'], 5)
+        self.assertEqual(metrics.snapshot()['counters']['spoken_words'], 5)
+        self.assertEqual(leaked_blocks, set())
+
+    def test_process_decoder_keeps_every_process_busy(self):
+        """
+        Tests if main decodes several files at once when given a decoder with several processes, even with one worker,
+        and if the decoded samples are handed back as a view of the shared memory rather than a copy.
+        """
+
+        class CountingDecoder(script.ProcessDecoder):
+            def __init__(self, workers):
+                super().__init__(workers)
+                self.calls = self.peak_calls = 0
+                self.counter_lock = threading.Lock()
+
+            def __call__(self, *args, **kwargs):
+                with self.counter_lock:
+                    self.calls += 1
+                    self.peak_calls = max(self.peak_calls, self.calls)
+                try:
+                    time.sleep(0.05)
+                    return super().__call__(*args, **kwargs)
+                finally:
+                    with self.counter_lock:
+                        self.calls -= 1
+
+        directory = tempfile.mkdtemp()
+        try:
+            benchmark.generate_corpus(directory, 6, seconds=0.1)
+            with CountingDecoder(2) as decoder:
+                rows = self.run_main(directory, recognizer=benchmark.StubRecognizer(latency=0), decoder=decoder)
+                audio_data, has_speech, segments = decoder(os.path.join(directory, rows[1][0]))
+                samples = bytes(audio_data.frame_data)
+                self.assertIsInstance(audio_data.frame_data, memoryview)
+                self.assertTrue(audio_data.frame_data.readonly)
+                del audio_data
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(decoder.peak_calls, 2)
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(len(samples), 3200)
+        self.assertEqual(decoder._blocks, [])
+
+    def test_iter_audio_files_recursive(self):
+        """
+        Tests if the directory walker finds .wav files in subdirectories with their size and modification time.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(directory, "2021-09-30", "morning"))
+            benchmark.write_wav(os.path.join(directory, "top.wav"), seconds=0.1)
+            benchmark.write_wav(os.path.join(directory, "2021-09-30", "morning", "nested.wav"), seconds=0.2)
+            with open(os.path.join(directory, "2021-09-30", "notes.txt"), 'w') as f:
+                f.write("not audio")
+            entries = sorted(script.iter_audio_files(directory))
+            total_files = script.get_total_files(directory)
+            stat = os.stat(os.path.join(directory, "top.wav"))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual([entry[0] for entry in entries], [os.path.join("2021-09-30", "morning", "nested.wav"), "top.wav"])
+        self.assertEqual(entries[0][1], 44 + 2 * 3200)
+        self.assertEqual(entries[1][1:], (stat.st_size, stat.st_mtime_ns))
+        self.assertEqual(total_files, 2)
+
+    def test_manifest_reuses_hashes_of_unchanged_files(self):
+        """
+        Tests if the manifest only hashes new and changed files, and finds them without reading them.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            filenames = benchmark.generate_corpus(directory, 3, seconds=0.1)
+            with script.Manifest(os.path.join(directory, "manifest.sqlite")) as manifest:
+                entries = sorted(script.iter_audio_files(directory))
+                first = [manifest.content_hash(os.path.join(directory, path), size, mtime_ns) for path, size, mtime_ns in entries]
+                second = [manifest.content_hash(os.path.join(directory, path)) for path, size, mtime_ns in entries]
+                hashed_once = manifest.hashed
+                expected = script.hash_file(os.path.join(directory, filenames[1]))
+
+                benchmark.write_wav(os.path.join(directory, filenames[0]), seconds=0.2)
+                os.remove(os.path.join(directory, filenames[2]))
+                entries = sorted(script.iter_audio_files(directory))
+                changed = [entry[0] for entry in manifest.changed(directory, entries)]
+                removed = manifest.prune(directory, [entry[0] for entry in entries])
+                remaining = len(manifest)
+                rehashed = manifest.content_hash(os.path.join(directory, filenames[0]))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(first, second)
+        self.assertEqual(first[1], expected)
+        self.assertEqual(hashed_once, 3)
+        self.assertEqual((changed, removed, remaining), ([filenames[0]], 1, 2))
+        self.assertNotEqual(rehashed, first[0])
+
+    def test_main_with_subdirectories_and_manifest(self):
+        """
+        Tests if files in subdirectories are processed with their relative path, and a second run hashes no audio.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(directory, "day-1"))
+            benchmark.generate_corpus(os.path.join(directory, "day-1"), 2, seconds=0.1)
+            benchmark.write_wav(os.path.join(directory, "09-30-2021 10-00-00.wav"), seconds=0.1, marker=99)
+            with script.Manifest(os.path.join(directory, "manifest.sqlite")) as manifest, \
+                    script.TranscriptCache(os.path.join(directory, "cache.sqlite"), manifest=manifest) as cache:
+                first = self.run_main(directory, recognizer=benchmark.StubRecognizer(latency=0), cache=cache)
+                hashed = manifest.hashed
+                second = self.run_main(directory, recognizer=benchmark.StubRecognizer(latency=0), cache=cache)
+                hits = cache.hits
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual([row[:2] for row in first[1:]], [["09-30-2021 10-00-00.wav", "2021-09-30T10:00:00"], [os.path.join("day-1", "09-30-2021 00-00-00.wav"), "2021-09-30T00:00:00"], [os.path.join("day-1", "09-30-2021 00-00-01.wav"), "2021-09-30T00:00:01"]])
+        self.assertEqual(second, first)
+        self.assertEqual((hashed, manifest.hashed, hits), (3, 3, 3))
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    def test_main_with_parquet_output(self):
+        """
+        Tests if Parquet output holds the same results as the CSV output, in typed columns and several row groups.
+        """
+
+        import pyarrow.parquet
+
+        directory = tempfile.mkdtemp()
+        try:
+            benchmark.generate_corpus(directory, 3, seconds=0.1)
+            benchmark.write_wav(os.path.join(directory, "unnamed.wav"), seconds=0.1, marker=99)
+            recognizer = benchmark.StubRecognizer(("12345678910", "1324", None, "12"), latency=0)
+            rows = self.run_main(directory, recognizer=recognizer)
+            self.run_main(directory, recognizer=benchmark.StubRecognizer(("12345678910", "1324", None, "12"), latency=0), output_format='parquet')
+            with script.ParquetResultSink(os.path.join(directory, "batches.parquet"), batch_size=2) as sink:
+                for row in rows[1:]:
+                    script.write_row_to_csv(sink, row[0], row[1], int(row[2]), row[3] == 'True', int(row[4]))
+            table = pyarrow.parquet.read_table(os.path.join(directory, "output.parquet"))
+            row_groups = pyarrow.parquet.ParquetFile(os.path.join(directory, "batches.parquet")).num_row_groups
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(str(table.schema.field('Timestamp').type), 'timestamp[ms]')
+        self.assertEqual(str(table.schema.field('Words Out of Order').type), 'bool')
+        self.assertEqual(table.column('Count of Audible Words').to_pylist(), [int(row[2]) for row in rows[1:]])
+        self.assertEqual(table.column('Words Out of Order').to_pylist(), [row[3] == 'True' for row in rows[1:]])
+        self.assertEqual([value.isoformat() if value else "None" for value in table.column('Timestamp').to_pylist()], [row[1] for row in rows[1:]])
+        self.assertEqual(row_groups, 2)
+
+    def test_parquet_output_cannot_resume(self):
+        """
+        Tests if resume mode is rejected for Parquet output, which cannot be appended to.
+        """
+
+        self.assertRaises(ValueError, script.main, resume=True, output_format='parquet')
+        self.assertRaises(ValueError, script.main, output_format='xml')
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, script.parse_args, ['--resume', '--format', 'parquet'])
+        self.assertEqual(script.parse_args([]).format, 'csv')
+
+    def test_get_timestamp_layouts(self):
+        """
+        Tests if the other registered filename layouts are recognised and impossible dates and times are rejected.
+        """
+
+        self.assertEqual(script.get_timestamp("2021-09-30 03-12-31.wav"), "2021-09-30T03:12:31")
+        self.assertEqual(script.get_timestamp("20210930_031231.wav"), "2021-09-30T03:12:31")
+        self.assertEqual(script.get_timestamp("02-29-2024 00-00-00.wav"), "2024-02-29T00:00:00")
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            self.assertIsNone(script.get_timestamp("02-29-2021 00-00-00.wav"))
+            self.assertIsNone(script.get_timestamp("09-30-2021 24-00-00.wav"))
+            self.assertIsNone(script.get_timestamp("2021-02-29 00-00-00.wav"))
+        self.assertIn("2021-02-29 00-00-00.wav: the date or time does not exist", stdout.getvalue())
+        self.assertNotIn("mm-dd-yyyy", stdout.getvalue())
+        self.assertIsNone(script.get_timestamp("recording.wav"))
+        self.assertRaises(ValueError, script.register_timestamp_layout, r'(?P<year>\d{4})\.wav')
+
+    def test_get_timestamps_matches_get_timestamp(self):
+        """
+        Tests if the bulk timestamp extraction gives the same result as get_timestamp for each filename.
+        """
+
+        filenames = ["09-30-2021 03-12-31.wav", "12-31-1999 23-59-59.wav", "02-29-2000 12-00-00.wav", "02-29-1900 12-00-00.wav",
+                     "00-10-2021 00-00-00.wav", "09-30-2021 03-60-00.wav", "09-3x-2021 03-12-31.wav", "09-30-2021 03-12-31.wav.bak",
+                     "2021-09-30 03-12-31.wav", "20210930_031231.wav", "notes.wav", "09-30-2021 03-12-31.wäv"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = [script.get_timestamp(filename) for filename in filenames]
+        self.assertEqual(script.get_timestamps(filenames), expected)
+        self.assertEqual(script.get_timestamps([os.path.join("2021-09-30", filenames[0]), "notes.wav"]), ["2021-09-30T03:12:31", None])
+        self.assertEqual(script.get_timestamps([]), [])
+
+    def test_import_is_lazy(self):
+        """
+        Tests if importing the script loads none of the recognizer, numerical or engine dependencies until they are used.
+        """
+
+        code = ("import sys, script\n"
+                "heavy = ['speech_recognition', 'numpy', 'asyncio', 'multiprocessing.shared_memory']\n"
+                "print(*[name in sys.modules for name in heavy])\n"
+                "script.r\n"
+                "print(*[name in sys.modules for name in heavy])\n")
+        result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(script.__file__)), capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.split("\n")[:2], ["False False False False", "True False False False"])
+        self.assertIs(script.r, script.get_default_recognizer())
+        self.assertEqual(repr(script.sr), "<lazy module 'speech_recognition'>")
+
+    def test_run_parses_arguments(self):
+        """
+        Tests if the command line entry point used by run.py takes its arguments as a list.
+        """
+
+        with contextlib.redirect_stdout(io.StringIO()) as stdout, self.assertRaises(SystemExit):
+            script.run(['--help'])
+        self.assertIn('--workers', stdout.getvalue())
+
+    def run_watch(self, use_inotify):
+        """
+        Watches a directory while files are dropped into it, and returns the filenames of the existing files and the rows written.
+        """
+
+        directory = tempfile.mkdtemp()
+        original_audio_dir, original_output_file = script.audio_dir, script.output_file
+        script.audio_dir, script.output_file = directory, os.path.join(directory, "output.csv")
+        stop = threading.Event()
+        try:
+            filenames = benchmark.generate_corpus(directory, 2, seconds=0.1)
+            with open(script.output_file, 'w', newline='') as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=script.CsvResultSink.fieldnames)
+                writer.writeheader()
+                script.write_row_to_csv(writer, filenames[0], "2021-09-30T00:00:00", 10, False, 10)
+
+            recognizer = benchmark.StubRecognizer(latency=0)
+            with contextlib.redirect_stdout(io.StringIO()):
+                watcher = threading.Thread(target=script.watch, kwargs={'recognizer': recognizer, 'settle': 0.2, 'poll_interval': 0.05, 'use_inotify': use_inotify, 'stop': stop})
+                watcher.start()
+                try:
+                    # A file renamed into place, and one written in two parts with a pause in between
+                    time.sleep(0.1)
+                    benchmark.write_wav(os.path.join(directory, "incoming.tmp"), seconds=0.1, marker=7)
+                    os.rename(os.path.join(directory, "incoming.tmp"), os.path.join(directory, "09-30-2021 01-00-00.wav"))
+                    os.makedirs(os.path.join(directory, "day-2"))
+                    benchmark.write_wav(os.path.join(directory, "day-2", "09-30-2021 02-00-00.wav"), seconds=0.1, marker=8)
+                    with open(os.path.join(directory, "day-2", "09-30-2021 02-00-00.wav"), 'rb') as f:
+                        content = f.read()
+                    with open(os.path.join(directory, "day-2", "09-30-2021 02-00-00.wav"), 'wb') as f:
+                        f.write(content[:100])
+                    time.sleep(0.1)
+                    with open(os.path.join(directory, "day-2", "09-30-2021 02-00-00.wav"), 'ab') as f:
+                        f.write(content[100:])
+
+                    deadline = time.monotonic() + 10
+                    while time.monotonic() < deadline:
+                        with open(script.output_file, 'r') as csvfile:
+                            rows = list(csv.reader(csvfile))
+                        if len(rows) >= 5:
+                            break
+                        time.sleep(0.05)
+                    time.sleep(0.5)
+                finally:
+                    stop.set()
+                    watcher.join()
+            with open(script.output_file, 'r') as csvfile:
+                return filenames, list(csv.reader(csvfile))
+        finally:
+            script.audio_dir, script.output_file = original_audio_dir, original_output_file
+            shutil.rmtree(directory)
+
+    def test_watch_with_inotify(self):
+        """
+        Tests if watch mode processes existing and new files once each, after they have been completely written.
+        """
+
+        watcher = script.create_watcher(tempfile.gettempdir())
+        watcher.close()
+        if not isinstance(watcher, script.InotifyWatcher):
+            self.skipTest("inotify is not available")
+        filenames, rows = self.run_watch(use_inotify=True)
+        self.assertEqual(sorted(row[0] for row in rows[1:]), sorted(filenames + ["09-30-2021 01-00-00.wav", os.path.join("day-2", "09-30-2021 02-00-00.wav")]))
+        self.assertEqual(rows[-1][2:], ['10', 'False', '10'])
+
+    def test_watch_with_polling(self):
+        """
+        Tests if watch mode finds new files by scanning the directory when inotify is not used.
+        """
+
+        filenames, rows = self.run_watch(use_inotify=False)
+        self.assertEqual(sorted(row[0] for row in rows[1:]), sorted(filenames + ["09-30-2021 01-00-00.wav", os.path.join("day-2", "09-30-2021 02-00-00.wav")]))
+
+    def test_watch_replaces_row_of_rewritten_file(self):
+        """
+        Tests if a watched file that is rewritten after it was processed keeps a single, updated row, and rows are
+        still appended for new files afterwards.
+        """
+
+        directory = tempfile.mkdtemp()
+        original_audio_dir, original_output_file = script.audio_dir, script.output_file
+        script.audio_dir, script.output_file = directory, os.path.join(directory, "output.csv")
+        stop = threading.Event()
+
+        def wait_for_rows(condition):
+            deadline = time.monotonic() + 10
+            while time.monotonic() < deadline:
+                with open(script.output_file, 'r') as csvfile:
+                    rows = list(csv.reader(csvfile))
+                if condition(rows):
+                    return rows
+                time.sleep(0.05)
+            return rows
+
+        try:
+            filenames = benchmark.generate_corpus(directory, 2, seconds=0.1)
+            with open(script.output_file, 'w', newline='') as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=script.CsvResultSink.fieldnames)
+                writer.writeheader()
+                script.write_row_to_csv(writer, filenames[0], "2021-09-30T00:00:00", 3, False, 3)
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                watcher = threading.Thread(target=script.watch, kwargs={'recognizer': benchmark.StubRecognizer(latency=0), 'settle': 0.2, 'poll_interval': 0.05, 'use_inotify': False, 'stop': stop})
+                watcher.start()
+                try:
+                    wait_for_rows(lambda rows: len(rows) >= 3)
+                    # One file from the earlier run and one processed by this one are both rewritten
+                    for filename in filenames:
+                        benchmark.write_wav(os.path.join(directory, filename), seconds=0.2, marker=5)
+                    wait_for_rows(lambda rows: ['3', 'False', '3'] not in [row[2:] for row in rows])
+                    time.sleep(0.5)
+                    benchmark.write_wav(os.path.join(directory, "09-30-2021 01-00-00.wav"), seconds=0.1, marker=6)
+                    wait_for_rows(lambda rows: len(rows) >= 4)
+                finally:
+                    stop.set()
+                    watcher.join()
+            with open(script.output_file, 'r') as csvfile:
+                rows = list(csv.reader(csvfile))
+        finally:
+            script.audio_dir, script.output_file = original_audio_dir, original_output_file
+            shutil.rmtree(directory)
+        self.assertEqual(sorted(row[0] for row in rows[1:]), sorted(filenames + ["09-30-2021 01-00-00.wav"]))
+        self.assertEqual([row[2:] for row in rows[1:]], [['10', 'False', '10']] * 3)
+
+    def test_watch_keeps_going_after_corrupt_file(self):
+        """
+        Tests if a corrupt file gets a failed row without stopping watch mode, and the files after it are still processed.
+        """
+
+        directory = tempfile.mkdtemp()
+        original_audio_dir, original_output_file = script.audio_dir, script.output_file
+        script.audio_dir, script.output_file = directory, os.path.join(directory, "output.csv")
+        stop = threading.Event()
+        try:
+            with open(os.path.join(directory, "09-30-2021 00-00-00.wav"), 'wb') as f:
+                f.write(b"RIFF not really a wave file")
+            benchmark.write_wav(os.path.join(directory, "09-30-2021 00-00-01.wav"), seconds=0.1)
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                watcher = threading.Thread(target=script.watch, kwargs={'recognizer': benchmark.StubRecognizer(latency=0), 'settle': 0.1, 'poll_interval': 0.05, 'use_inotify': False, 'stop': stop})
+                watcher.start()
+                try:
+                    deadline = time.monotonic() + 10
+                    while time.monotonic() < deadline and watcher.is_alive():
+                        if os.path.exists(script.output_file):
+                            with open(script.output_file, 'r') as csvfile:
+                                if len(list(csv.reader(csvfile))) >= 3:
+                                    break
+                        time.sleep(0.05)
+                    alive = watcher.is_alive()
+                finally:
+                    stop.set()
+                    watcher.join()
+            with open(script.output_file, 'r') as csvfile:
+                rows = list(csv.reader(csvfile))
+        finally:
+            script.audio_dir, script.output_file = original_audio_dir, original_output_file
+            shutil.rmtree(directory)
+        self.assertTrue(alive)
+        self.assertEqual(sorted(row[:1] + row[2:] for row in rows[1:]), [["09-30-2021 00-00-00.wav", '0', 'False', '0'], ["09-30-2021 00-00-01.wav", '10', 'False', '10']])
+        self.assertIn("Could not process 09-30-2021 00-00-00.wav", stdout.getvalue())
+
+    def test_audio_preprocessor_resamples_and_requantises(self):
+        """
+        Tests if downsampling keeps the pitch of a tone and changing the width keeps its level.
+        """
+
+        np = script.np
+        tone = np.sin(2 * np.pi * 440 * np.arange(44100) / 44100)
+        audio_data = script.sr.AudioData((tone * 16000).astype(np.int16).tobytes(), 44100, 2)
+        preprocessor = script.AudioPreprocessor(16000)
+        converted = preprocessor.convert(audio_data)
+        self.assertEqual((converted.sample_rate, converted.sample_width, len(converted.frame_data)), (16000, 2, 32000))
+        samples = np.frombuffer(converted.frame_data, np.int16)
+        self.assertEqual(np.argmax(np.abs(np.fft.rfft(samples))), 440)
+        self.assertAlmostEqual(np.abs(samples).max(), 16000, delta=100)
+        self.assertIs(preprocessor.convert(converted), converted)
+        # AudioData holds 8-bit samples signed, although get_raw_data returns them unsigned
+        narrow = script.sr.AudioData((tone * 62.5).astype(np.int8).tobytes(), 44100, 1)
+        wide = script.sr.AudioData((tone * 16000 * 65536).astype(np.int32).tobytes(), 44100, 4)
+        packed = script.sr.AudioData(np.frombuffer(wide.frame_data, np.uint8).reshape(-1, 4)[:, 1:].tobytes(), 44100, 3)
+        for other in (narrow, packed, wide):
+            samples = np.frombuffer(preprocessor.convert(other).frame_data, np.int16)
+            self.assertAlmostEqual(np.abs(samples).max(), 16000, delta=300)
+        self.assertIs(script.AudioPreprocessor(48000).convert(converted), converted)
+        # A tone above the new Nyquist limit is filtered out rather than folded back into the band
+        alias = script.sr.AudioData((np.sin(2 * np.pi * 10000 * np.arange(44100) / 44100) * 16000).astype(np.int16).tobytes(), 44100, 2)
+        samples = np.frombuffer(preprocessor.convert(alias).frame_data, np.int16).astype(np.float64)
+        self.assertLess(np.sqrt(np.mean(samples[100:-100] ** 2)), 16000 * 0.01)
+        # Audio already in the target format is wrapped for its FLAC data rather than changed in place
+        flac_preprocessor = script.AudioPreprocessor(16000, flac=True)
+        preprocessed = flac_preprocessor.preprocess(converted)
+        self.assertIsNot(preprocessed, converted)
+        self.assertNotIn('get_flac_data', vars(converted))
+        self.assertEqual(preprocessed.get_flac_data(), converted.get_flac_data(convert_width=2))
+        self.assertIs(preprocessed.get_flac_data(), preprocessed.flac_data)
+        # --flac on its own keeps the sample rate of each recording
+        flac_only = script.create_backend(script.parse_args(['--flac'])).preprocessor
+        self.assertIsNone(flac_only.sample_rate)
+        self.assertEqual(flac_only.preprocess(audio_data).sample_rate, 44100)
+
+    def test_main_with_audio_preprocessor(self):
+        """
+        Tests if preprocessing shrinks the uploads without changing the rows, and counts the bytes it saves.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            for second in range(2):
+                benchmark.write_counting_wav(os.path.join(directory, f"09-30-2021 00-00-0{second}.wav"), words=2, sample_rate=44100)
+            uploads = {}
+            for flac in (None, False, True):
+                metrics = script.Metrics()
+                preprocessor = script.AudioPreprocessor(16000, flac=flac) if flac is not None else None
+                with benchmark.FakeRecognitionServer(("12",)) as server:
+                    rows = self.run_main(directory, backend=script.GoogleBackend(endpoint=server.endpoint, preprocessor=preprocessor), metrics=metrics)
+                uploads[flac] = (rows, server.bytes_received, metrics.snapshot()['counters'], metrics.summary())
+        finally:
+            shutil.rmtree(directory)
+        original, downsampled, flac = uploads[None], uploads[False], uploads[True]
+        self.assertEqual(original[0], downsampled[0])
+        self.assertEqual(original[0], flac[0])
+        self.assertLess(downsampled[1], original[1] * 0.8)
+        frames = int(44100 * 1.8)
+        self.assertEqual(downsampled[2]['bytes_saved'], 2 * (frames * 2 - round(frames * 16000 / 44100) * 2))
+        self.assertEqual(downsampled[2]['preprocessed_files'], 2)
+        self.assertIn("Bytes saved per file", downsampled[3])
+        self.assertEqual(flac[2]['upload_bytes'], downsampled[1])
+        self.assertNotIn('bytes_saved', original[2])
+        self.assertNotEqual(script.GoogleBackend().settings, script.GoogleBackend(preprocessor=script.AudioPreprocessor()).settings)
+
+    def test_main_with_deduplicator(self):
+        """
+        Tests if copies of a recording are not recognised but get its result, and near-duplicates only when asked. A
+        recording with the same timing in another voice is not a near-duplicate.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            original = os.path.join(directory, "09-30-2021 00-00-00.wav")
+            benchmark.write_counting_wav(original, words=3)
+            benchmark.write_counting_wav(os.path.join(directory, "09-30-2021 00-00-01.wav"), words=2)
+            shutil.copy(original, os.path.join(directory, "09-30-2021 00-00-02.wav"))
+            with script.sr.AudioFile(original) as source:
+                audio_data = script.r.record(source)
+            quieter = (script.np.frombuffer(audio_data.frame_data, script.np.int16) // 2).astype(script.np.int16)
+            with open(os.path.join(directory, "09-30-2021 00-00-03.wav"), 'wb') as f:
+                f.write(script.sr.AudioData(quieter.tobytes(), audio_data.sample_rate, 2).get_wav_data())
+            for second in (4, 5):
+                benchmark.write_wav(os.path.join(directory, f"09-30-2021 00-00-0{second}.wav"), seconds=1.0, marker=second)
+            benchmark.write_counting_wav(os.path.join(directory, "09-30-2021 00-00-06.wav"), words=3, pitch=330)
+            results = {}
+            for similarity, workers in ((None, 1), (0.98, 1), (0.98, 3)):
+                metrics = script.Metrics()
+                with benchmark.FakeRecognitionServer(("123",)) as server:
+                    rows = self.run_main(directory, workers=workers, backend=script.GoogleBackend(endpoint=server.endpoint), metrics=metrics, deduplicator=script.Deduplicator(similarity))
+                results[similarity, workers] = rows, server.requests, metrics.snapshot()['counters']['duplicates']
+        finally:
+            shutil.rmtree(directory)
+        exact_rows, exact_requests, exact_duplicates = results[None, 1]
+        near_rows, near_requests, near_duplicates = results[0.98, 1]
+        self.assertEqual(exact_rows[0][-1], 'Duplicate Of')
+        self.assertEqual(exact_rows[3], ["09-30-2021 00-00-02.wav", "2021-09-30T00:00:02", '3', 'False', '3', "09-30-2021 00-00-00.wav"])
+        self.assertEqual([row[-1] for row in exact_rows[1:]], ['', '', "09-30-2021 00-00-00.wav", '', '', '', ''])
+        self.assertEqual((exact_requests, exact_duplicates), (6, 1))
+        self.assertEqual([row[-1] for row in near_rows[1:]], ['', '', "09-30-2021 00-00-00.wav", "09-30-2021 00-00-00.wav", '', '', ''])
+        self.assertEqual((near_requests, near_duplicates), (5, 2))
+        self.assertEqual(results[0.98, 3][0], near_rows)
+
+    def test_deduplicated_sink_analyses_duplicate_without_original_result(self):
+        """
+        Tests if a duplicate whose first copy has no result is analysed on its own instead of failing.
+        """
+
+        table = script.ResultTable()
+        analysed = []
+        def analyse(filename):
+            analysed.append(filename)
+            return script.AudioResult(filename, "None", 3, False, 3, None)
+        with script.DeduplicatedResultSink(table, ["b.wav", "c.wav"], {"b.wav": "a.wav"}, analyse=analyse) as sink:
+            sink.write(script.AudioResult("c.wav", "None", 1, False, 1, None))
+        self.assertEqual(analysed, ["b.wav"])
+        self.assertEqual([(result.filename, result.duplicate_of) for result in table], [("b.wav", None), ("c.wav", None)])
+
+    def test_template_backend_recognises_numbers(self):
+        """
+        Tests if the words of a recording are labelled with the number of the closest template, in the order spoken.
+        """
+
+        directory = tempfile.mkdtemp()
+        templates = tempfile.mkdtemp()
+        try:
+            benchmark.write_counting_wav(os.path.join(templates, "1 2 3 4 5 6 7 8 9 10.wav"))
+            bank = script.TemplateBank.from_directory(templates)
+            benchmark.write_counting_wav(os.path.join(directory, "09-30-2021 00-00-00.wav"), word_seconds=0.45, gap_seconds=0.3, sample_rate=44100)
+            benchmark.write_counting_wav(os.path.join(directory, "09-30-2021 00-00-01.wav"), words=4)
+            benchmark.write_wav(os.path.join(directory, "09-30-2021 00-00-02.wav"))
+            rows = {method: self.run_main(directory, backend=script.TemplateBackend(bank, method)) for method in ('centroid', 'dtw')}
+            with script.sr.AudioFile(os.path.join(directory, "09-30-2021 00-00-01.wav")) as source:
+                audio_data = script.r.record(source)
+        finally:
+            shutil.rmtree(directory)
+            shutil.rmtree(templates)
+        self.assertEqual(bank.labels, list(range(1, 11)))
+        for method in ('centroid', 'dtw'):
+            self.assertEqual([row[2:] for row in rows[method][1:]], [['10', 'False', '10'], ['4', 'False', '4'], ['0', 'False', '0']])
+        segments = script.VoiceActivityDetector().find_segments(audio_data)
+        shuffled = script.VoiceActivityDetector().trim(audio_data, [segments[2], segments[0], segments[1]])
+        self.assertEqual(script.TemplateBackend(bank).recognize(None, shuffled), "3 1 2")
+        self.assertEqual(script.TemplateBackend(bank, max_distance=0).settings.split(':')[-1], '0')
+
+    def test_template_bank_checks_labels(self):
+        """
+        Tests if clips whose number of words does not match their name, and missing template directories, are rejected.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            benchmark.write_counting_wav(os.path.join(directory, "one two_take1.wav"), words=3)
+            with self.assertRaises(ValueError):
+                script.TemplateBank.from_directory(directory)
+            with self.assertRaises(ValueError):
+                script.TemplateBank.from_directory(os.path.join(directory, "missing"))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_main_sharded_and_merged_matches_single_run(self):
+        """
+        Tests if shards process every file once between them, and if merging checks and combines their partial outputs.
+        """
+
+        directory = tempfile.mkdtemp()
+        original_audio_dir, original_output_file = script.audio_dir, script.output_file
+        try:
+            benchmark.generate_corpus(directory, 12, seconds=0.1)
+            os.makedirs(os.path.join(directory, "day-2"))
+            benchmark.generate_corpus(os.path.join(directory, "day-2"), 3, seconds=0.1)
+            expected = self.run_main(directory, recognizer=benchmark.StubRecognizer(latency=0))
+            script.audio_dir, script.output_file = directory, os.path.join(directory, "output.csv")
+            os.remove(script.output_file)
+            with contextlib.redirect_stdout(io.StringIO()):
+                for shard in range(3):
+                    script.main(recognizer=benchmark.StubRecognizer(latency=0), shard=(shard, 3))
+                partials = [script.shard_output_file(script.output_file, shard, 3) for shard in range(3)]
+                shard_rows = []
+                for partial in partials:
+                    with open(partial, 'r') as csvfile:
+                        shard_rows.append(list(csv.reader(csvfile))[1:])
+                script.run(['--merge'])
+            with open(script.output_file, 'r') as csvfile:
+                merged = list(csv.reader(csvfile))
+
+            with open(f"{partials[0]}.files", 'r') as f:
+                listing = json.load(f)
+            with open(f"{partials[0]}.files", 'w') as f:
+                json.dump(dict(listing, shard=1), f)
+            with self.assertRaisesRegex(ValueError, "written by shard 1 of 3, not shard 0 of 3"):
+                script.merge_shard_outputs(script.output_file)
+            with open(f"{partials[0]}.files", 'w') as f:
+                json.dump(dict(listing, dataset_digest="0" * 64), f)
+            with self.assertRaisesRegex(ValueError, "same list of audio files"):
+                script.merge_shard_outputs(script.output_file)
+            with open(f"{partials[0]}.files", 'w') as f:
+                json.dump(dict(listing, files=listing['files'][1:]), f)
+            with self.assertRaisesRegex(ValueError, "assigned 14 of the 15 audio files"):
+                script.merge_shard_outputs(script.output_file)
+            with open(f"{partials[0]}.files", 'w') as f:
+                json.dump(listing, f)
+
+            with open(partials[1], 'a', newline='') as csvfile:
+                csv.writer(csvfile).writerow(shard_rows[1][0])
+            with self.assertRaisesRegex(ValueError, "1 duplicated"):
+                script.merge_shard_outputs(script.output_file)
+            with open(partials[1], 'w', newline='') as csvfile:
+                csv.writer(csvfile).writerows([expected[0]] + shard_rows[1][1:])
+            with self.assertRaisesRegex(ValueError, "1 missing"):
+                script.merge_shard_outputs(script.output_file)
+            os.remove(partials[2])
+            with self.assertRaisesRegex(ValueError, r"shards \[2\] of 3"):
+                script.merge_shard_outputs(script.output_file)
+        finally:
+            script.audio_dir, script.output_file = original_audio_dir, original_output_file
+            shutil.rmtree(directory)
+        self.assertEqual(merged, expected)
+        self.assertEqual(sum(len(rows) for rows in shard_rows), 15)
+        self.assertTrue(all(shard_rows))
+        self.assertEqual(script.shard_of(os.path.join("day-2", "a.wav"), 4), script.shard_of("day-2/a.wav", 4))
+        with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            script.parse_args(['--shard', '3/3'])
+
+    def write_pcm_wav(self, path, frame_data, sample_width, channels=1):
+        """
+        Writes a WAV file with the given frames, sample width and number of channels at 8 kHz.
+        """
+
+        with wave.open(path, 'wb') as wav_file:
+            wav_file.setnchannels(channels)
+            wav_file.setsampwidth(sample_width)
+            wav_file.setframerate(8000)
+            wav_file.writeframes(frame_data)
+
+    def test_read_wav_file_matches_audio_file(self):
+        """
+        Tests if the memory-mapped reader gives the same audio as sr.AudioFile without copying it, and leaves other formats to sr.AudioFile.
+        Without mapping, the audio is the same and still readable after the file is truncated.
+        """
+
+        np = script.np
+        directory = tempfile.mkdtemp()
+        try:
+            samples = np.frombuffer(((np.sin(np.arange(8000) / 10) * 30000).astype('<i4') << 16).tobytes(), np.uint8).reshape(-1, 4)
+            paths = {}
+            for width in (1, 2, 3, 4):
+                paths[width] = os.path.join(directory, f"{width}.wav")
+                # The most significant bytes of each sample, with 8-bit samples stored unsigned as in every WAV file
+                self.write_pcm_wav(paths[width], (samples[:, 4 - width:] ^ (0x80 if width == 1 else 0)).tobytes(), width)
+            paths['stereo'] = os.path.join(directory, "stereo.wav")
+            self.write_pcm_wav(paths['stereo'], b'\x01\x00\x03\x00' * 100, 2, channels=2)
+            # A data chunk whose size was never filled in by the writer, and which ends in half a sample
+            with open(paths[2], 'rb') as f:
+                content = bytearray(f.read())
+            content[40:44] = b'\xff\xff\xff\xff'
+            paths['truncated'] = os.path.join(directory, "truncated.wav")
+            with open(paths['truncated'], 'wb') as f:
+                f.write(content[:-1])
+
+            results = {}
+            for name, path in paths.items():
+                with script.sr.AudioFile(path) as source:
+                    expected = script.r.record(source)
+                results[name] = (script.read_wav_file(path), script.read_audio_file(path), expected)
+            rewritten = os.path.join(directory, "rewritten.wav")
+            shutil.copy(paths[2], rewritten)
+            unmapped = script.read_audio_file(rewritten, map_file=False)
+            open(rewritten, 'wb').close()
+            unmapped_frames = bytes(unmapped.frame_data)
+        finally:
+            shutil.rmtree(directory)
+        for name, (mapped, audio_data, expected) in results.items():
+            # The half sample at the end of the truncated file is dropped rather than read as noise
+            whole_samples = len(expected.frame_data) // expected.sample_width * expected.sample_width
+            self.assertEqual((bytes(audio_data.frame_data), audio_data.sample_rate, audio_data.sample_width), (expected.frame_data[:whole_samples], expected.sample_rate, expected.sample_width), name)
+        for name in (1, 'stereo'):
+            self.assertIsNone(results[name][0])
+        for name in (2, 3, 4, 'truncated'):
+            self.assertIsInstance(results[name][0].frame_data, memoryview)
+        self.assertEqual(len(results['truncated'][0].frame_data), 2 * 7999)
+        self.assertEqual(unmapped_frames, results[2][2].frame_data)
+        view = np.frombuffer(results[2][0].frame_data, '<i2')
+        self.assertFalse(view.flags.owndata or view.flags.writeable)
+
+    def test_result_table_sorts_and_summarises(self):
+        """
+        Tests if the table sorts by timestamp with untimed results last, summarises its columns, and reads back a CSV file.
+        """
+
+        results = [
+            script.AudioResult("b.wav", "2021-09-30T10:00:00", 10, False, 10),
+            script.AudioResult("unnamed.wav", "None", 0, False, 0),
+            script.AudioResult("a.wav", "2021-09-29T23:59:59", 4, True, 2),
+            script.AudioResult("c.wav", "2021-09-30T11:00:00", 4, True, 2, "a.wav"),
+        ]
+        table = script.ResultTable(results)
+        directory = tempfile.mkdtemp()
+        output_path = os.path.join(directory, "output.csv")
+        try:
+            with script.CsvResultSink(output_path, 'w', fieldnames=list(script.AudioResult.fieldnames)) as sink:
+                for result in results:
+                    sink.write(result)
+            loaded = script.ResultTable.from_csv(output_path)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual([result.filename for result in table.sorted_by()], ["a.wav", "b.wav", "c.wav", "unnamed.wav"])
+        self.assertEqual([result.filename for result in table.sorted_by('count_of_audible_words', reverse=True)][0], "b.wav")
+        self.assertEqual(table[-1], results[-1])
+        self.assertEqual(table.summary(), {
+            'files': 4, 'files_without_words': 1, 'files_out_of_order': 2, 'duplicates': 1, 'audible_words': 18,
+            'mean_audible_words': 4.5, 'longest_consecutive_count': 10,
+            'first_timestamp': "2021-09-29T23:59:59", 'last_timestamp': "2021-09-30T11:00:00",
+        })
+        self.assertEqual(list(loaded), results)
+        self.assertEqual(results[0].as_row(), dict(zip(script.CsvResultSink.fieldnames, results[0])))
+
+    def test_main_returns_result_table(self):
+        """
+        Tests if main with 'table' output returns the same results as it writes to the CSV file, without writing a file.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            benchmark.generate_corpus(directory, 6, seconds=0.1)
+            rows = self.run_main(directory, workers=2, recognizer=benchmark.StubRecognizer(latency=0))
+            os.remove(os.path.join(directory, "output.csv"))
+            original_audio_dir, original_output_file = script.audio_dir, script.output_file
+            script.audio_dir, script.output_file = directory, os.path.join(directory, "output.csv")
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    table = script.main(workers=2, recognizer=benchmark.StubRecognizer(latency=0), output_format='table')
+            finally:
+                script.audio_dir, script.output_file = original_audio_dir, original_output_file
+            written = os.listdir(directory)
+        finally:
+            shutil.rmtree(directory)
+        self.assertIsInstance(table, script.ResultTable)
+        self.assertEqual([[str(value) for value in result[:5]] for result in table], rows[1:])
+        self.assertNotIn("output.csv", written)
+        self.assertEqual(table.summary()['files'], 6)
+
+    def test_bounded_queue_limits_items_and_bytes(self):
+        """
+        Tests if the queue blocks a producer once it is full by count or by size, but always admits an item into an empty queue.
+        """
+
+        metrics = script.Metrics()
+        queue = script.BoundedQueue('decoded', 3, 100, metrics)
+        self.assertTrue(queue.put('a', 60))
+        added = threading.Event()
+        producer = threading.Thread(target=lambda: (queue.put('b', 60), added.set()))
+        producer.start()
+        self.assertFalse(added.wait(0.1))
+        self.assertEqual(queue.get(), 'a')
+        producer.join(5)
+        self.assertTrue(added.is_set())
+        self.assertEqual(queue.get(), 'b')
+        self.assertTrue(queue.put('huge', 1000))
+        self.assertEqual(queue.stats()['bytes'], 1000)
+        queue.close()
+        self.assertFalse(queue.put('c', 1))
+        self.assertEqual((queue.get(), queue.get()), ('huge', None))
+        stats = queue.stats()
+        self.assertEqual((stats['items'], stats['peak_items'], stats['peak_bytes']), (0, 1, 1000))
+        self.assertGreater(stats['full_seconds'], 0.05)
+        self.assertEqual(metrics.snapshot()['stages']['decoded_full']['calls'], 1)
+        self.assertRaises(ValueError, script.BoundedQueue, 'empty', 0)
+
+    def test_main_with_staged_engine(self):
+        """
+        Tests if the staged engine writes the same rows as the thread pool while keeping the decoded audio within its queue size.
+        """
+
+        directory = tempfile.mkdtemp()
+        try:
+            benchmark.generate_corpus(directory, 20, seconds=0.1)
+            benchmark.write_wav(os.path.join(directory, "unnamed.wav"), seconds=0.1, marker=99)
+            expected = self.run_main(directory, workers=3, recognizer=benchmark.StubRecognizer(latency=0))
+            metrics = script.Metrics()
+            # Each file decodes to 3200 bytes, so at most two fit in the queue while the slow recognizers catch up
+            engine = script.StagedEngine(decoders=2, recognizers=2, queue_files=8, queue_bytes=6400)
+            rows = self.run_main(directory, recognizer=benchmark.StubRecognizer(latency=0.01), engine=engine, metrics=metrics)
+            stats = engine.stats()['queues']
+            snapshot = metrics.snapshot()
+            failing = script.StagedEngine(decoders=2, recognizers=2, queue_files=2)
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertRaises(FileNotFoundError, failing.run, ["missing.wav"] + [f"{i}.wav" for i in range(20)], script.ResultTable(), 21, directory=directory)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(rows, expected)
+        self.assertLessEqual(stats['decoded']['peak_bytes'], 6400)
+        self.assertEqual(stats['decoded']['peak_items'], 2)
+        self.assertEqual(stats['decoded']['items'], 0)
+        self.assertEqual(snapshot['gauges']['queue_decoded_peak_bytes'], stats['decoded']['peak_bytes'])
+        self.assertIn('decoded_full', snapshot['stages'])
+        self.assertEqual(snapshot['stages']['write']['calls'], 21)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file